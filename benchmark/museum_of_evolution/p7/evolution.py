@@ -0,0 +1,560 @@
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as la
+from floq.helpers.index import n_to_i, i_to_n
+from floq.helpers.numpy_replacements import numba_outer, numba_zeros
+import floq.helpers.blockmatrix as bm
+import floq.helpers.matrix as mm
+import floq.errors as errors
+import itertools
+import cmath
+from numba import autojit
+
+
+def get_u(hf, params):
+    """
+    Calculate the time evolution operator U,
+    given a Fourier transformed Hamiltonian Hf
+    and the parameters of the problem
+    """
+    return get_u_and_eigensystem(hf, params)[0]
+
+
+def get_u_and_udot(hf, params):
+    """
+    Calculate the time evolution operator U,
+    given a Fourier transformed Hamiltonian Hf
+    and the parameters of the problem, as well
+    as its time derivative.
+    """
+    u, vals, vecs, phi, psi = get_u_and_eigensystem(hf, params)
+
+    psidot = calculate_psidot(vecs, params)
+
+    udot = calculate_udot(phi, psi, psidot, vals, params)
+
+    return [u, udot]
+
+
+def get_u_and_du(hf, dhf, params):
+    """
+    Calculate the time evolution operator U
+    given a Fourier transformed Hamiltonian Hf,
+    as well as its derivative dU given dHf,
+    and the parameters of the problem
+    """
+    u, vals, vecs, phi, psi = get_u_and_eigensystem(hf, params)
+
+    du = get_du_from_eigensystem(dhf, psi, vals, vecs, params)
+
+    return [u, du]
+
+
+def get_u_and_eigensystem(hf, params):
+    """
+    Calculate the time evolution operator U,
+    given a Fourier transformed Hamiltonian Hf
+    and the parameters of the problem, and return
+    it as well as the intermediary results
+    """
+    k = assemble_k(hf, params)
+
+    vals, vecs = find_eigensystem(k, params)
+
+    phi = calculate_phi(vecs)
+    psi = calculate_psi(vecs, params)
+
+    return [calculate_u(phi, psi, vals, params), vals, vecs, phi, psi]
+
+
+def get_du_from_eigensystem(dhf, psi, vals, vecs, params):
+    # dhf can hold the derivatives of Hf with respect to any set of
+    # parameters that enter Hf linearly, not only the controls:
+    # the number of parameters is inferred from its first index
+    dk = assemble_dk(dhf, params)
+    du = calculate_du(dk, psi, vals, vecs, params)
+
+    return du
+
+
+def get_d2u_from_eigensystem(dhf_a, dhf_b, psi, vals, vecs, params):
+    """
+    Calculate the mixed second derivatives d^2U/da_i db_j,
+    given the derivatives dhf_a and dhf_b of the Fourier transformed
+    Hamiltonian with respect to two sets of parameters a and b,
+    and the eigensystem of K.
+
+    Hf is assumed to be linear in a and b (as it is in the controls of most systems),
+    otherwise the contribution of its second derivative is missing.
+
+    Returns an array of shape (na, nb, dim, dim).
+    """
+    dk_a = assemble_dk(dhf_a, params)
+    dk_b = assemble_dk(dhf_b, params)
+
+    return calculate_d2u(dk_a, dk_b, psi, vals, vecs, params)
+
+
+def get_udot_from_eigensystem(phi, psi, vals, vecs, params):
+    """
+    Calculate the time evolution operator U,
+    given a Fourier transformed Hamiltonian Hf
+    and the parameters of the problem, as well
+    as its time derivative.
+    """
+
+    psidot = calculate_psidot(vecs, params)
+
+    udot = calculate_udot(phi, psi, psidot, vals, params)
+
+    return udot
+
+
+def assemble_k(hf, p):
+    # assemble the Floquet Hamiltonian K from
+    # the components of the Fourier-transformed Hamiltonian
+    return numba_assemble_k(hf, p.dim, p.k_dim, p.nz, p.nc, p.omega)
+
+@autojit(nopython=True)
+def numba_assemble_k(hf, dim, k_dim, nz, nc, omega):
+    hf_max = (nc-1)/2
+    k = numba_zeros((k_dim, k_dim))
+
+    # Assemble K by placing each component of Hf in turn, which
+    # for a fixed Fourier index lie on diagonals, with 0 on the
+    # main diagonal, positive numbers on the right and negative on the left
+    #
+    # The first row is therefore essentially Hf(0) Hf(-1) ... Hf(-hf_max) 0 0 0 ...
+    # The last row is then ... 0 0 0 Hf(+hf_max) ... Hf(0)
+    # Note that the main diagonal acquires a factor of omega*identity*(row/column number)
+
+    for n in range(-hf_max, hf_max+1):
+        start_row = max(0, n)  # if n < 0, start at row 0
+        start_col = max(0, -n)  # if n > 0, start at col 0
+
+        stop_row = min((nz-1)+n, nz-1)
+        stop_col = min((nz-1)-n, nz-1)
+
+        row = start_row
+        col = start_col
+
+        current_component = hf[n_to_i(n, nc)]
+
+        while row <= stop_row and col <= stop_col:
+            if n == 0:
+                block = current_component + np.identity(dim)*omega*i_to_n(row, nz)
+                bm.set_block_in_matrix(block, k, dim, nz, row, col)
+            else:
+                bm.set_block_in_matrix(current_component, k, dim, nz, row, col)
+
+            row += 1
+            col += 1
+
+    return k
+
+
+def assemble_dk(dhf, p):
+    # assemble the derivative of the Floquet Hamiltonian K from
+    # the components of the derivative of the Fourier-transformed Hamiltonian
+    # This is equivalent to K, with Hf -> d HF and omega -> 0.
+    return numba_assemble_dk(dhf, dhf.shape[0], p.dim, p.k_dim, p.nz, p.nc)
+
+@autojit(nopython=True)
+def numba_assemble_dk(dhf, npm, dim, k_dim, nz, nc):
+    dk = np.empty((npm, k_dim, k_dim), dtype=np.complex128)
+    for c in range(npm):
+        dk[c, :, :] = numba_assemble_k(dhf[c], dim, k_dim, nz, nc, 0.0)
+
+    return dk
+
+
+
+def find_eigensystem(k, p):
+    # Find unique eigenvalues and -vectors,
+    # return them as segments (each of which is a ket)
+    unique_vals, unique_vecs = get_basis(k, p)
+
+    unique_vecs = np.array([np.split(unique_vecs[i], p.nz) for i in xrange(p.dim)])
+
+    return [unique_vals, unique_vecs]
+
+
+def get_basis(k, p):
+    # Compute the eigensystem of K,
+    # then separate out the dim relevant parts,
+    # orthogonalising degenerate subspaces.
+    vals, vecs = compute_eigensystem(k, p)
+
+    start = find_first_above_value(vals, -p.omega/2.)
+
+    picked_vals = vals[start:start+p.dim]
+    picked_vecs = np.array([vecs[:, i] for i in xrange(start, start+p.dim)])
+
+    degenerate_indices = find_duplicates(picked_vals, p.decimals)
+
+    if degenerate_indices:
+        to_orthogonalize = picked_vecs[degenerate_indices]
+
+        orthogonalized = mm.gram_schmidt(to_orthogonalize)
+
+        picked_vecs[degenerate_indices, :] = orthogonalized
+
+
+    return [picked_vals, picked_vecs]
+
+
+def compute_eigensystem(k, p):
+    # Find eigenvalues and eigenvectors of k,
+    # using the method specified in the parameters
+    # (sparse is almost always faster, and is the default)
+    if p.sparse:
+        k = sp.csc_matrix(k)
+
+        number_of_eigs = min(2*p.dim, p.k_dim)
+
+        # find number_of_eigs eigenvectors/-values around 0.0
+        # -> trimming/sorting the eigensystem is NOT necessary
+        vals, vecs = la.eigs(k, k=number_of_eigs, sigma=0.0)
+
+    else:
+        vals, vecs = np.linalg.eig(k)
+        vals, vecs = trim_eigensystem(vals, vecs, p)
+
+    vals = vals.real.astype(np.float64, copy=False)
+
+    # sort eigenvalues / eigenvectors
+    idx = vals.argsort()
+    vals = vals[idx]
+    vecs = vecs[:, idx]
+
+    return vals, vecs
+
+
+def trim_eigensystem(vals, vecs, p):
+    # Trim eigenvalues and eigenvectors to only 2*dim ones
+    # clustered around zero
+
+    # Sort eigenvalues and -vectors in increasing order
+    idx = vals.argsort()
+    vals = vals[idx]
+    vecs = vecs[:, idx]
+
+    # Only keep values around 0
+    middle = p.k_dim/2
+    cutoff_left = max(0, middle - p.dim)
+    cutoff_right = min(p.k_dim, cutoff_left + 2*p.dim)
+
+    cut_vals = vals[cutoff_left:cutoff_right]
+    cut_vecs = vecs[:, cutoff_left:cutoff_right]
+
+    return cut_vals, cut_vecs
+
+
+@autojit(nopython=True)
+def find_first_above_value(array, value):
+    """Find the index of the first array entry > value."""
+    for i in xrange(len(array)):
+        if array[i] > value:
+            return i
+    return None
+
+
+def find_duplicates(array, decimals):
+    indices = np.arange(array.shape[0])
+    a = np.round(array, decimals=decimals)
+
+    vals, idx_start, count = np.unique(a, return_counts=True,
+                                       return_index=True)
+
+    res = np.split(indices, idx_start[1:])
+
+
+    res = filter(lambda x: x.size > 1, res)
+
+    return res
+
+
+
+@autojit(nopython=True)
+def calculate_phi(vecs):
+    # Given an array of eigenvectors vecs,
+    # sum over Fourier components in each
+    dim = vecs.shape[0]
+    phi = np.empty((dim, dim), dtype=np.complex128)
+    for i in range(dim):
+        phi[i] = numba_sum_components(vecs[i], dim)
+    return phi
+
+@autojit(nopython=True)
+def numba_sum_components(vec, dim):
+    n = vec.shape[0]
+    result = numba_zeros(dim)
+    for i in range(n):
+        result += vec[i]
+    return result
+
+
+
+def calculate_psi(vecs, p):
+    # Given an array of eigenvectors vecs,
+    # sum over all Fourier components in each,
+    # weighted by exp(- i omega t n), with n
+    # being the Fourier index of the component
+
+    return numba_calculate_psi(vecs, p.dim, p.nz, p.omega, p.t)
+
+@autojit(nopython=True)
+def numba_calculate_psi(vecs, dim, nz, omega, t):
+    psi = numba_zeros((dim, dim))
+
+    for k in range(0, dim):
+        partial = numba_zeros(dim)
+        for i in range(0, nz):
+            num = i_to_n(i, nz)
+            partial += np.exp(1j*omega*t*num)*vecs[k][i]
+        psi[k, :] = partial
+
+    return psi
+
+
+def calculate_psidot(vecs, p):
+    # Given an array of eigenvectors vecs,
+    # sum over all Fourier components in each,
+    # weighted by exp(- i omega t n), with n
+    # being the Fourier index of the component
+
+    return numba_calculate_psidot(vecs, p.dim, p.nz, p.omega, p.t)
+
+@autojit(nopython=True)
+def numba_calculate_psidot(vecs, dim, nz, omega, t):
+    psidot = numba_zeros((dim, dim))
+
+    for k in range(0, dim):
+        partial = numba_zeros(dim)
+        for i in range(0, nz):
+            num = i_to_n(i, nz)
+            partial += (1j*omega*num)*np.exp(1j*omega*t*num)*vecs[k][i]
+        psidot[k, :] = partial
+
+    return psidot
+
+
+def calculate_u(phi, psi, energies, p):
+    u = np.zeros([p.dim, p.dim], dtype='complex128')
+    t = p.t
+
+    for k in xrange(0, p.dim):
+        u += np.exp(-1j*t*energies[k])*np.outer(psi[k], np.conj(phi[k]))
+
+    return u
+
+
+def calculate_udot(phi, psi, psidot, energies, p):
+    udot = np.zeros([p.dim, p.dim], dtype='complex128')
+    t = p.t
+
+    for k in xrange(0, p.dim):
+        udot += np.exp(-1j*t*energies[k])*np.outer(psidot[k], np.conj(phi[k]))
+        udot += -1j*energies[k]*np.exp(-1j*t*energies[k])*np.outer(psi[k], np.conj(phi[k]))
+
+    return udot
+
+
+
+def calculate_du(dk, psi, vals, vecs, p):
+    # Given the eigensystem of K, and its derivative,
+    # perform the computations to get dU.
+    #
+    # This routine is optimised and quite hard to read, I recommend
+    # taking a look in the museum, which contains functionally equivalent,
+    # but much more readable versions.
+
+    dim = p.dim
+    nz_max = p.nz_max
+    nz = p.nz
+    npm = dk.shape[0]
+    omega = p.omega
+    t = p.t
+
+    vecsstar = np.conj(vecs)
+    factors = calculate_factors(dk, nz, nz_max, dim, npm, vals, vecs, vecsstar, omega, t)
+    return assemble_du(nz, nz_max, dim, npm, factors, psi, vecsstar)
+
+
+def calculate_factors(dk, nz, nz_max, dim, npm, vals, vecs, vecsstar, omega, t):
+    # Factors in the sum for dU that only depend on dn=n1-n2, and therefore
+    # can be computed more efficiently outside the "full" loop
+    factors = np.empty([npm, 2*nz+1, dim, dim], dtype=np.complex128)
+
+    for dn in xrange(-nz_max*2, 2*nz_max+1):
+        idn = n_to_i(dn, 2*nz)
+        for i1 in xrange(0, dim):
+            for i2 in xrange(0, dim):
+                v1 = np.roll(vecsstar[i1], dn, axis=0)  # not supported by numba!
+                for c in xrange(0, npm):
+                    factors[c, idn, i1, i2] = (integral_factors(vals[i1], vals[i2], dn, omega, t) *
+                                               expectation_value(dk[c], v1, vecs[i2]))
+
+    return factors
+
+
+@autojit(nopython=True)
+def assemble_du(nz, nz_max, dim, npm, alphas, psi, vecsstar):
+    # Execute the sum defining dU, taking pre-computed factors into account
+    du = numba_zeros((npm, dim, dim))
+
+    for n2 in range(-nz_max, nz_max+1):
+        for i1 in range(0, dim):
+            for i2 in range(0, dim):
+                product = numba_outer(psi[i1], vecsstar[i2, n_to_i(-n2, nz)])
+                for n1 in range(-nz_max, nz_max+1):
+                    idn = n_to_i(n1-n2, 2*nz)
+                    for c in xrange(0, npm):
+                        du[c] += alphas[c, idn, i1, i2]*product
+
+    return du
+
+
+@autojit(nopython=True)
+def integral_factors(e1, e2, dn, omega, t):
+    if e1 == e2 and dn == 0:
+        return -1.0j*cmath.exp(-1j*t*e1)*t
+    else:
+        return (cmath.exp(-1j*t*e1)-cmath.exp(-1j*t*(e2-omega*dn)))/((e1-e2+omega*dn))
+
+
+@autojit(nopython=True)
+def expectation_value(dk, v1, v2):
+    # Computes <v1|dk|v2>, assuming v1 is already conjugated
+
+    # v1 and v2 are split into Fourier components,
+    # we undo that here
+    a = v1.flatten()
+    b = v2.flatten()
+
+    return np.dot(np.dot(a, dk), b)
+
+
+
+def calculate_d2u(dk_a, dk_b, psi, vals, vecs, p):
+    # Given the eigensystem of K, and its derivatives with respect
+    # to two sets of parameters, compute the mixed second derivatives of U.
+    #
+    # The second derivative of exp(-iKt) is (Daleckii-Krein)
+    #   sum_abc |a> (A_ac B_cb + B_ac A_cb) <b| f[l_a, l_c, l_b],
+    # with f[.,.,.] the second divided difference of exp(-i l t).
+    # The eigenvectors of K in other Brillouin zones are the ones we have,
+    # shifted by m zones (with l -> l + m omega). As for dU, the sum over the
+    # zone of |a> combines with the phases into psi, which leaves sums over the
+    # zone offsets d = m_c - m_a and e = m_b - m_a, and over the zone m_a itself,
+    # which only enters through the components of <b| that are summed up (in S).
+
+    dim = p.dim
+    nz = p.nz
+    nz_max = p.nz_max
+    nd = 4*nz_max+1
+
+    shifted = shift_vecs(vecs, nz_max).reshape(dim, nd, p.k_dim)
+    vecsstar = np.conj(vecs.reshape(dim, p.k_dim))
+
+    ma = shifted_expectation_values(dk_a, vecsstar, shifted)
+    mb = shifted_expectation_values(dk_b, vecsstar, shifted)
+
+    # offsets d (first axis) and e (second axis), and e-d for the second matrix element
+    offsets = np.arange(-2*nz_max, 2*nz_max+1)
+    d, e = offsets[:, np.newaxis], offsets[np.newaxis, :]
+    e_minus_d = e - d + 2*nz_max
+    outside = (e_minus_d < 0) | (e_minus_d >= nd)
+    e_minus_d = np.clip(e_minus_d, 0, nd-1)
+
+    ma_second = ma[..., e_minus_d]
+    mb_second = mb[..., e_minus_d]
+    ma_second[..., outside] = 0.0
+    mb_second[..., outside] = 0.0
+
+    # divided differences, indexed as [k_a, k_c, k_b, d, e]
+    x = vals[:, None, None, None, None]
+    y = vals[None, :, None, None, None] + p.omega*d[None, None, None, :, :]
+    z = vals[None, None, :, None, None] + p.omega*e[None, None, None, :, :]
+    factors = second_integral_factors(x, y, z, p.t)
+
+    coefficients = np.einsum('akcd,bcjde,kcjde->abkjde', ma, mb_second, factors) \
+        + np.einsum('bkcd,acjde,kcjde->abkjde', mb, ma_second, factors)
+
+    s = summed_components(vecs, d, e, nz_max)
+
+    partial = np.einsum('abkjde,jdey->abky', coefficients, s)
+    return np.einsum('kx,abky->abxy', psi, partial)
+
+
+def shift_vecs(vecs, nz_max):
+    # Shift the eigenvectors by -2*nz_max...2*nz_max Brillouin zones,
+    # dropping the components that leave the truncated space
+    dim, nz = vecs.shape[0], vecs.shape[1]
+    nd = 4*nz_max+1
+    shifted = np.zeros((dim, nd, nz, dim), dtype=np.complex128)
+
+    for i in xrange(nd):
+        d = i - 2*nz_max
+        if d >= 0:
+            shifted[:, i, d:] = vecs[:, :nz-d]
+        else:
+            shifted[:, i, :nz+d] = vecs[:, -d:]
+
+    return shifted
+
+
+def shifted_expectation_values(dk, vecsstar, shifted):
+    # Compute <v_k1|dk[c]|v_k2 shifted by d>, indexed as [c, k1, k2, d],
+    # given the conjugated and flattened vectors vecsstar
+    applied = np.tensordot(dk, shifted, axes=([2], [2]))  # [c, x, k2, d]
+    return np.einsum('kx,cxjd->ckjd', vecsstar, applied)
+
+
+def summed_components(vecs, d, e, nz_max):
+    # For each pair of offsets d and e, sum the conjugated components
+    # of the eigenvectors over all zones m for which m, m+d and m+e
+    # lie in the truncated space; the component of zone m+e enters.
+    # Returned as [k, d, e, component].
+    vecsstar = np.conj(vecs)
+    dim, nz = vecs.shape[0], vecs.shape[1]
+
+    cumulative = np.zeros((dim, nz+1, dim), dtype=np.complex128)
+    cumulative[:, 1:] = np.cumsum(vecsstar, axis=1)
+
+    lo = np.maximum(-nz_max, np.maximum(-nz_max-d, -nz_max-e))
+    hi = np.minimum(nz_max, np.minimum(nz_max-d, nz_max-e))
+
+    # zone m+e sits at index nz_max-(m+e) (see assemble_du)
+    first = np.clip(nz_max-hi-e, 0, nz)
+    last = np.clip(nz_max-lo-e+1, 0, nz)
+    empty = hi < lo
+
+    summed = cumulative[:, last] - cumulative[:, first]
+    summed[:, empty] = 0.0
+
+    return summed
+
+
+def divided_differences(x, y, t):
+    # First divided difference of exp(-i l t) at x and y,
+    # written in a form that is stable when x and y (nearly) coincide
+    mean = 0.5*(x+y)
+    half = 0.5*(x-y)
+    return -1j*t*np.exp(-1j*t*mean)*np.sinc(t*half/np.pi)
+
+
+def second_integral_factors(x, y, z, t, tolerance=1e-7):
+    # Second divided difference of exp(-i l t) at x, y and z.
+    # It is symmetric in its arguments, so the points are sorted
+    # in order to divide by the largest distance.
+    x, y, z = np.broadcast_arrays(x, y, z)
+    points = np.sort(np.array([x, y, z]), axis=0)
+    lo, mid, hi = points[0], points[1], points[2]
+
+    spread = hi - lo
+    degenerate = spread < tolerance
+    spread = np.where(degenerate, 1.0, spread)
+
+    factors = (divided_differences(mid, hi, t) - divided_differences(lo, mid, t))/spread
+    return np.where(degenerate, -0.5*t**2*np.exp(-1j*t*mid), factors)
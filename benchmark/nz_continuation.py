@@ -0,0 +1,56 @@
+import sys
+sys.path.append('..')
+import time
+from floq.systems.spins import SpinEnsemble
+from floq.optimization.fidelity import EnsembleFidelity, OperatorDistance
+from floq.optimization.optimizer import SciPyOptimizer, ContinuationOptimizer
+import numpy as np
+
+
+def time_to_target(make_optimizer, goal):
+    """
+    Run an optimisation on a fresh ensemble, returning the time until
+    f first dropped below goal (with the full truncation), the total time
+    and the final f.
+    """
+    fid = EnsembleFidelity(SpinEnsemble(n, ncomp, 1.5, freqs, amps), OperatorDistance,
+                           t=1.0, target=target)
+    reached = [None]
+    start = time.time()
+
+    iterate = fid.iterate
+    def timed_iterate(controls):
+        iterate(controls)
+        full = not fid.fidelities[0].system.fixed_nz
+        if reached[0] is None and full and fid.f(controls) <= goal:
+            reached[0] = time.time() - start
+    fid.iterate = timed_iterate
+
+    res = make_optimizer(fid).optimize()
+    return reached[0], time.time() - start, res.fun
+
+
+def report(name, result):
+    reached, total, f = result
+    reached = "never" if reached is None else str(round(reached, 3)) + " s"
+    print name + ": target after " + reached + ", done after " + str(round(total, 3)) + \
+        " s at F=" + str(f)
+
+
+ncomp = 5
+n = 50
+freqs = 0.01*np.ones(n)-0.025+0.05*np.random.rand(n)
+amps = 1.0*np.ones(n)-0.025+0.05*np.random.rand(n)
+ctrl = 0.5*np.ones(2*ncomp)
+target = np.array([[-0.0720053 + 0.j, -0.705271 - 0.705271j],
+                   [0.705271 - 0.705271j, -0.0720053 + 0.j]])
+goal = 1e-3
+stages = [(5, 3, 0.2), (15, 6, 0.001)]
+
+# Compile the kernels first
+OperatorDistance(SpinEnsemble(1, ncomp, 1.5, freqs, amps).systems[0], t=1.0,
+                 target=target).value_and_grad(ctrl)
+
+report("Growing nz only", time_to_target(lambda fid: SciPyOptimizer(fid, ctrl, tol=1e-5), goal))
+report("nz continuation " + str(stages),
+       time_to_target(lambda fid: ContinuationOptimizer(fid, ctrl, stages, tol=1e-5), goal))
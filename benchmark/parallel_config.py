@@ -0,0 +1,44 @@
+import sys
+sys.path.append('..')
+from floq.systems.spins import SpinEnsemble
+from floq.optimization.fidelity import OperatorDistance
+from floq.parallel.config import tune
+from floq.parallel.worker import FidelityMaster
+from floq.parallel.threaded import ThreadedEnsembleFidelity
+import numpy as np
+
+
+def report(name, best, timings):
+    print "---- " + name
+    for config, time in timings:
+        print repr(config) + ": " + str(round(time, 3)) + " s per F+dF"
+    print "Best: " + repr(best)
+
+
+ncomp = 5
+n = 64
+freqs = 0.01*np.ones(n)-0.025+0.05*np.random.rand(n)
+amps = 1.0*np.ones(n)-0.025+0.05*np.random.rand(n)
+s = SpinEnsemble(n, ncomp, 1.5, freqs, amps)
+ctrl = 0.5*np.ones(2*ncomp)
+target = np.array([[-0.0720053 + 0.j, -0.705271 - 0.705271j],
+                   [0.705271 - 0.705271j, -0.0720053 + 0.j]])
+
+# Compile the kernels before any workers are forked
+OperatorDistance(s.systems[0], t=1.0, target=target).value_and_grad(ctrl)
+
+
+def master(config):
+    return FidelityMaster(config.workers, s, OperatorDistance, config=config,
+                          t=1.0, target=target)
+
+
+def threaded(config):
+    return ThreadedEnsembleFidelity(s, OperatorDistance, config=config, t=1.0, target=target)
+
+
+best, timings = tune(master, ctrl)
+report("Processes (FidelityMaster)", best, timings)
+
+best, timings = tune(threaded, ctrl)
+report("Threads (ThreadedEnsembleFidelity)", best, timings)
@@ -85,6 +85,30 @@ print time_f_and_df(fid, ctrl)
 print time_opt(opt)
 
 
+print "---- Persistent Pool Version"
+fid = ParallelEnsembleFidelity(s, OperatorDistance, persistent=True, t=1.0, target=target)
+opt = SciPyOptimizer(fid, ctrl, tol=0.01)
+
+print time_f(fid.f, ctrl)
+print time_df(fid.df, ctrl)
+print time_f_and_df(fid, ctrl)
+print time_opt(opt)
+fid.kill()
+
+
+print "---- Threaded Version"
+from floq.parallel.threaded import ThreadedEnsembleFidelity
+
+fid = ThreadedEnsembleFidelity(s, OperatorDistance, t=1.0, target=target)
+opt = SciPyOptimizer(fid, ctrl, tol=0.01)
+
+print time_f(fid.f, ctrl)
+print time_df(fid.df, ctrl)
+print time_f_and_df(fid, ctrl)
+print time_opt(opt)
+fid.kill()
+
+
 print "---- Legacy version"
 from museum_of_forks.p0.optimization.fidelity import EnsembleFidelity, OperatorDistance
 fid = EnsembleFidelity(s, OperatorDistance, t=1.0, target=target)
@@ -2,7 +2,7 @@ import sys
 sys.path.append('..')
 sys.path.append('museum_of_evolution')
 import numpy as np
-import floq.core.spin as spin
+import floq.systems.spins as spin
 import floq.core.fixed_system as fs
 import timeit
 
@@ -40,6 +40,13 @@ print time_u(ev.get_u, hf, params)
 print time_du(ev.get_u_and_du, hf, dhf, params)
 
 
+print "---- Factors for dU in python"
+import museum_of_evolution.p7.evolution as ev
+
+print time_u(ev.get_u, hf, params)
+print time_du(ev.get_u_and_du, hf, dhf, params)
+
+
 print "---- With degeneracy check"
 import museum_of_evolution.p6.evolution as ev
 
@@ -8,6 +8,7 @@ import floq.helpers.matrix as mm
 import floq.errors as errors
 import itertools
 import cmath
+from multiprocessing.pool import ThreadPool
 from numba import autojit
 
 
@@ -67,13 +68,58 @@ def get_u_and_eigensystem(hf, params):
     return [calculate_u(phi, psi, vals, params), vals, vecs, phi, psi]
 
 
-def get_du_from_eigensystem(dhf, psi, vals, vecs, params):
+def get_du_from_eigensystem(dhf, psi, vals, vecs, params, threads=1):
+    # dhf can hold the derivatives of Hf with respect to any set of
+    # parameters that enter Hf linearly, not only the controls:
+    # the number of parameters is inferred from its first index
+    if threads > 1 and dhf.shape[0] > 1:
+        return calculate_du_threaded(dhf, psi, vals, vecs, params, threads)
+
     dk = assemble_dk(dhf, params)
     du = calculate_du(dk, psi, vals, vecs, params)
 
     return du
 
 
+def get_d2u_from_eigensystem(dhf_a, dhf_b, psi, vals, vecs, params):
+    """
+    Calculate the mixed second derivatives d^2U/da_i db_j,
+    given the derivatives dhf_a and dhf_b of the Fourier transformed
+    Hamiltonian with respect to two sets of parameters a and b,
+    and the eigensystem of K.
+
+    Hf is assumed to be linear in a and b (as it is in the controls of most systems),
+    otherwise the contribution of its second derivative is missing.
+
+    Returns an array of shape (na, nb, dim, dim).
+    """
+    dk_a = assemble_dk(dhf_a, params)
+    dk_b = assemble_dk(dhf_b, params)
+
+    return calculate_d2u(dk_a, dk_b, psi, vals, vecs, params)
+
+
+def get_d2u_trace_from_eigensystem(dhf, dhf_v, w, psi, vals, vecs, params):
+    """
+    Calculate tr(w d^2U/dp_i dv) for all parameters p_i, given their derivatives dhf
+    of the Fourier transformed Hamiltonian, the derivative dhf_v in one direction v
+    (for instance the contraction of dhf with v), a (dim, dim) matrix w,
+    and the eigensystem of K.
+
+    This is what fidelities that are linear in U need for the product of
+    their Hessian with v. As w and v are contracted before the parameters
+    p_i enter, only (dim*nd)^2 sized blocks are held, rather than the
+    full second derivatives (see get_d2u_from_eigensystem).
+
+    Hf is assumed to be linear in p and v.
+
+    Returns an array of shape (np,).
+    """
+    dk_v = assemble_dk(dhf_v[np.newaxis], params)
+
+    return calculate_d2u_trace(dhf, dk_v[0], w, psi, vals, vecs, params)
+
+
 def get_udot_from_eigensystem(phi, psi, vals, vecs, params):
     """
     Calculate the time evolution operator U,
@@ -94,7 +140,7 @@ def assemble_k(hf, p):
     # the components of the Fourier-transformed Hamiltonian
     return numba_assemble_k(hf, p.dim, p.k_dim, p.nz, p.nc, p.omega)
 
-@autojit(nopython=True)
+@autojit(nopython=True, nogil=True)
 def numba_assemble_k(hf, dim, k_dim, nz, nc, omega):
     hf_max = (nc-1)/2
     k = numba_zeros((k_dim, k_dim))
@@ -136,9 +182,9 @@ def assemble_dk(dhf, p):
     # assemble the derivative of the Floquet Hamiltonian K from
     # the components of the derivative of the Fourier-transformed Hamiltonian
     # This is equivalent to K, with Hf -> d HF and omega -> 0.
-    return numba_assemble_dk(dhf, p.np, p.dim, p.k_dim, p.nz, p.nc)
+    return numba_assemble_dk(dhf, dhf.shape[0], p.dim, p.k_dim, p.nz, p.nc)
 
-@autojit(nopython=True)
+@autojit(nopython=True, nogil=True)
 def numba_assemble_dk(dhf, npm, dim, k_dim, nz, nc):
     dk = np.empty((npm, k_dim, k_dim), dtype=np.complex128)
     for c in range(npm):
@@ -254,7 +300,7 @@ def find_duplicates(array, decimals):
 
 
 
-@autojit(nopython=True)
+@autojit(nopython=True, nogil=True)
 def calculate_phi(vecs):
     # Given an array of eigenvectors vecs,
     # sum over Fourier components in each
@@ -264,7 +310,7 @@ def calculate_phi(vecs):
         phi[i] = numba_sum_components(vecs[i], dim)
     return phi
 
-@autojit(nopython=True)
+@autojit(nopython=True, nogil=True)
 def numba_sum_components(vec, dim):
     n = vec.shape[0]
     result = numba_zeros(dim)
@@ -282,7 +328,7 @@ def calculate_psi(vecs, p):
 
     return numba_calculate_psi(vecs, p.dim, p.nz, p.omega, p.t)
 
-@autojit(nopython=True)
+@autojit(nopython=True, nogil=True)
 def numba_calculate_psi(vecs, dim, nz, omega, t):
     psi = numba_zeros((dim, dim))
 
@@ -304,7 +350,7 @@ def calculate_psidot(vecs, p):
 
     return numba_calculate_psidot(vecs, p.dim, p.nz, p.omega, p.t)
 
-@autojit(nopython=True)
+@autojit(nopython=True, nogil=True)
 def numba_calculate_psidot(vecs, dim, nz, omega, t):
     psidot = numba_zeros((dim, dim))
 
@@ -351,7 +397,7 @@ def calculate_du(dk, psi, vals, vecs, p):
     dim = p.dim
     nz_max = p.nz_max
     nz = p.nz
-    npm = p.np
+    npm = dk.shape[0]
     omega = p.omega
     t = p.t
 
@@ -360,24 +406,57 @@ def calculate_du(dk, psi, vals, vecs, p):
     return assemble_du(nz, nz_max, dim, npm, factors, psi, vecsstar)
 
 
+def calculate_du_threaded(dhf, psi, vals, vecs, p, threads):
+    # The derivatives with respect to different parameters are independent,
+    # so the parameters are split across threads that share the eigensystem
+    # (the kernels release the GIL), each assembling only its slice of dK
+    slices = [s for s in np.array_split(np.arange(dhf.shape[0]), threads) if s.size]
+
+    def du_for_slice(indices):
+        dk = assemble_dk(dhf[indices], p)
+        return calculate_du(dk, psi, vals, vecs, p)
+
+    pool = ThreadPool(len(slices))
+    try:
+        dus = pool.map(du_for_slice, slices)
+    finally:
+        pool.close()
+
+    return np.concatenate(dus)
+
+
 def calculate_factors(dk, nz, nz_max, dim, npm, vals, vecs, vecsstar, omega, t):
     # Factors in the sum for dU that only depend on dn=n1-n2, and therefore
-    # can be computed more efficiently outside the "full" loop
-    factors = np.empty([npm, 2*nz+1, dim, dim], dtype=np.complex128)
+    # can be computed more efficiently outside the "full" loop.
+    #
+    # dk|v2> does not depend on dn, so it is computed once here, leaving
+    # only the (cyclically) shifted overlaps with <v1| to the kernel.
+    k_dim = nz*dim
+    dkvecs = np.dot(dk, vecs.reshape(dim, k_dim).T).reshape(npm, nz, dim, dim)
+    return numba_calculate_factors(dkvecs, nz, nz_max, dim, npm, vals, vecsstar, omega, t)
 
-    for dn in xrange(-nz_max*2, 2*nz_max+1):
+
+@autojit(nopython=True, nogil=True)
+def numba_calculate_factors(dkvecs, nz, nz_max, dim, npm, vals, vecsstar, omega, t):
+    factors = numba_zeros((npm, 2*nz+1, dim, dim))
+
+    for dn in range(-nz_max*2, 2*nz_max+1):
         idn = n_to_i(dn, 2*nz)
-        for i1 in xrange(0, dim):
-            for i2 in xrange(0, dim):
-                v1 = np.roll(vecsstar[i1], dn, axis=0)  # not supported by numba!
-                for c in xrange(0, npm):
-                    factors[c, idn, i1, i2] = (integral_factors(vals[i1], vals[i2], dn, omega, t) *
-                                               expectation_value(dk[c], v1, vecs[i2]))
+        for i1 in range(0, dim):
+            for i2 in range(0, dim):
+                integral = integral_factors(vals[i1], vals[i2], dn, omega, t)
+                for c in range(0, npm):
+                    overlap = 0.0j
+                    for n in range(0, nz):
+                        shifted = (n - dn) % nz
+                        for j in range(0, dim):
+                            overlap += vecsstar[i1, shifted, j]*dkvecs[c, n, j, i2]
+                    factors[c, idn, i1, i2] = integral*overlap
 
     return factors
 
 
-@autojit(nopython=True)
+@autojit(nopython=True, nogil=True)
 def assemble_du(nz, nz_max, dim, npm, alphas, psi, vecsstar):
     # Execute the sum defining dU, taking pre-computed factors into account
     du = numba_zeros((npm, dim, dim))
@@ -394,7 +473,7 @@ def assemble_du(nz, nz_max, dim, npm, alphas, psi, vecsstar):
     return du
 
 
-@autojit(nopython=True)
+@autojit(nopython=True, nogil=True)
 def integral_factors(e1, e2, dn, omega, t):
     if e1 == e2 and dn == 0:
         return -1.0j*cmath.exp(-1j*t*e1)*t
@@ -402,13 +481,208 @@ def integral_factors(e1, e2, dn, omega, t):
         return (cmath.exp(-1j*t*e1)-cmath.exp(-1j*t*(e2-omega*dn)))/((e1-e2+omega*dn))
 
 
-@autojit(nopython=True)
-def expectation_value(dk, v1, v2):
-    # Computes <v1|dk|v2>, assuming v1 is already conjugated
 
-    # v1 and v2 are split into Fourier components,
-    # we undo that here
-    a = v1.flatten()
-    b = v2.flatten()
+def calculate_d2u(dk_a, dk_b, psi, vals, vecs, p):
+    # Given the eigensystem of K, and its derivatives with respect
+    # to two sets of parameters, compute the mixed second derivatives of U.
+    #
+    # The second derivative of exp(-iKt) is (Daleckii-Krein)
+    #   sum_abc |a> (A_ac B_cb + B_ac A_cb) <b| f[l_a, l_c, l_b],
+    # with f[.,.,.] the second divided difference of exp(-i l t).
+    # The eigenvectors of K in other Brillouin zones are the ones we have,
+    # shifted by m zones (with l -> l + m omega). As for dU, the sum over the
+    # zone of |a> combines with the phases into psi, which leaves sums over the
+    # zone offsets d = m_c - m_a and e = m_b - m_a, and over the zone m_a itself,
+    # which only enters through the components of <b| that are summed up (in S).
+
+    dim = p.dim
+    nz = p.nz
+    nz_max = p.nz_max
+    nd = 4*nz_max+1
+
+    shifted = shift_vecs(vecs, nz_max).reshape(dim, nd, p.k_dim)
+    vecsstar = np.conj(vecs.reshape(dim, p.k_dim))
+
+    ma = shifted_expectation_values(dk_a, vecsstar, shifted)
+    mb = shifted_expectation_values(dk_b, vecsstar, shifted)
+
+    # offsets d (first axis) and e (second axis), and e-d for the second matrix element
+    offsets = np.arange(-2*nz_max, 2*nz_max+1)
+    d, e = offsets[:, np.newaxis], offsets[np.newaxis, :]
+    e_minus_d = e - d + 2*nz_max
+    outside = (e_minus_d < 0) | (e_minus_d >= nd)
+    e_minus_d = np.clip(e_minus_d, 0, nd-1)
+
+    ma_second = ma[..., e_minus_d]
+    mb_second = mb[..., e_minus_d]
+    ma_second[..., outside] = 0.0
+    mb_second[..., outside] = 0.0
+
+    # divided differences, indexed as [k_a, k_c, k_b, d, e]
+    x = vals[:, None, None, None, None]
+    y = vals[None, :, None, None, None] + p.omega*d[None, None, None, :, :]
+    z = vals[None, None, :, None, None] + p.omega*e[None, None, None, :, :]
+    factors = second_integral_factors(x, y, z, p.t)
+
+    coefficients = np.einsum('akcd,bcjde,kcjde->abkjde', ma, mb_second, factors) \
+        + np.einsum('bkcd,acjde,kcjde->abkjde', mb, ma_second, factors)
+
+    s = summed_components(vecs, d, e, nz_max)
+
+    partial = np.einsum('abkjde,jdey->abky', coefficients, s)
+    return np.einsum('kx,abky->abxy', psi, partial)
+
+
+def calculate_d2u_trace(dhf, dk_v, w, psi, vals, vecs, p):
+    # The contraction of calculate_d2u with w (over the matrix indices of U),
+    # for a single direction dk_v. With
+    #   Q[k, j, d, e] = sum_xy psi[k, x] w[y, x] S[j, d, e, y],
+    # the coefficients of calculate_d2u only enter as sum_kjde coefficients*Q,
+    # which is accumulated one eigenvector k (of the first matrix element) at a time,
+    # so that the largest arrays are (dim*nd)^2 blocks.
+    # The parameters p_i only enter through their matrix elements, which are
+    # linear in dK_i: the accumulated sums are mapped back onto a single
+    # (k_dim, k_dim) matrix X, and the trace for p_i is then sum(dK_i * X).
+
+    dim = p.dim
+    nz_max = p.nz_max
+    nd = 4*nz_max+1
+
+    shifted = shift_vecs(vecs, nz_max).reshape(dim, nd, p.k_dim)
+    vecsstar = np.conj(vecs.reshape(dim, p.k_dim))
+
+    mv = shifted_expectation_values(dk_v[np.newaxis], vecsstar, shifted)[0]
+
+    offsets = np.arange(-2*nz_max, 2*nz_max+1)
+    d, e = offsets[:, np.newaxis], offsets[np.newaxis, :]
+    e_minus_d = e - d + 2*nz_max
+    inside = (e_minus_d >= 0) & (e_minus_d < nd)
+    e_minus_d = np.clip(e_minus_d, 0, nd-1)
+
+    mv_second = mv[..., e_minus_d]
+    mv_second[..., ~inside] = 0.0
+
+    q = np.einsum('ky,jdey->kjde', np.dot(psi, w.T), summed_components(vecs, d, e, nz_max))
+
+    # The points y (of k_c and d) and z (of k_b and e) lie on the same grid,
+    # the first divided differences between them are only needed once
+    grid = vals[:, np.newaxis] + p.omega*offsets[np.newaxis, :]
+    y = grid[:, np.newaxis, :, np.newaxis]
+    z = grid[np.newaxis, :, np.newaxis, :]
+    fyz = divided_differences(y, z, p.t)
+
+    first = np.zeros((dim, dim, nd), dtype=np.complex128)  # [k, c, d]
+    second = np.zeros((dim, dim, nd, nd), dtype=np.complex128)  # [c, j, d, e]
+    for k in xrange(dim):
+        fx = divided_differences(vals[k], grid, p.t)
+        factors = second_integral_factors_from_first(vals[k], y, z, fx[:, np.newaxis, :, np.newaxis],
+                                                     fx[np.newaxis, :, np.newaxis, :], fyz, p.t)
+        weighted = factors*q[k][np.newaxis]
+
+        first[k] = np.einsum('cjde,cjde->cd', mv_second, weighted)
+        second += mv[k][:, np.newaxis, :, np.newaxis]*weighted
+
+    # Fold the second term onto e-d, the offset of its matrix element
+    for i_d in xrange(nd):
+        first[:, :, e_minus_d[i_d, inside[i_d]]] += second[:, :, i_d, inside[i_d]]
+
+    # sum_kjd first[k, j, d] <v_k|dK|v_j shifted by d> = sum(dK * x)
+    x = np.dot(vecsstar.T, np.dot(first.reshape(dim, dim*nd), shifted.reshape(dim*nd, p.k_dim)))
+
+    traces = np.zeros(dhf.shape[0], dtype=np.complex128)
+    for i in xrange(dhf.shape[0]):
+        # One parameter at a time, so that only a single dK is assembled
+        traces[i] = np.sum(assemble_dk(dhf[i:i+1], p)[0]*x)
+
+    return traces
+
+
+def shift_vecs(vecs, nz_max):
+    # Shift the eigenvectors by -2*nz_max...2*nz_max Brillouin zones,
+    # dropping the components that leave the truncated space
+    dim, nz = vecs.shape[0], vecs.shape[1]
+    nd = 4*nz_max+1
+    shifted = np.zeros((dim, nd, nz, dim), dtype=np.complex128)
+
+    for i in xrange(nd):
+        d = i - 2*nz_max
+        if d >= 0:
+            shifted[:, i, d:] = vecs[:, :nz-d]
+        else:
+            shifted[:, i, :nz+d] = vecs[:, -d:]
+
+    return shifted
+
+
+def shifted_expectation_values(dk, vecsstar, shifted):
+    # Compute <v_k1|dk[c]|v_k2 shifted by d>, indexed as [c, k1, k2, d],
+    # given the conjugated and flattened vectors vecsstar
+    applied = np.tensordot(dk, shifted, axes=([2], [2]))  # [c, x, k2, d]
+    return np.einsum('kx,cxjd->ckjd', vecsstar, applied)
+
+
+def summed_components(vecs, d, e, nz_max):
+    # For each pair of offsets d and e, sum the conjugated components
+    # of the eigenvectors over all zones m for which m, m+d and m+e
+    # lie in the truncated space; the component of zone m+e enters.
+    # Returned as [k, d, e, component].
+    vecsstar = np.conj(vecs)
+    dim, nz = vecs.shape[0], vecs.shape[1]
+
+    cumulative = np.zeros((dim, nz+1, dim), dtype=np.complex128)
+    cumulative[:, 1:] = np.cumsum(vecsstar, axis=1)
+
+    lo = np.maximum(-nz_max, np.maximum(-nz_max-d, -nz_max-e))
+    hi = np.minimum(nz_max, np.minimum(nz_max-d, nz_max-e))
+
+    # zone m+e sits at index nz_max-(m+e) (see assemble_du)
+    first = np.clip(nz_max-hi-e, 0, nz)
+    last = np.clip(nz_max-lo-e+1, 0, nz)
+    empty = hi < lo
+
+    summed = cumulative[:, last] - cumulative[:, first]
+    summed[:, empty] = 0.0
+
+    return summed
+
+
+def divided_differences(x, y, t):
+    # First divided difference of exp(-i l t) at x and y,
+    # written in a form that is stable when x and y (nearly) coincide
+    mean = 0.5*(x+y)
+    half = 0.5*(x-y)
+    return -1j*t*np.exp(-1j*t*mean)*np.sinc(t*half/np.pi)
+
+
+def second_integral_factors_from_first(x, y, z, fxy, fxz, fyz, t, tolerance=1e-7):
+    # Second divided difference of exp(-i l t) at x, y and z, given the first ones
+    # between each pair of points. As in second_integral_factors, the difference
+    # of the two first divided differences that share the middle point is divided
+    # by the largest distance, which leaves only arithmetic to be done here.
+    dxy, dxz, dyz = x - y, x - z, y - z
+    adxy, adxz, adyz = np.abs(dxy), np.abs(dxz), np.abs(dyz)
+
+    use_xz = (adxz >= adxy) & (adxz >= adyz)
+    use_xy = ~use_xz & (adxy >= adyz)
+    numerator = np.where(use_xz, fxy - fyz, np.where(use_xy, fxz - fyz, fxy - fxz))
+    spread = np.where(use_xz, dxz, np.where(use_xy, dxy, dyz))
+
+    degenerate = np.abs(spread) < tolerance
+    spread = np.where(degenerate, 1.0, spread)
+    return np.where(degenerate, -0.5*t**2*np.exp(-1j*t*x), numerator/spread)
+
+
+def second_integral_factors(x, y, z, t, tolerance=1e-7):
+    # Second divided difference of exp(-i l t) at x, y and z.
+    # It is symmetric in its arguments, so the points are sorted
+    # in order to divide by the largest distance.
+    x, y, z = np.broadcast_arrays(x, y, z)
+    points = np.sort(np.array([x, y, z]), axis=0)
+    lo, mid, hi = points[0], points[1], points[2]
+
+    spread = hi - lo
+    degenerate = spread < tolerance
+    spread = np.where(degenerate, 1.0, spread)
 
-    return np.dot(np.dot(a, dk), b)
+    factors = (divided_differences(mid, hi, t) - divided_differences(lo, mid, t))/spread
+    return np.where(degenerate, -0.5*t**2*np.exp(-1j*t*mid), factors)
@@ -85,6 +85,118 @@ def d_operator_distance(u, dus, target):
 
 
 
+def hessp_operator_distance(u, traces):
+    """
+    Calculate the product of the Hessian of the operator distance with a vector v
+    of the controls, given traces[c] = tr(target^dagger d/dc (du.v)),
+    the second derivatives of u contracted with v and traced with
+    the weight operator_trace_weight(target).
+    """
+    dim = u.shape[0]
+    return -np.real(traces)/dim
+
+
+
+def operator_trace_weight(target):
+    """ The matrix w with tr(w u) = tr(target^dagger u) """
+    return np.conj(target).T
+
+
+
+def operator_sensitivity(dus):
+    """
+    Given the derivatives dus of u with respect to a set of
+    uncertain parameters p_j, compute ||du_j||^2/dim (Frobenius norm) for each.
+
+    At u = target, this is the curvature of the operator distance
+    in p_j, i.e. the leading contribution of the scatter of p_j
+    to the average operator distance over an ensemble.
+    """
+    dim = dus.shape[-1]
+    return np.sum(np.abs(dus)**2, axis=(-2, -1))/dim
+
+
+def d_operator_sensitivity(dus, ddus):
+    """
+    Calculate the gradient of the operator sensitivities with respect to the controls,
+    given the mixed second derivatives ddus[j, c] = d^2u/dp_j dc.
+    """
+    dim = dus.shape[-1]
+    return 2.0*np.real(np.einsum('jxy,jcxy->jc', np.conj(dus), ddus))/dim
+
+
+def operator_curvature(u, d2us, target):
+    """
+    Calculate the curvature of the operator distance with respect to
+    a set of parameters p_j, given the second derivatives d2us[j] = d^2u/dp_j^2.
+    """
+    return -np.array([operator_fidelity(d2u, target) for d2u in d2us])
+
+
+
+def hessp_transfer_distance(u, dus, du_v, traces, initial, final):
+    """
+    Calculate the product of the Hessian of the transfer distance with a vector v
+    of the controls, given the gradient dus of u, its derivative du_v = du.v
+    in the direction v, and traces[c] = <f|d/dc (du.v)|i>, the second derivatives
+    traced with the weight transfer_trace_weight(initial, final):
+    -2 Re(<f|du_c|i> <i|du_v^dagger|f> + traces[c] <i|u^dagger|f>).
+    """
+    fui = expectation_value(final, u, initial)
+    fdui = expectation_value(final, du_v, initial)
+    first = np.array([expectation_value(final, du, initial) for du in dus])
+
+    return -2.0*np.real(first*np.conj(fdui) + traces*np.conj(fui))
+
+
+
+def transfer_trace_weight(initial, final):
+    """ The matrix w with tr(w u) = <final|u|initial> """
+    return np.outer(initial, np.conj(final))
+
+
+
+def transfer_sensitivity(dus, initial, final):
+    """
+    Given the derivatives dus of u with respect to a set of
+    uncertain parameters p_j, compute 2(||du_j|i>||^2 - |<f|du_j|i>|^2) for each.
+
+    If u transfers |i> to |f> perfectly, this is the curvature of the
+    transfer distance in p_j (see operator_sensitivity).
+    """
+    states = np.dot(dus, initial)
+    overlaps = np.dot(states, np.conj(final))
+    return 2.0*(np.sum(np.abs(states)**2, axis=-1) - np.abs(overlaps)**2)
+
+
+def d_transfer_sensitivity(dus, ddus, initial, final):
+    """
+    Calculate the gradient of the transfer sensitivities with respect to the controls,
+    given the mixed second derivatives ddus[j, c] = d^2u/dp_j dc.
+    """
+    states = np.dot(dus, initial)
+    dstates = np.dot(ddus, initial)
+    overlaps = np.dot(states, np.conj(final))
+    doverlaps = np.dot(dstates, np.conj(final))
+
+    return 4.0*(np.real(np.einsum('jx,jcx->jc', np.conj(states), dstates))
+                - np.real(np.conj(overlaps)[:, np.newaxis]*doverlaps))
+
+
+def transfer_curvature(u, dus, d2us, initial, final):
+    """
+    Calculate the curvature of the transfer distance with respect to
+    a set of parameters p_j, given the first and second derivatives of u,
+    dus[j] = du/dp_j and d2us[j] = d^2u/dp_j^2.
+    """
+    fui = expectation_value(final, u, initial)
+    first = np.array([expectation_value(final, du, initial) for du in dus])
+    second = np.array([expectation_value(final, d2u, initial) for d2u in d2us])
+
+    return -2.0*(np.abs(first)**2 + np.real(np.conj(fui)*second))
+
+
+
 def expectation_value(left, operator, right):
     """ Compute <left | operator | right> """
     leftconj = np.transpose(np.conj(left))
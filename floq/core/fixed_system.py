@@ -20,6 +20,10 @@ class FixedSystem(object):
     Methods
         u: computes u / returns already computed u
         du: computes du / returns already computed du
+        du_for(dhf): computes the derivative of u with respect to other
+                     parameters, given the derivative of hf
+        d2u_for(dhf_a, dhf_b): computes mixed second derivatives of u
+        at_time(t): the same system at another time t, sharing the eigensystem of K
 
     Attributes:
         hf: the Fourier transformed Hamiltonian (ndarray, square)
@@ -29,12 +33,17 @@ class FixedSystem(object):
         decimals: number of decimals used internally for detecting degeneracies
         sparse: if yes, sparse matrix computations are performed
         max_nz: maximum nz
+        threads: number of threads the parameters are split across when computing du
+        fixed_nz: if True, nz is not increased, and U is accepted even if it is not unitary
     """
 
-    def __init__(self, hf, dhf, nz, omega, t, decimals=10, sparse=True, max_nz=999):
+    def __init__(self, hf, dhf, nz, omega, t, decimals=10, sparse=True, max_nz=999, threads=1,
+                 fixed_nz=False):
         self.hf = hf
         self.dhf = dhf
         self.max_nz = max_nz
+        self.threads = threads
+        self.fixed_nz = fixed_nz
 
         # Inferred parameters
         dim = hf.shape[1]
@@ -46,6 +55,7 @@ class FixedSystem(object):
         self._u = None
         self._udot = None
         self._du = None
+        self._du_parameters = None  # kept by ParametricSystemBase.du_parameters
         self._vals, self._vecs, self._phi, self._psi = None, None, None, None
 
     def __eq__(self, other):
@@ -86,6 +96,11 @@ class FixedSystem(object):
     def _compute_u(self):
         # Increase nz until U can be computed,
         # then set U and the intermediary results
+        if self.fixed_nz:
+            self._u, self._vals, self._vecs, self._phi, self._psi = \
+                ev.get_u_and_eigensystem(self.hf, self.params)
+            return
+
         [nz_okay, results] = self._test_nz()
         while nz_okay is False:
             self.params.nz += 2
@@ -120,7 +135,65 @@ class FixedSystem(object):
         if self._u is None:
             self._compute_u()
         self._du = ev.get_du_from_eigensystem(self.dhf, self._psi,
-                                              self._vals, self._vecs, self.params)
+                                              self._vals, self._vecs, self.params,
+                                              threads=self.threads)
+
+
+    def du_for(self, dhf):
+        """
+        Compute the derivative of U with respect to parameters
+        that enter hf linearly, given the derivative dhf of hf
+        (with the first index running over the parameters).
+        """
+        if self._u is None:
+            self._compute_u()
+        return ev.get_du_from_eigensystem(dhf, self._psi, self._vals, self._vecs, self.params,
+                                          threads=self.threads)
+
+
+    def at_time(self, t):
+        """
+        Return a FixedSystem for the same hf and dhf at time t.
+        The eigensystem of K does not depend on t, so if it has been computed
+        here, only psi and U are recomputed -- unless U turns out not to be
+        unitary at t, in which case nz is grown from scratch as usual.
+        """
+        p = self.params
+        other = FixedSystem(self.hf, self.dhf, p.nz, p.omega, t, decimals=p.decimals,
+                            max_nz=self.max_nz, threads=self.threads, fixed_nz=self.fixed_nz)
+        if self._u is None:
+            return other
+
+        psi = ev.calculate_psi(self._vecs, other.params)
+        u = ev.calculate_u(self._phi, psi, self._vals, other.params)
+        if self.fixed_nz or is_unitary(u, tolerance=10**-p.decimals):
+            other._u, other._vals, other._vecs, other._phi, other._psi = \
+                u, self._vals, self._vecs, self._phi, psi
+        return other
+
+
+    def d2u_for(self, dhf_a, dhf_b):
+        """
+        Compute the mixed second derivatives of U with respect to
+        two sets of parameters that enter hf linearly,
+        given the derivatives of hf dhf_a and dhf_b.
+        """
+        if self._u is None:
+            self._compute_u()
+        return ev.get_d2u_from_eigensystem(dhf_a, dhf_b, self._psi, self._vals,
+                                           self._vecs, self.params)
+
+
+    def d2u_trace_for(self, dhf, dhf_v, w):
+        """
+        Compute tr(w d^2U/dp_i dv) for parameters p_i and a single direction v
+        that enter hf linearly, given the derivatives of hf dhf and dhf_v,
+        without forming the second derivatives themselves.
+        """
+        if self._u is None:
+            self._compute_u()
+        return ev.get_d2u_trace_from_eigensystem(dhf, dhf_v, w, self._psi, self._vals,
+                                                 self._vecs, self.params)
 
 
 class DummyFixedSystem(FixedSystem):
@@ -17,3 +17,40 @@ class NZTooLargeError(Exception):
     """Thrown when NZ gets too large"""
 
     pass
+
+
+class WorkerError(Exception):
+    """Thrown when a worker process fails"""
+
+    def __init__(self, worker):
+        self.worker = worker
+
+
+class WorkerDiedError(WorkerError):
+    """Thrown when a worker process has died"""
+
+    def __init__(self, worker, exitcode):
+        self.worker, self.exitcode = worker, exitcode
+
+    def __str__(self):
+        return "Worker " + str(self.worker) + " died with exit code " + str(self.exitcode)
+
+
+class WorkerTimeoutError(WorkerError):
+    """Thrown when a worker spends too long on a single member"""
+
+    def __init__(self, worker, timeout):
+        self.worker, self.timeout = worker, timeout
+
+    def __str__(self):
+        return "Worker " + str(self.worker) + " timed out after " + str(self.timeout) + " s"
+
+
+class RemoteError(WorkerError):
+    """Thrown when a computation raised an exception inside a worker"""
+
+    def __init__(self, worker, remote_traceback):
+        self.worker, self.remote_traceback = worker, remote_traceback
+
+    def __str__(self):
+        return "Exception in worker " + str(self.worker) + ":\n" + self.remote_traceback
@@ -2,14 +2,14 @@ import numpy as np
 from numba import autojit
 
 
-@autojit(nopython=True)
+@autojit(nopython=True, nogil=True)
 def numba_zeros(dims):
     ary = np.empty(dims, dtype=np.complex128)
     ary[:] = 0.0+0.0j
     return ary
 
 
-@autojit(nopython=True)
+@autojit(nopython=True, nogil=True)
 def numba_outer(a, b):
     m = a.shape[0]
     n = b.shape[0]
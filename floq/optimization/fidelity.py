@@ -1,8 +1,16 @@
 # Provide templates and implementations for FidelityComputer class,
 # which wraps a ParametricSystem and computes F and dF for given controls
 import logging
+import json
+import time
 from floq.core.fidelities import d_operator_distance, operator_distance
 from floq.core.fidelities import transfer_distance, d_transfer_distance
+from floq.core.fidelities import hessp_operator_distance, hessp_transfer_distance
+from floq.core.fidelities import operator_trace_weight, transfer_trace_weight
+from floq.core.fidelities import operator_sensitivity, d_operator_sensitivity, operator_curvature
+from floq.core.fidelities import transfer_sensitivity, d_transfer_sensitivity, transfer_curvature
+from floq.systems.parametric_system import control_mask
+import floq.errors as er
 import numpy as np
 
 
@@ -13,6 +21,11 @@ class FidelityBase(object):
     common functionality, such as counting iterations or handling optional
     penalty terms not arising directly from the fidelity.
 
+    The results of the most recent evaluation are remembered, so that asking
+    for f and df (or iterating) at the same controls does not trigger
+    a second computation. If a fidelity is changed in a way that affects
+    its value, forget() should be called.
+
     Sub-classes should implement:
         _f(controls_and_t)
         _df(controls_and_t).
@@ -20,7 +33,14 @@ class FidelityBase(object):
     Sub-classes can optionally implement:
         penalty(controls_and_t)
         d_penalty(controls_and_t),
-        _iterate(controls_and_t), which gets called on each iteration.
+        _hessp(controls_and_t, v), the product of the Hessian of _f with v
+                                   (by default a finite difference of _df),
+        hessp_penalty(controls_and_t, v), the same for the penalty,
+        _iterate(controls_and_t), which gets called on each iteration,
+        _value_and_grad(controls_and_t), computing _f and _df in one pass,
+        _f_batch(controls), _df_batch(controls), computing _f and _df for each row
+                                                 of a matrix of controls,
+        _value_and_grad_batch(controls), computing both for each row in one pass.
 
     The __init__ should take the form __init__(self, system, **kwargs)
     for compatibility with EnsembleFidelity.
@@ -28,41 +48,179 @@ class FidelityBase(object):
     Methods:
         f(controls_and_t): returns a real number, the fidelity,
         df(controls_and_t): returns its gradient,
+        value_and_grad(controls_and_t): returns both,
+        hessp(controls_and_t, v): returns the product of the Hessian of f with v,
+        f_batch(controls): returns an array of f for each row of controls,
+        df_batch(controls): returns an array of df for each row of controls,
+        value_and_grad_batch(controls): returns both,
         iterate(controls_and_t): expected to be called after each iteration by
-                                 an Optimizer.
+                                 an Optimizer,
+        forget(): discard the remembered results of the last evaluation,
+        set_mask(mask): only compute (and return) the components of df for the
+                        controls in mask (indices, or booleans over the controls),
+                        None for all of them,
+        cache_state(eigensystems): returns the state of the caches of the system(s)
+                                   (their truncation, and optionally the last eigensystems),
+        restore_cache(state): restores it, for instance when resuming an optimization.
 
     Attributes:
         system: the system (or ensemble) under consideration.
         iterations: count of iterations
+        evaluations: count of evaluations (of f, df or both) that were actually computed
+        progress: None, or a file-like object, to which one line of JSON
+                  (iteration, f, df_norm, time, evaluations) is written per iteration
+        mask: the indices of the controls df is computed for (None for all), see set_mask
     """
 
     def __init__(self, system):
         self.system = system
         self.iterations = 0
+        self.evaluations = 0
+        self.progress = None
+        self.mask = None
+
+        self._start = time.time()
+        self.forget()
 
 
     def f(self, controls_and_t):
-        return self._f(controls_and_t) + self.penalty(controls_and_t)
+        if self._last_f is not None and self._is_last(controls_and_t):
+            return self._last_f
+
+        f = self._f(controls_and_t) + self.penalty(controls_and_t)
+        self._remember(controls_and_t, f, None)
+        return f
 
 
     def df(self, controls_and_t):
-        return self._df(controls_and_t) + self.d_penalty(controls_and_t)
+        if self._last_df is not None and self._is_last(controls_and_t):
+            return self._last_df
+
+        df = self._df(controls_and_t) + self.d_penalty(controls_and_t)
+        self._remember(controls_and_t, None, df)
+        return df
+
+
+    def value_and_grad(self, controls_and_t):
+        if self._last_f is not None and self._last_df is not None \
+           and self._is_last(controls_and_t):
+            return self._last_f, self._last_df
+
+        f, df = self._value_and_grad(controls_and_t)
+        f = f + self.penalty(controls_and_t)
+        df = df + self.d_penalty(controls_and_t)
+        self._remember(controls_and_t, f, df)
+        return f, df
+
+
+    def hessp(self, controls_and_t, v):
+        """
+        The product of the Hessian of f (including the penalty) with the vector v.
+        It is not remembered, and does not count as an evaluation.
+        """
+        return self._hessp(controls_and_t, v) + self.hessp_penalty(controls_and_t, v)
+
+
+    def f_batch(self, controls):
+        controls = np.atleast_2d(controls)
+        self.evaluations += controls.shape[0]
+        return self._f_batch(controls) + np.array([self.penalty(c) for c in controls])
+
+
+    def df_batch(self, controls):
+        controls = np.atleast_2d(controls)
+        self.evaluations += controls.shape[0]
+        dfs = self._df_batch(controls)
+        return dfs + np.array([self.d_penalty(c)*np.ones(dfs.shape[1]) for c in controls])
+
+
+    def value_and_grad_batch(self, controls):
+        controls = np.atleast_2d(controls)
+        self.evaluations += controls.shape[0]
+        fs, dfs = self._value_and_grad_batch(controls)
+        fs = fs + np.array([self.penalty(c) for c in controls])
+        dfs = dfs + np.array([self.d_penalty(c)*np.ones(dfs.shape[1]) for c in controls])
+        return fs, dfs
 
 
     def iterate(self, controls_and_t):
         """
         Gets called by the Optimizer after each iteration. Increases
-        the iteration count self.iterations, and calls the (optional)
-        _iterate method.
+        the iteration count self.iterations, calls the (optional)
+        _iterate method, and reports to self.progress.
         """
         self.iterations += 1
         self._iterate(controls_and_t)
-        f = self.f(controls_and_t)
-        logging.info('Currently at iteration %i and f=%f' % (self.iterations, f))
+
+        if self.progress is not None:
+            self._report(controls_and_t)
 
 
     def reset_iterations(self):
         self.iterations = 0
+        self.evaluations = 0
+        self._start = time.time()
+
+
+    def forget(self):
+        self._last_controls = None
+        self._last_f = None
+        self._last_df = None
+
+
+    def set_mask(self, mask):
+        """
+        Only compute the derivatives with respect to the controls in mask.
+        The mask is set on the system(s) through restore_cache, so it reaches
+        the workers of parallel fidelities as well.
+        """
+        self.mask = control_mask(mask)
+        state = self.cache_state()
+        for member_state in (state if isinstance(state, list) else [state]):
+            member_state['mask'] = self.mask
+        self.restore_cache(state)
+
+
+    def cache_state(self, eigensystems=False):
+        return self.system.cache_state(eigensystems)
+
+
+    def restore_cache(self, state):
+        self.system.restore_cache(state)
+        self.forget()
+
+
+    def _is_last(self, controls_and_t):
+        return self._last_controls is not None \
+            and np.array_equal(self._last_controls, controls_and_t)
+
+
+    def _remember(self, controls_and_t, f, df):
+        # Store the results of an evaluation, keeping the other one
+        # of f and df if it was computed for the same controls
+        self.evaluations += 1
+
+        if self._is_last(controls_and_t):
+            self._last_f = f if f is not None else self._last_f
+            self._last_df = df if df is not None else self._last_df
+        else:
+            self._last_controls = np.copy(controls_and_t)
+            self._last_f = f
+            self._last_df = df
+
+
+    def _report(self, controls_and_t):
+        # Write one line of JSON to self.progress, using the
+        # remembered gradient if it is available
+        f = self.f(controls_and_t)
+        if self._last_df is not None:
+            df_norm = float(np.linalg.norm(self._last_df))
+        else:
+            df_norm = None
+
+        record = {'iteration': self.iterations, 'f': float(f), 'df_norm': df_norm,
+                  'time': time.time()-self._start, 'evaluations': self.evaluations}
+        self.progress.write(json.dumps(record) + '\n')
 
 
     def _f(self, controls_and_t):
@@ -73,6 +231,28 @@ class FidelityBase(object):
         raise NotImplementedError
 
 
+    def _value_and_grad(self, controls_and_t):
+        return self._f(controls_and_t), self._df(controls_and_t)
+
+
+    def _hessp(self, controls_and_t, v):
+        # Central difference of the gradient along v, two gradients per product
+        return central_difference(self._df, controls_and_t, v)
+
+
+    def _f_batch(self, controls):
+        return np.array([self._f(c) for c in controls])
+
+
+    def _df_batch(self, controls):
+        return np.array([self._df(c) for c in controls])
+
+
+    def _value_and_grad_batch(self, controls):
+        fs, dfs = zip(*[self._value_and_grad(c) for c in controls])
+        return np.array(fs), np.array(dfs)
+
+
     def _iterate(self, controls_and_t):
         pass
 
@@ -85,32 +265,265 @@ class FidelityBase(object):
         return 0.0
 
 
+    def hessp_penalty(self, controls_and_t, v):
+        return 0.0
+
+
 
 class EnsembleFidelity(FidelityBase):
     """
     With a given Ensemble, and a FidelityComputer,
-    calculate the average fidelity over the whole ensemble.
+    calculate the average fidelity over the whole ensemble,
+    weighted with ensemble.weights.
     """
 
     def __init__(self, ensemble, fidelity, **params):
         super(EnsembleFidelity, self).__init__(ensemble)
         self.fidelities = [fidelity(sys, **params) for sys in ensemble.systems]
+        self.weights = np.asarray(ensemble.weights)
 
     def _f(self, controls_and_t):
-        f = np.mean([fid.f(controls_and_t) for fid in self.fidelities])
+        f = np.dot(self.weights, [fid.f(controls_and_t) for fid in self.fidelities])
         return f
 
 
     def _df(self, controls_and_t):
-        df = np.mean([fid.df(controls_and_t) for fid in self.fidelities], axis=0)
+        df = np.dot(self.weights, [fid.df(controls_and_t) for fid in self.fidelities])
         return df
 
 
+    def _value_and_grad(self, controls_and_t):
+        fs, dfs = zip(*[fid.value_and_grad(controls_and_t) for fid in self.fidelities])
+        return np.dot(self.weights, fs), np.dot(self.weights, dfs)
+
+
+    def _hessp(self, controls_and_t, v):
+        return np.dot(self.weights, [fid.hessp(controls_and_t, v) for fid in self.fidelities])
+
+
+    def _f_batch(self, controls):
+        return np.dot(self.weights, members_f_batch(self.fidelities, controls))
+
+
+    def _df_batch(self, controls):
+        return np.tensordot(self.weights, members_df_batch(self.fidelities, controls), axes=1)
+
+
+    def _value_and_grad_batch(self, controls):
+        fs, dfs = members_value_and_grad_batch(self.fidelities, controls)
+        return np.dot(self.weights, fs), np.tensordot(self.weights, dfs, axes=1)
+
+
+    def cache_state(self, eigensystems=False):
+        return [fid.cache_state(eigensystems) for fid in self.fidelities]
+
+
+    def restore_cache(self, state):
+        for fid, member_state in zip(self.fidelities, state):
+            fid.restore_cache(member_state)
+        self.forget()
+
+
+
+class AdaptiveEnsembleFidelity(EnsembleFidelity):
+    """
+    With a given Ensemble, and a FidelityComputer,
+    calculate the average fidelity over a growing subset of the ensemble.
+
+    The members are visited in refinement_order, so that the first few
+    form a coarse sample of the ensemble, and the fidelity is initially
+    averaged over the first `initial` of them. After each iteration, the
+    active subset is enlarged by a factor of `growth` if either
+        - f has improved by less than a fraction `stall` during the
+          last `patience` iterations, or
+        - the estimated sampling error of the average (the standard error
+          over the active members) exceeds the remaining distance f.
+
+    All members are set up at once, so members that are already active
+    keep their systems -- and the cached eigensystems and nz -- when the
+    subset grows.
+
+    Note that each growth step changes the objective, which the optimizer
+    does not know about (BFGS will keep its Hessian approximation, for instance).
+    """
+
+    def __init__(self, ensemble, fidelity, initial=4, growth=2.0, stall=1e-3,
+                 patience=3, **params):
+        super(AdaptiveEnsembleFidelity, self).__init__(ensemble, fidelity, **params)
+        self.order = refinement_order(len(self.fidelities))
+        self.growth = growth
+        self.stall = stall
+        self.patience = patience
+
+        self.n_active = min(initial, len(self.fidelities))
+        self._best_f = None
+        self._stalled = 0
+
+
+    @property
+    def active(self):
+        return [self.fidelities[i] for i in self.order[:self.n_active]]
+
+
+    @property
+    def active_weights(self):
+        w = self.weights[self.order[:self.n_active]]
+        return w/np.sum(w)
+
+
+    @property
+    def complete(self):
+        return self.n_active == len(self.fidelities)
+
+
+    def grow(self):
+        """ Enlarge the active subset by a factor of self.growth """
+        n = len(self.fidelities)
+        self.n_active = min(n, max(self.n_active+1, int(np.ceil(self.n_active*self.growth))))
+        self._best_f = None
+        self._stalled = 0
+        self.forget()
+        logging.info('Growing ensemble to %i of %i members' % (self.n_active, n))
+
+
+    def _f(self, controls_and_t):
+        return np.dot(self.active_weights, [fid.f(controls_and_t) for fid in self.active])
+
+
+    def _df(self, controls_and_t):
+        return np.dot(self.active_weights, [fid.df(controls_and_t) for fid in self.active])
+
+
+    def _value_and_grad(self, controls_and_t):
+        fs, dfs = zip(*[fid.value_and_grad(controls_and_t) for fid in self.active])
+        return np.dot(self.active_weights, fs), np.dot(self.active_weights, dfs)
+
+
+    def _hessp(self, controls_and_t, v):
+        return np.dot(self.active_weights, [fid.hessp(controls_and_t, v) for fid in self.active])
+
+
+    def _f_batch(self, controls):
+        return np.dot(self.active_weights, members_f_batch(self.active, controls))
+
+
+    def _df_batch(self, controls):
+        return np.tensordot(self.active_weights, members_df_batch(self.active, controls), axes=1)
+
+
+    def _value_and_grad_batch(self, controls):
+        fs, dfs = members_value_and_grad_batch(self.active, controls)
+        return np.dot(self.active_weights, fs), np.tensordot(self.active_weights, dfs, axes=1)
+
+
+    def _iterate(self, controls_and_t):
+        if self.complete:
+            return
+
+        fs = np.array([fid.f(controls_and_t) for fid in self.active])
+        f = np.dot(self.active_weights, fs)
+
+        if self._best_f is None or f < self._best_f*(1.0-self.stall):
+            self._best_f = f
+            self._stalled = 0
+        else:
+            self._stalled += 1
+
+        error = np.std(fs, ddof=1)/np.sqrt(fs.size) if fs.size > 1 else np.inf
+
+        if self._stalled >= self.patience or error > f:
+            self.grow()
+
+
+
+class MinimaxEnsembleFidelity(EnsembleFidelity):
+    """
+    With a given Ensemble, and a FidelityComputer,
+    calculate a smooth approximation of the worst fidelity in the ensemble,
+    the soft-max
+        F = 1/sharpness log(sum_i w_i exp(sharpness f_i)),
+    which approaches max_i f_i as the sharpness grows.
+
+    Its gradient is sum_i p_i df_i, with the soft-max weights
+    p_i = w_i exp(sharpness f_i)/sum_j w_j exp(sharpness f_j).
+    Since these are concentrated on the few worst members, df_i is only
+    computed for members with p_i >= cutoff (always including the largest p_i),
+    and the others are dropped, renormalising the weights of the kept ones.
+    This introduces an error of at most 2 (sum of the dropped p_i) * max |df_i|.
+    """
+
+    def __init__(self, ensemble, fidelity, sharpness=50.0, cutoff=1e-3, **params):
+        super(MinimaxEnsembleFidelity, self).__init__(ensemble, fidelity, **params)
+        self.sharpness = sharpness
+        self.cutoff = cutoff
+        self.skipped = 0
+
+
+    def _f(self, controls_and_t):
+        fs = np.array([fid.f(controls_and_t) for fid in self.fidelities])
+        return self._softmax(fs)
+
+
+    def _df(self, controls_and_t):
+        return self._value_and_grad(controls_and_t)[1]
+
+
+    def _value_and_grad(self, controls_and_t):
+        fs = np.array([fid.f(controls_and_t) for fid in self.fidelities])
+
+        p = self._softmax_weights(fs)
+        active = np.flatnonzero(p >= min(self.cutoff, np.max(p)))
+        self.skipped = p.size - active.size
+
+        kept = p[active]/np.sum(p[active])
+        df = np.dot(kept, [self.fidelities[i].df(controls_and_t) for i in active])
+        return self._softmax(fs), df
+
+
+    def _hessp(self, controls_and_t, v):
+        # The softmax mixes the members beyond a weighted sum of their Hessians
+        return FidelityBase._hessp(self, controls_and_t, v)
+
+
+    def _f_batch(self, controls):
+        fs = members_f_batch(self.fidelities, controls)
+        return np.array([self._softmax(fs[:, r]) for r in xrange(fs.shape[1])])
+
+
+    def _df_batch(self, controls):
+        return np.array([self._df(c) for c in controls])
+
+
+    def _value_and_grad_batch(self, controls):
+        # Row by row, so that df is only computed for the members above the cutoff,
+        # right after their f at the same controls
+        return FidelityBase._value_and_grad_batch(self, controls)
+
+
+    def softmax_weights(self, controls_and_t):
+        fs = np.array([fid.f(controls_and_t) for fid in self.fidelities])
+        return self._softmax_weights(fs)
+
+
+    def _softmax(self, fs):
+        fmax = np.max(fs)
+        return fmax + np.log(np.dot(self.weights, np.exp(self.sharpness*(fs-fmax))))/self.sharpness
+
+
+    def _softmax_weights(self, fs):
+        p = self.weights*np.exp(self.sharpness*(fs-np.max(fs)))
+        return p/np.sum(p)
+
+
 
 class OperatorDistance(FidelityBase):
     """
     Calculate the operator distance (see core.fidelities for details)
     for a given ParametricSystem and a fixed pulse duration t.
+
+    If t is None, the pulse duration is optimised as well: it is taken
+    from the last entry of controls_and_t, and the last entry of df is
+    the derivative with respect to it (see u_and_du).
     """
 
     def __init__(self, system, t, target):
@@ -120,23 +533,41 @@ class OperatorDistance(FidelityBase):
         self.target = target
 
 
-    def _f(self, controls):
-        u = self.system.u(controls, self.t)
+    def _f(self, controls_and_t):
+        controls, t = split_duration(controls_and_t, self.t)
+        u = self.system.u(controls, t)
         return operator_distance(u, self.target)
 
 
-    def _df(self, controls):
-        u = self.system.u(controls, self.t)
-        du = self.system.du(controls, self.t)
+    def _df(self, controls_and_t):
+        u, du = u_and_du(self.system, controls_and_t, self.t)
         return d_operator_distance(u, du, self.target)
 
 
+    def _value_and_grad(self, controls_and_t):
+        u, du = u_and_du(self.system, controls_and_t, self.t)
+        return operator_distance(u, self.target), d_operator_distance(u, du, self.target)
+
+
+    def _hessp(self, controls_and_t, v):
+        if self.t is None or self.mask is not None:
+            return FidelityBase._hessp(self, controls_and_t, v)
+
+        u = self.system.u(controls_and_t, self.t)
+        traces = self.system.d2u_trace_directional(controls_and_t, self.t, v,
+                                                   operator_trace_weight(self.target))
+        return hessp_operator_distance(u, traces)
+
+
 
 class TransferDistance(FidelityBase):
     """
     Calculate the state transfer fidelity between two states |initial>
     and |final> (see core.fidelities for details)
     for a given ParametricSystem and a fixed pulse duration t.
+
+    If t is None, the pulse duration is the last entry of controls_and_t
+    (see OperatorDistance).
     """
 
     def __init__(self, system, t, initial, final):
@@ -147,12 +578,243 @@ class TransferDistance(FidelityBase):
         self.final = final
 
 
-    def _f(self, controls):
-        u = self.system.u(controls, self.t)
+    def _f(self, controls_and_t):
+        controls, t = split_duration(controls_and_t, self.t)
+        u = self.system.u(controls, t)
         return transfer_distance(u, self.initial, self.final)
 
 
+    def _df(self, controls_and_t):
+        u, du = u_and_du(self.system, controls_and_t, self.t)
+        return d_transfer_distance(u, du, self.initial, self.final)
+
+
+    def _value_and_grad(self, controls_and_t):
+        u, du = u_and_du(self.system, controls_and_t, self.t)
+        return (transfer_distance(u, self.initial, self.final),
+                d_transfer_distance(u, du, self.initial, self.final))
+
+
+    def _hessp(self, controls_and_t, v):
+        if self.t is None or self.mask is not None:
+            return FidelityBase._hessp(self, controls_and_t, v)
+
+        u = self.system.u(controls_and_t, self.t)
+        du = self.system.du(controls_and_t, self.t)
+        weight = transfer_trace_weight(self.initial, self.final)
+        traces = self.system.d2u_trace_directional(controls_and_t, self.t, v, weight)
+        return hessp_transfer_distance(u, du, np.tensordot(v, du, axes=1), traces,
+                                       self.initial, self.final)
+
+
+
+
+class FixedDuration(FidelityBase):
+    """
+    Wrap a fidelity that optimises the pulse duration (constructed with t=None),
+    fixing the duration to t: the controls are passed on with t appended,
+    and the derivative with respect to t is dropped from df.
+
+    Several FixedDurations can wrap the same fidelity, so that its systems
+    (and their caches) are shared between durations.
+    """
+
+    def __init__(self, fidelity, t):
+        super(FixedDuration, self).__init__(fidelity.system)
+        self.fidelity = fidelity
+        self.t = t
+
+
+    def _f(self, controls):
+        return self.fidelity.f(np.append(controls, self.t))
+
+
     def _df(self, controls):
+        return self.fidelity.df(np.append(controls, self.t))[:-1]
+
+
+    def _value_and_grad(self, controls):
+        f, df = self.fidelity.value_and_grad(np.append(controls, self.t))
+        return f, df[:-1]
+
+
+    def _hessp(self, controls, v):
+        return self.fidelity.hessp(np.append(controls, self.t), np.append(v, 0.0))[:-1]
+
+
+    def cache_state(self, eigensystems=False):
+        return self.fidelity.cache_state(eigensystems)
+
+
+    def restore_cache(self, state):
+        self.fidelity.restore_cache(state)
+        self.forget()
+
+
+
+class RobustOperatorDistance(OperatorDistance):
+    """
+    Approximate the average operator distance over an ensemble of systems
+    whose uncertain parameters p_j (see ParametricSystemBase._dhf_parameters)
+    scatter independently around the nominal ones with standard deviations sigmas,
+    by its expansion to second order around the nominal system,
+        f + sum_j sigma_j^2/2 d^2f/dp_j^2.
+
+    The curvature is taken at u = target, where it reduces to the sensitivity
+    ||du/dp_j||^2/dim (see core.fidelities), which is added as a penalty.
+    Only the eigensystem of the nominal system is needed.
+    """
+
+    def __init__(self, system, t, target, sigmas):
+        if t is None:
+            raise er.UsageError("RobustOperatorDistance needs a fixed pulse duration t")
+        super(RobustOperatorDistance, self).__init__(system, t, target)
+        self.sigmas = np.asarray(sigmas)
+
+
+    def penalty(self, controls):
+        dus = self.system.du_parameters(controls, self.t)
+        return np.dot(0.5*self.sigmas**2, operator_sensitivity(dus))
+
+
+    def d_penalty(self, controls):
+        dus = self.system.du_parameters(controls, self.t)
+        ddus = self.system.d2u_parameters_controls(controls, self.t)
+        return np.dot(0.5*self.sigmas**2, d_operator_sensitivity(dus, ddus))
+
+
+    def hessp_penalty(self, controls, v):
+        # No second derivatives of the sensitivities are available
+        return central_difference(self.d_penalty, controls, v)
+
+
+    def taylor_average(self, controls):
+        """
+        Expand the ensemble average to second order around the nominal system,
+        with the curvature evaluated at the given controls, rather than at the target.
+        """
         u = self.system.u(controls, self.t)
-        du = self.system.du(controls, self.t)
-        return d_transfer_distance(u, du, self.initial, self.final)
+        d2us = np.diagonal(self.system.d2u_parameters(controls, self.t)).transpose(2, 0, 1)
+        return self._f(controls) + np.dot(0.5*self.sigmas**2, operator_curvature(u, d2us, self.target))
+
+
+
+class RobustTransferDistance(TransferDistance):
+    """
+    Approximate the average transfer distance over an ensemble of systems
+    whose uncertain parameters scatter around the nominal ones with standard
+    deviations sigmas, by its expansion to second order around the nominal system
+    (see RobustOperatorDistance).
+    """
+
+    def __init__(self, system, t, initial, final, sigmas):
+        if t is None:
+            raise er.UsageError("RobustTransferDistance needs a fixed pulse duration t")
+        super(RobustTransferDistance, self).__init__(system, t, initial, final)
+        self.sigmas = np.asarray(sigmas)
+
+
+    def penalty(self, controls):
+        dus = self.system.du_parameters(controls, self.t)
+        return np.dot(0.5*self.sigmas**2, transfer_sensitivity(dus, self.initial, self.final))
+
+
+    def d_penalty(self, controls):
+        dus = self.system.du_parameters(controls, self.t)
+        ddus = self.system.d2u_parameters_controls(controls, self.t)
+        return np.dot(0.5*self.sigmas**2, d_transfer_sensitivity(dus, ddus, self.initial, self.final))
+
+
+    def hessp_penalty(self, controls, v):
+        # No second derivatives of the sensitivities are available
+        return central_difference(self.d_penalty, controls, v)
+
+
+    def taylor_average(self, controls):
+        """
+        Expand the ensemble average to second order around the nominal system,
+        with the curvature evaluated at the given controls, rather than at the target.
+        """
+        u = self.system.u(controls, self.t)
+        dus = self.system.du_parameters(controls, self.t)
+        d2us = np.diagonal(self.system.d2u_parameters(controls, self.t)).transpose(2, 0, 1)
+        curvature = transfer_curvature(u, dus, d2us, self.initial, self.final)
+        return self._f(controls) + np.dot(0.5*self.sigmas**2, curvature)
+
+
+
+def central_difference(df, controls_and_t, v, h=1e-6):
+    """
+    Approximate the product of the Jacobian of df with v by a central
+    difference with a step h relative to the norms of controls_and_t and v.
+    """
+    norm = np.linalg.norm(v)
+    if norm == 0.0:
+        return np.zeros_like(df(controls_and_t))
+    step = h*max(1.0, np.linalg.norm(controls_and_t))/norm
+    return (df(controls_and_t + step*v) - df(controls_and_t - step*v))/(2.0*step)
+
+
+
+def split_duration(controls_and_t, t):
+    """
+    Split controls_and_t into the controls and the pulse duration,
+    which is t, unless t is None, in which case it is the last entry.
+    """
+    if t is None:
+        return controls_and_t[:-1], controls_and_t[-1]
+    return controls_and_t, t
+
+
+def u_and_du(system, controls_and_t, t):
+    """
+    Compute U and its derivatives with respect to the controls -- and,
+    if t is None (see split_duration), with respect to the pulse duration
+    as the last one, which is given by udot from the same eigensystem.
+    """
+    controls, duration = split_duration(controls_and_t, t)
+    u = system.u(controls, duration)
+    du = system.du(controls, duration)
+    if t is None:
+        du = np.concatenate((du, [system.udot(controls, duration)]))
+    return u, du
+
+
+def members_f_batch(fidelities, controls):
+    # f of each fidelity (rows) for each control vector (columns),
+    # computed member by member, so that each system stays warm
+    return np.array([[fid.f(c) for c in controls] for fid in fidelities])
+
+
+def members_df_batch(fidelities, controls):
+    return np.array([[fid.df(c) for c in controls] for fid in fidelities])
+
+
+def members_value_and_grad_batch(fidelities, controls):
+    # Arrays of f (members, rows) and df (members, rows, controls), from one pass
+    pairs = [[fid.value_and_grad(c) for c in controls] for fid in fidelities]
+    fs = np.array([[f for f, df in member] for member in pairs])
+    dfs = np.array([[df for f, df in member] for member in pairs])
+    return fs, dfs
+
+
+def refinement_order(n):
+    """
+    Order the indices 0...n-1 such that every leading slice of the
+    result samples the range as evenly as possible:
+    0, then every (2^k)-th index, then every (2^(k-1))-th, and so on.
+    """
+    step = 1
+    while step < n:
+        step *= 2
+
+    order = []
+    seen = np.zeros(n, dtype=bool)
+    while step >= 1:
+        for i in xrange(0, n, step):
+            if not seen[i]:
+                order.append(i)
+                seen[i] = True
+        step //= 2
+
+    return order
@@ -1,5 +1,14 @@
+import logging
+import json
+import os
+import threading
+import cPickle as pickle
+from multiprocessing.pool import ThreadPool
+import Queue
 import scipy.optimize as opt
 import numpy as np
+from floq.systems.parametric_system import expand_controls
+from floq.optimization.fidelity import FixedDuration
 
 
 class OptimizerBase(object):
@@ -14,11 +23,22 @@ class OptimizerBase(object):
         raise NotImplementedError
 
 
+# Methods of scipy.minimize that don't use the gradient
+GRADIENT_FREE = ['Nelder-Mead', 'Powell', 'COBYLA']
+
+# Methods of scipy.minimize that use products of the Hessian with vectors
+HESSIAN_METHODS = ['Newton-CG', 'trust-ncg', 'trust-krylov']
+
+
 class SciPyOptimizer(OptimizerBase):
     """A wrapper around scipy.minimize.
 
     For detailed documentation, please refer to the SciPy docs.
 
+    For methods using the gradient, f and df are obtained together
+    from fid.value_and_grad. Methods in HESSIAN_METHODS additionally
+    get the products of the Hessian with vectors from fid.hessp.
+
     Attributes:
         fid: Fidelity object to be optimized
         init: Array of initial control parameters
@@ -39,6 +59,544 @@ class SciPyOptimizer(OptimizerBase):
 
 
     def optimize(self):
-        res = opt.minimize(self.fid.f, self.init, jac=self.fid.df, method=self.method,
+        if self.method in GRADIENT_FREE:
+            fun, jac = self.fid.f, None
+        else:
+            fun, jac = self.fid.value_and_grad, True
+
+        hessp = self.fid.hessp if self.method in HESSIAN_METHODS else None
+
+        res = opt.minimize(fun, self.init, jac=jac, hessp=hessp, method=self.method,
                            tol=self.tol, callback=self.fid.iterate, options=self.options)
         return res
+
+
+
+class NewtonCGOptimizer(SciPyOptimizer):
+    """Trust-region Newton-CG, using the products of the Hessian
+    of the fidelity with vectors (see FidelityBase.hessp).
+
+    Each iteration solves the trust-region subproblem with conjugate
+    gradients, at the cost of one Hessian-vector product per CG step,
+    so that the curvature is known from the start, rather than built up
+    over many iterations as in BFGS. This pays off on ill-conditioned
+    problems, such as robust fidelities.
+
+    Attributes: see SciPyOptimizer, method is 'trust-ncg' by default.
+    """
+    def __init__(self, fid, init, method='trust-ncg', tol=1e-5, options={}):
+        super(NewtonCGOptimizer, self).__init__(fid, init, method, tol, options)
+
+
+
+class BFGSOptimizer(OptimizerBase):
+    """BFGS with checkpoints, for long optimisations that may be interrupted.
+
+    scipy.minimize can neither return nor accept the inverse Hessian,
+    so a restarted BFGS would start over from the identity. This optimizer
+    runs BFGS itself (with scipy's Wolfe line search), and every `every`
+    iterations writes a checkpoint to the file `checkpoint`, containing the
+    controls, the inverse Hessian, and the caches of the fidelity
+    (see FidelityBase.cache_state, eigensystems selects whether
+    the cached eigensystems are included).
+    BFGSOptimizer.resume continues from such a checkpoint.
+
+    Attributes:
+        fid: Fidelity object to be optimized
+        init: Array of initial control parameters
+        tol: Float specifying tolerance on the largest gradient component
+        maxiter: maximal number of iterations
+        checkpoint: path of the checkpoint file (None to disable)
+        every: number of iterations between checkpoints
+        eigensystems: whether checkpoints include the eigensystems
+        target: if given, stop as soon as f drops below it
+
+    Methods:
+        optimize: Run optimisation, returns result dictionary
+        resume: Construct an optimizer from a checkpoint
+
+    """
+    def __init__(self, fid, init, tol=1e-5, maxiter=None, checkpoint=None, every=10,
+                 eigensystems=False, target=None):
+        self.fid = fid
+        self.init = np.asarray(init, dtype=float)
+        self.tol = tol
+        self.target = target
+        self.maxiter = maxiter or 200*self.init.size
+        self.checkpoint = checkpoint
+        self.every = every
+        self.eigensystems = eigensystems
+
+        self.hess_inv = np.eye(self.init.size)
+        self.iterations = 0
+
+
+    @classmethod
+    def resume(cls, fid, path, **kwargs):
+        """Construct an optimizer continuing from the checkpoint at path,
+        restoring the caches of fid. By default, it keeps writing to path."""
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+
+        kwargs.setdefault('checkpoint', path)
+        optimizer = cls(fid, state['x'], **kwargs)
+        optimizer.hess_inv = state['hess_inv']
+        optimizer.iterations = state['iterations']
+        fid.restore_cache(state['cache'])
+        return optimizer
+
+
+    def save(self, x, fx):
+        """Write a checkpoint, replacing the previous one atomically"""
+        state = {'x': x, 'f': fx, 'hess_inv': self.hess_inv, 'iterations': self.iterations,
+                 'cache': self.fid.cache_state(self.eigensystems)}
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'wb') as out:
+            pickle.dump(state, out, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.checkpoint)
+
+
+    def optimize(self):
+        # f and df both go through value_and_grad, so that the gradient
+        # at the accepted step comes from the fidelity's memo
+        f = lambda x: self.fid.value_and_grad(x)[0]
+        df = lambda x: self.fid.value_and_grad(x)[1]
+
+        x = np.copy(self.init)
+        fx, g = self.fid.value_and_grad(x)
+        old_f = fx + np.linalg.norm(g)/2.0
+        identity = np.eye(x.size)
+
+        message = 'Maximum number of iterations has been exceeded.'
+        success = False
+        while self.iterations < self.maxiter:
+            if np.max(np.abs(g)) <= self.tol:
+                message, success = 'Optimization terminated successfully.', True
+                break
+            if self.target is not None and fx <= self.target:
+                message, success = 'Target reached.', True
+                break
+
+            p = -np.dot(self.hess_inv, g)
+            alpha, fc, gc, new_f, old_f, new_slope = opt.line_search(f, df, x, p, g, fx, old_f)
+            if alpha is None:
+                message = 'Desired error not necessarily achieved due to precision loss.'
+                break
+
+            s = alpha*p
+            x = x + s
+            new_g = df(x)
+            y = new_g - g
+            fx, g = new_f, new_g
+            self.iterations += 1
+            self.fid.iterate(x)
+
+            # Skip the update if the curvature condition fails
+            ys = np.dot(y, s)
+            if ys > 0:
+                rho = 1.0/ys
+                a1 = identity - rho*np.outer(s, y)
+                a2 = identity - rho*np.outer(y, s)
+                self.hess_inv = np.dot(a1, np.dot(self.hess_inv, a2)) + rho*np.outer(s, s)
+
+            if self.checkpoint is not None and self.iterations % self.every == 0:
+                self.save(x, fx)
+
+        if self.checkpoint is not None:
+            self.save(x, fx)
+
+        return opt.OptimizeResult(x=x, fun=fx, jac=g, hess_inv=self.hess_inv,
+                                  nit=self.iterations, success=success, message=message)
+
+
+
+class ContinuationOptimizer(OptimizerBase):
+    """Optimise with a coarse Floquet truncation first, refining it in stages.
+
+    Early iterations only need to point in the right direction, which
+    a small nz and a loose unitarity target already achieve at a fraction
+    of the cost. Each stage (nz, decimals, target) fixes nz (see FixedSystem's
+    fixed_nz) and sets decimals for all systems of fid, and runs BFGS
+    until f drops below target (or converges). Finally, the original truncation
+    is restored (with nz at least as large as in the last stage, and allowed
+    to grow again), and the optimisation is completed with tol.
+
+    Every stage is warm-started from the previous one: it starts from the
+    controls reached, and keeps the inverse Hessian built up so far
+    (see BFGSOptimizer).
+
+    The truncation is changed through fid.cache_state and fid.restore_cache,
+    so this works with the parallel backends as well.
+
+    Attributes:
+        fid: Fidelity object to be optimized
+        init: Array of initial control parameters
+        stages: list of (nz, decimals, target), in order of increasing nz
+        tol: tolerance of the final stage (as for BFGSOptimizer)
+        maxiter: maximal number of iterations per stage
+
+    After optimize:
+        stage_results: controls and f reached in each stage (the last one is final)
+
+    Methods:
+        optimize: Run optimisation, returns the result of the final stage
+
+    """
+    def __init__(self, fid, init, stages, tol=1e-5, maxiter=None):
+        self.fid = fid
+        self.init = init
+        self.stages = stages
+        self.tol = tol
+        self.maxiter = maxiter
+
+
+    def optimize(self):
+        original = self.fid.cache_state()
+        x = self.init
+        hess_inv = None
+        self.stage_results = []
+
+        for nz, decimals, target in self.stages:
+            self.fid.restore_cache(set_truncation(original, nz=nz, decimals=decimals,
+                                                  fixed_nz=True))
+            res = self._run_stage(x, hess_inv, self.tol, target)
+            x, hess_inv = res.x, res.hess_inv
+            self.stage_results.append([res.x, res.fun])
+            logging.info('Stage with nz=%i finished at f=%f' % (nz, res.fun))
+
+        last_nz = self.stages[-1][0] if self.stages else 0
+        self.fid.restore_cache(set_truncation(original, nz=lambda nz: max(nz, last_nz)))
+        res = self._run_stage(x, hess_inv, self.tol, None)
+        self.stage_results.append([res.x, res.fun])
+        return res
+
+
+    def _run_stage(self, x, hess_inv, tol, target):
+        stage = BFGSOptimizer(self.fid, x, tol=tol, maxiter=self.maxiter, target=target)
+        if hess_inv is not None:
+            stage.hess_inv = hess_inv
+        return stage.optimize()
+
+
+
+class ComponentContinuationOptimizer(OptimizerBase):
+    """Optimise with a few Fourier components of the pulse first,
+    adding higher harmonics in stages.
+
+    The cost of an iteration grows with the number of components ncomp,
+    through the number of controls and the bandwidth of K. For each
+    entry of ncomps, the systems of fid are switched to that many components
+    (see ParametricSystemBase.set_ncomp), the controls reached so far are padded
+    with zeros for the new ones, and BFGS continues, keeping the inverse Hessian
+    for the old controls (see BFGSOptimizer).
+
+    The number of components is changed through fid.cache_state and
+    fid.restore_cache, so this works with the parallel backends as well.
+
+    Attributes:
+        fid: Fidelity object to be optimized
+        init: Array of initial control parameters, for ncomps[0] components
+        ncomps: increasing list of numbers of components
+        tol: tolerance of the final stage (as for BFGSOptimizer)
+        stage_tol: tolerance of the earlier stages (by default tol)
+        maxiter: maximal number of iterations per stage
+
+    After optimize:
+        stage_results: controls and f reached with each number of components
+
+    Methods:
+        optimize: Run optimisation, returns the result of the final stage
+
+    """
+    def __init__(self, fid, init, ncomps, tol=1e-5, stage_tol=None, maxiter=None):
+        self.fid = fid
+        self.init = np.asarray(init, dtype=float)
+        self.ncomps = ncomps
+        self.tol = tol
+        self.stage_tol = stage_tol or tol
+        self.maxiter = maxiter
+
+
+    def optimize(self):
+        x = self.init
+        hess_inv = np.eye(x.size)
+        ncomp = self.ncomps[0]
+        self.stage_results = []
+
+        for stage, new_ncomp in enumerate(self.ncomps):
+            self.fid.restore_cache(set_truncation(self.fid.cache_state(), ncomp=new_ncomp))
+            x = expand_controls(x, ncomp, new_ncomp)
+            ncomp = new_ncomp
+
+            expanded = np.eye(x.size)
+            expanded[:hess_inv.shape[0], :hess_inv.shape[1]] = hess_inv
+
+            tol = self.tol if stage == len(self.ncomps)-1 else self.stage_tol
+            optimizer = BFGSOptimizer(self.fid, x, tol=tol, maxiter=self.maxiter)
+            optimizer.hess_inv = expanded
+            res = optimizer.optimize()
+
+            x, hess_inv = res.x, res.hess_inv
+            self.stage_results.append([res.x, res.fun])
+            logging.info('Stage with ncomp=%i finished at f=%f' % (ncomp, res.fun))
+
+        return res
+
+
+
+class DurationSweep(OptimizerBase):
+    """Optimise the controls for each pulse duration on a grid, e.g. to find
+    the shortest duration reaching a given fidelity.
+
+    The durations are visited in order, and each optimisation (BFGS, see
+    BFGSOptimizer) starts from the controls and inverse Hessian reached for
+    the previous duration. Since the controls then coincide, the systems only
+    need to evolve the cached eigensystem of K to the new duration
+    (see FixedSystem.at_time), and nz is not rediscovered.
+
+    make_fidelity() should return a fidelity with t=None (see OperatorDistance),
+    it is called once per chain: the grid is split into `chains` contiguous
+    pieces, which are swept concurrently in threads (each starting from init),
+    so the fidelities of different chains must not share their systems.
+
+    If path is given, one line of JSON (t, f, iterations, controls) is appended
+    to it as soon as each duration is done.
+
+    Attributes:
+        make_fidelity: callable returning a fidelity with free t
+        ts: the durations
+        init: Array of initial control parameters
+        chains: number of pieces of the grid swept concurrently
+        path: file to write the fidelity-vs-t curve to (None to disable)
+        tol, maxiter: as for BFGSOptimizer
+
+    After optimize:
+        results: the result for each duration, in the order of ts
+
+    Methods:
+        optimize: Run the sweep, returns the durations and the fidelities reached
+
+    """
+    def __init__(self, make_fidelity, ts, init, chains=1, path=None, tol=1e-5, maxiter=None):
+        self.make_fidelity = make_fidelity
+        self.ts = np.sort(ts)
+        self.init = np.asarray(init, dtype=float)
+        self.chains = chains
+        self.path = path
+        self.tol = tol
+        self.maxiter = maxiter
+
+
+    def optimize(self):
+        self.results = [None]*len(self.ts)
+        self._lock = threading.Lock()
+
+        pieces = [piece for piece in np.array_split(np.arange(len(self.ts)), self.chains)
+                  if len(piece)]
+        if len(pieces) == 1:
+            self._sweep(pieces[0])
+        else:
+            pool = ThreadPool(len(pieces))
+            try:
+                pool.map(self._sweep, pieces)
+            finally:
+                pool.close()
+
+        return self.ts, np.array([res.fun for res in self.results])
+
+
+    def _sweep(self, indices):
+        fid = self.make_fidelity()
+        x = self.init
+        hess_inv = None
+
+        try:
+            for i in indices:
+                optimizer = BFGSOptimizer(FixedDuration(fid, self.ts[i]), x, tol=self.tol,
+                                          maxiter=self.maxiter)
+                if hess_inv is not None:
+                    optimizer.hess_inv = hess_inv
+                res = optimizer.optimize()
+                x, hess_inv = res.x, res.hess_inv
+
+                self.results[i] = res
+                self._record(self.ts[i], res)
+                logging.info('Duration %f done at f=%f' % (self.ts[i], res.fun))
+        finally:
+            if hasattr(fid, 'kill'):
+                fid.kill()
+
+
+    def _record(self, t, res):
+        if self.path is None:
+            return
+        record = {'t': float(t), 'f': float(res.fun), 'iterations': res.nit,
+                  'controls': [float(c) for c in res.x]}
+        with self._lock:
+            with open(self.path, 'a') as out:
+                out.write(json.dumps(record) + '\n')
+
+
+
+def set_truncation(state, **truncation):
+    """
+    Copy the cache state of a fidelity (a dict, or a list of them for ensembles),
+    dropping eigensystems and setting the given truncation, for instance nz=5
+    (or ncomp, the number of control components).
+    Values can also be functions of the current value.
+    """
+    if isinstance(state, list):
+        return [set_truncation(member, **truncation) for member in state]
+
+    new = dict((key, state[key]) for key in ('nz', 'decimals', 'fixed_nz', 'ncomp')
+               if key in state)
+    for key, value in truncation.items():
+        new[key] = value(new[key]) if callable(value) else value
+    return new
+
+
+
+class Culled(Exception):
+    """Raised inside a start of MultiStartOptimizer that has been abandoned"""
+
+    pass
+
+
+class MultiStartOptimizer(OptimizerBase):
+    """Run scipy.minimize from several initial controls concurrently,
+    abandoning the starts that fall behind.
+
+    Each start runs in its own thread, but all evaluations go through one
+    coordinator: once every running start waits for an evaluation, all of them
+    are computed together with fid.value_and_grad_batch (or fid.f_batch for
+    gradient-free methods), so that a parallel fidelity distributes the whole
+    batch over its workers in one round-trip.
+
+    After a start has done `after` iterations, it is abandoned as soon as the best
+    fidelity it has seen trails the best one of all starts by more than `margin`.
+
+    Attributes:
+        fid: Fidelity object to be optimized
+        inits: Array of initial control parameters, one start per row
+        method, tol, options: as for SciPyOptimizer
+        margin: how far (in f) a start may trail the leader
+        after: number of iterations before a start can be abandoned
+
+    After optimize:
+        results: the scipy result of each start (None if it was abandoned)
+        culled: indices of the abandoned starts
+        iterations: iterations of each start
+        best: the best f seen by each start
+
+    Methods:
+        optimize: Run the optimisations, returns the best result
+
+    """
+    def __init__(self, fid, inits, method='BFGS', tol=1e-5, options={}, margin=0.1, after=10):
+        self.fid = fid
+        self.inits = np.atleast_2d(inits)
+        self.method = method
+        self.tol = tol
+        self.options = options
+        self.margin = margin
+        self.after = after
+
+
+    def optimize(self):
+        n = self.inits.shape[0]
+        self.requests = Queue.Queue()
+        self.replies = [Queue.Queue() for i in xrange(n)]
+        self.results = [None]*n
+        self.errors = [None]*n
+        self.culled = []
+        self.iterations = np.zeros(n, dtype=int)
+        self.best = np.inf*np.ones(n)
+
+        threads = [threading.Thread(target=self._run_start, args=(i,)) for i in xrange(n)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        self._coordinate(n)
+
+        for thread in threads:
+            thread.join()
+        for error in self.errors:
+            if error is not None:
+                raise error
+
+        finished = [res for res in self.results if res is not None]
+        return min(finished, key=lambda res: res.fun)
+
+
+    def _run_start(self, i):
+        gradient = self.method not in GRADIENT_FREE
+
+        def fun(x):
+            self.requests.put(['evaluate', i, np.copy(x), gradient])
+            reply = self.replies[i].get()
+            if reply is None:
+                raise Culled()
+            return reply
+
+        def callback(x):
+            self.iterations[i] += 1
+
+        try:
+            self.results[i] = opt.minimize(fun, self.inits[i], jac=gradient or None,
+                                           method=self.method, tol=self.tol,
+                                           callback=callback, options=self.options)
+        except Culled:
+            pass
+        except Exception as error:
+            self.errors[i] = error
+        finally:
+            self.requests.put(['done', i])
+
+
+    def _coordinate(self, n):
+        # Serve the starts in rounds, until all of them have finished
+        running = set(xrange(n))
+        while running:
+            waiting = {}
+            while len(waiting) < len(running):
+                msg = self.requests.get()
+                if msg[0] == 'done':
+                    running.discard(msg[1])
+                else:
+                    waiting[msg[1]] = msg[2:]
+
+            for i in self._to_cull(waiting):
+                logging.info('Abandoning start %i at f=%f' % (i, self.best[i]))
+                self.culled.append(i)
+                self.replies[i].put(None)
+                del waiting[i]
+
+            if waiting:
+                self._evaluate(waiting)
+
+
+    def _to_cull(self, waiting):
+        leader = np.min(self.best)
+        return [i for i in waiting
+                if self.iterations[i] >= self.after and self.best[i] > leader + self.margin]
+
+
+    def _evaluate(self, waiting):
+        ids = sorted(waiting)
+        controls = np.array([waiting[i][0] for i in ids])
+        gradient = [row for row, i in enumerate(ids) if waiting[i][1]]
+        values = [row for row, i in enumerate(ids) if not waiting[i][1]]
+
+        # f and df are computed together, so that each row is only diagonalised once
+        replies = {}
+        if gradient:
+            fs, dfs = self.fid.value_and_grad_batch(controls[gradient])
+            replies.update(zip(gradient, zip(fs, dfs)))
+        if values:
+            replies.update(zip(values, self.fid.f_batch(controls[values])))
+
+        for row, i in enumerate(ids):
+            reply = replies[row]
+            self.best[i] = min(self.best[i], reply[0] if row in gradient else reply)
+            self.replies[i].put(reply)
@@ -0,0 +1,230 @@
+import contextlib
+import ctypes
+import logging
+import os
+import time
+import multiprocessing as mp
+import numpy as np
+import numba
+
+try:
+    from threadpoolctl import threadpool_limits, threadpool_info
+except ImportError:
+    threadpool_limits = threadpool_info = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+# Environment variables read by BLAS/OpenMP when they are loaded,
+# i.e. they only affect processes started after they have been set
+THREAD_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS']
+
+# Getters and setters of the thread count of BLAS libraries, by library name,
+# used if threadpoolctl (which needs Python 3) is not available
+BLAS_THREAD_FUNCTIONS = {'openblas': ('openblas_get_num_threads', 'openblas_set_num_threads'),
+                         'mkl_rt': ('MKL_Get_Max_Threads', 'MKL_Set_Num_Threads')}
+_blas_handles = {}
+_blas_warned = []
+
+
+
+class ParallelConfig(object):
+    """
+    Describes how the cores of a node are split up between nested levels
+    of parallelism: the ensemble backends in floq.parallel run the members
+    on 'workers' processes (or threads), and each worker may use 'threads'
+    threads, both to split the parameters of du (see FixedSystem) and in BLAS/OpenMP.
+
+    If pin is True, worker i is pinned to its own set of 'threads' cores
+    (requires os.sched_setaffinity or psutil).
+
+    By default, workers*threads equals the number of cores.
+    """
+
+    def __init__(self, workers=None, threads=1, pin=False, cores=None):
+        self.cores = cores or mp.cpu_count()
+        self.threads = threads
+        self.workers = workers or max(1, self.cores // threads)
+        self.pin = pin
+
+
+    def __repr__(self):
+        return 'ParallelConfig(workers=%i, threads=%i, pin=%s)' % (self.workers, self.threads,
+                                                                   self.pin)
+
+
+    def cpus(self, i):
+        """ The cores assigned to worker i """
+        return [(i*self.threads + j) % self.cores for j in xrange(self.threads)]
+
+
+    def environment(self):
+        """
+        Environment variables limiting the libraries to self.threads threads,
+        for processes that load them after they have been set.
+        """
+        return dict((variable, str(self.threads)) for variable in THREAD_VARIABLES)
+
+
+    def configure_systems(self, fidelities):
+        """ Let the systems of the given fidelities compute du on self.threads threads """
+        for fid in fidelities:
+            if hasattr(fid.system, 'threads'):
+                fid.system.threads = self.threads
+
+
+    def apply(self, i=None):
+        """
+        Apply the configuration in the current process, which runs worker i:
+        limit BLAS/OpenMP and numba to self.threads threads, and pin it if requested.
+
+        The libraries are already loaded (the workers are forked), so the limits are
+        set through threadpoolctl, or else the BLAS libraries found by blas_libraries();
+        the environment only reaches processes started by the worker.
+        A warning is logged if no library could be limited.
+        """
+        os.environ.update(self.environment())
+        set_numba_threads(self.threads)
+        if threadpool_limits is not None:
+            threadpool_limits(limits=self.threads)
+        else:
+            set_blas_threads(self.threads)
+
+        if self.pin and i is not None:
+            pin(self.cpus(i))
+
+
+    def limits(self):
+        """
+        Context manager limiting BLAS/OpenMP to self.threads threads,
+        for backends that run their workers as threads.
+        A warning is logged if no library could be limited.
+        """
+        if threadpool_limits is not None:
+            return threadpool_limits(limits=self.threads)
+        return _blas_limits(self.threads)
+
+
+
+def pin(cpus):
+    """ Pin the current process to the given cores, if the platform allows it """
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    elif psutil is not None:
+        psutil.Process().cpu_affinity(cpus)
+    else:
+        logging.warning('Cannot pin to cores %s, neither os.sched_setaffinity nor psutil '
+                        'are available' % str(cpus))
+
+
+def blas_libraries():
+    """
+    The BLAS libraries loaded in the current process whose thread count
+    can be controlled, as a list of (getter, setter) ctypes functions
+    (this reads /proc/self/maps, so it finds nothing on other platforms)
+    """
+    try:
+        with open('/proc/self/maps') as maps:
+            paths = set(line.split()[-1] for line in maps if '.so' in line)
+    except IOError:
+        return []
+
+    libraries = []
+    for path in sorted(paths):
+        for name, (getter, setter) in BLAS_THREAD_FUNCTIONS.iteritems():
+            if name in os.path.basename(path):
+                if path not in _blas_handles:
+                    _blas_handles[path] = ctypes.CDLL(path)
+                library = _blas_handles[path]
+                if hasattr(library, getter) and hasattr(library, setter):
+                    libraries.append((getattr(library, getter), getattr(library, setter)))
+    return libraries
+
+
+def blas_threads():
+    """ The thread counts of the loaded BLAS libraries, see blas_libraries """
+    if threadpool_limits is not None:
+        return [info['num_threads'] for info in threadpool_info()]
+    return [getter() for getter, setter in blas_libraries()]
+
+
+def set_blas_threads(threads):
+    """
+    Set the thread count of the loaded BLAS libraries, see blas_libraries,
+    and return their setters together with their previous thread counts
+    """
+    libraries = blas_libraries()
+    if not libraries and not _blas_warned:
+        _blas_warned.append(threads)
+        logging.warning('Cannot limit BLAS to %i threads: threadpoolctl is not available, '
+                        'and no known BLAS library is loaded' % threads)
+
+    previous = [(setter, getter()) for getter, setter in libraries]
+    for getter, setter in libraries:
+        setter(threads)
+    return previous
+
+
+def set_numba_threads(threads):
+    """
+    Limit numba to the given number of threads: numba.config.NUMBA_NUM_THREADS
+    takes effect if numba's threading layer has not been launched yet,
+    and numba.set_num_threads (numba >= 0.49) afterwards.
+    """
+    if hasattr(numba, 'set_num_threads'):
+        numba.set_num_threads(min(threads, numba.config.NUMBA_NUM_THREADS))
+    numba.config.NUMBA_NUM_THREADS = threads
+
+
+def splits(cores):
+    """ All configurations with workers*threads == cores """
+    return [ParallelConfig(workers=cores // threads, threads=threads, cores=cores)
+            for threads in xrange(1, cores+1) if cores % threads == 0]
+
+
+def tune(make_fidelity, controls, cores=None, repeat=3):
+    """
+    Benchmark the possible splits of cores into workers and threads,
+    and return the fastest configuration, together with the timings
+    (seconds per value_and_grad call) of all of them.
+
+    make_fidelity(config) should return a fidelity using the given config
+    (for instance lambda config: FidelityMaster(config.workers, ensemble, fidelity,
+    config=config, **params)). If it has a kill() method, it is called afterwards.
+    """
+
+    timings = []
+    for config in splits(cores or mp.cpu_count()):
+        fid = make_fidelity(config)
+        try:
+            fid.value_and_grad(controls)  # warm-up: workers, nz, compilation
+
+            # Perturb the controls, so that no level of caching can answer
+            best = np.inf
+            for i in xrange(repeat):
+                start = time.time()
+                fid.value_and_grad(controls*(1.0 + 1e-3*(i+1)))
+                best = min(best, time.time() - start)
+        finally:
+            if hasattr(fid, 'kill'):
+                fid.kill()
+
+        logging.info('%s: %f s' % (repr(config), best))
+        timings.append([config, best])
+
+    return min(timings, key=lambda timing: timing[1])[0], timings
+
+
+
+@contextlib.contextmanager
+def _blas_limits(threads):
+    previous = set_blas_threads(threads)
+    try:
+        yield
+    finally:
+        for setter, count in previous:
+            setter(count)
@@ -0,0 +1,295 @@
+import logging
+import sys
+import traceback
+import multiprocessing as mp
+from multiprocessing.connection import Listener, Client
+import numpy as np
+from floq.optimization.fidelity import FidelityBase
+from floq.parallel.worker import chunks, partial_sums
+from floq.parallel.config import ParallelConfig
+import floq.errors as er
+
+
+
+class DistributedFidelity(FidelityBase):
+    """
+    With a given Ensemble, and a FidelityComputer,
+    calculate the average fidelity over the whole ensemble
+    (weighted with ensemble.weights) on worker daemons, which can run
+    on other hosts and are reached over TCP (see serve).
+
+    The daemons are arranged in a tree with the given fanout, the first
+    address being the root: requests are passed down the tree, and every
+    daemon adds the partial sums of its children to its own before answering
+    its parent, so the master only talks to the root.
+    Each daemon receives its slice of the ensemble once, on construction,
+    together with config (a ParallelConfig, by default with one thread),
+    which sets the threads it uses for du and BLAS.
+
+    Exceptions raised by the fidelities on a daemon are raised as RemoteError,
+    naming the address of the daemon, and the daemons keep serving.
+
+    Note: After use, the daemons should be released by calling kill().
+    They can then be used by another DistributedFidelity.
+    """
+
+    def __init__(self, addresses, ensemble, fidelity, authkey, fanout=2, config=None, **params):
+        super(DistributedFidelity, self).__init__(ensemble)
+        self.config = config or ParallelConfig(workers=1, cores=1)
+        self.fidelities = [fidelity(sys, **params) for sys in ensemble.systems]
+        self.config.configure_systems(self.fidelities)
+        self.n = len(ensemble.systems)
+        self.addresses = list(addresses)
+        self.fanout = fanout
+
+        fidelities_chunked = chunks(self.fidelities, len(self.addresses))
+        weights_chunked = chunks(np.asarray(ensemble.weights), len(self.addresses))
+        offsets = np.cumsum([0] + [len(chunk) for chunk in fidelities_chunked])
+        setups = [['setup', fidelities_chunked[i], weights_chunked[i], self.config, offsets[i]]
+                  for i in xrange(len(self.addresses))]
+
+        logging.info('Connecting to ' + str(len(self.addresses)) + ' daemons')
+        self.connection = Client(self.addresses[0], authkey=authkey)
+        self.connection.send(tree_setup(0, self.addresses, setups, fanout))
+        self._reply()
+        logging.info('Successfully distributed the ensemble')
+
+
+    def _run(self, instruction, controls_and_t):
+        self.connection.send([instruction, controls_and_t])
+        return self._reply()
+
+
+    def _reply(self):
+        reply = self.connection.recv()
+        if isinstance(reply, Failure):
+            raise er.RemoteError(reply.address, reply.remote_traceback)
+        return reply
+
+
+    def _f(self, controls_and_t):
+        """ Compute the average fidelity of the ensemble """
+        return self._run('f', controls_and_t)[0]
+
+
+    def _df(self, controls_and_t):
+        """ Compute the average gradient of the fidelity of the ensemble """
+        return self._run('df', controls_and_t)[1]
+
+
+    def _value_and_grad(self, controls_and_t):
+        """ Compute the average fidelity and its gradient in one round-trip """
+        return self._run('value_and_grad', controls_and_t)
+
+
+    def _f_batch(self, controls):
+        """ Compute the average fidelity for each row of controls in one round-trip """
+        return self._run('f_batch', controls)[0]
+
+
+    def _df_batch(self, controls):
+        """ Compute the average gradient for each row of controls in one round-trip """
+        return self._run('df_batch', controls)[1]
+
+
+    def _value_and_grad_batch(self, controls):
+        """ Compute the average fidelity and gradient for each row of controls in one round-trip """
+        return self._run('value_and_grad_batch', controls)
+
+
+    def _hessp(self, controls_and_t, v):
+        """ Compute the average product of the Hessians with v in one round-trip """
+        return self._run('hessp', (controls_and_t, v))[1]
+
+
+    def cache_state(self, eigensystems=False):
+        """ Collect the cache states of the members from the daemons """
+        states = [None]*self.n
+        for offset, daemon_states in self._run('cache', eigensystems):
+            states[offset:offset+len(daemon_states)] = daemon_states
+        return states
+
+
+    def restore_cache(self, state):
+        """ Restore the cache states of the members on the daemons """
+        self._run('restore', state)
+        self.forget()
+
+
+    def kill(self):
+        """ Release the daemons """
+        self.connection.send(None)
+        self.connection.close()
+
+
+
+def tree_setup(i, addresses, setups, fanout):
+    """
+    Build the setup message for daemon i, containing the addresses
+    and (recursively) the setup messages of its children.
+    """
+
+    children = range(i*fanout+1, min((i+1)*fanout+1, len(addresses)))
+    return setups[i] + [[[addresses[c], tree_setup(c, addresses, setups, fanout)] for c in children]]
+
+
+def serve(address, authkey, ready=None):
+    """
+    Run a worker daemon listening on address, serving one master (or parent
+    daemon) at a time until it disconnects.
+
+    If ready is given (a Pipe), the address that is actually listened on
+    is sent through it, which allows to listen on port 0.
+    """
+
+    listener = Listener(address, authkey=authkey)
+    if ready is not None:
+        ready.send(listener.address)
+
+    while True:
+        parent = listener.accept()
+        try:
+            Daemon(parent, authkey, listener.address).run()
+        except EOFError:
+            logging.info('Parent disconnected')
+        parent.close()
+
+
+class Failure(object):
+    """
+    Sent up the tree instead of a reply, if an exception was raised
+    on the daemon at address.
+    """
+
+    def __init__(self, address, remote_traceback):
+        self.address = address
+        self.remote_traceback = remote_traceback
+
+
+
+class Daemon(object):
+    """
+    Serves the requests of a parent connection: holds a slice of the ensemble,
+    and combines its partial f and df with the ones of its children.
+
+    If a request raises an exception, the traceback is sent to the parent
+    as a Failure (the first one in the subtree is passed on), and the
+    daemon keeps serving.
+    """
+
+    def __init__(self, parent, authkey, address=None):
+        self.parent = parent
+        self.authkey = authkey
+        self.address = address
+        self.children = []
+        self.fids = []
+        self.weights = []
+        self.offset = 0
+
+
+    def setup(self, fids, weights, config, offset, children):
+        self.fids = fids
+        self.weights = weights
+        self.offset = offset
+        config.apply()
+
+        self.children = [Client(address, authkey=self.authkey) for address, msg in children]
+        for child, (address, msg) in zip(self.children, children):
+            child.send(msg)
+        failures = [reply for reply in [child.recv() for child in self.children]
+                    if isinstance(reply, Failure)]
+        if failures:
+            return failures[0]
+
+        logging.info('Daemon initialised with ' + str(len(self.fids)) + ' fidelities and '
+                     + str(len(self.children)) + ' children')
+        return True
+
+
+    def compute(self, instruction, ctrl):
+        return partial_sums(instruction, zip(self.weights, self.fids), ctrl)
+
+
+    def handle(self, msg):
+        # Children start working before this daemon does
+        for child in self.children:
+            child.send(msg)
+        try:
+            own = self.handle_own(msg)
+        except Exception:
+            own = Failure(self.address, traceback.format_exc())
+        replies = [child.recv() for child in self.children]
+
+        failures = [reply for reply in [own] + replies if isinstance(reply, Failure)]
+        if failures:
+            return failures[0]
+
+        if msg[0] == 'cache':
+            # Gather (offset, states) of the whole subtree
+            return sum(replies, [[self.offset, own]])
+        elif msg[0] == 'restore':
+            return True
+        else:
+            f, df = own
+            for child_f, child_df in replies:
+                f += child_f
+                df = df + child_df
+            return [f, df]
+
+
+    def handle_own(self, msg):
+        if msg[0] == 'cache':
+            return [fid.cache_state(msg[1]) for fid in self.fids]
+        elif msg[0] == 'restore':
+            for fid, state in zip(self.fids, msg[1][self.offset:self.offset+len(self.fids)]):
+                fid.restore_cache(state)
+            return True
+        else:
+            return self.compute(*msg)
+
+
+    def run(self):
+        # Serve the parent until it sends None
+        while True:
+            msg = self.parent.recv()
+            if msg is None:
+                break
+
+            if msg[0] == 'setup':
+                try:
+                    reply = self.setup(*msg[1:])
+                except Exception:
+                    reply = Failure(self.address, traceback.format_exc())
+                self.parent.send(reply)
+            else:
+                self.parent.send(self.handle(msg))
+
+        for child in self.children:
+            child.send(None)
+            child.close()
+
+
+def start_local_daemons(n, authkey, host='localhost'):
+    """
+    Start n daemons as local processes, listening on free ports.
+    Returns the processes and their addresses.
+    """
+
+    processes = []
+    addresses = []
+    for i in xrange(n):
+        pipe_in, pipe_out = mp.Pipe()
+        process = mp.Process(target=serve, args=((host, 0), authkey, pipe_out))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+        addresses.append(pipe_in.recv())
+
+    return processes, addresses
+
+
+
+if __name__ == '__main__':
+    # python -m floq.parallel.distributed host port authkey
+    logging.basicConfig(level=logging.INFO)
+    serve((sys.argv[1], int(sys.argv[2])), sys.argv[3])
@@ -2,6 +2,12 @@
 import multiprocessing as mp
 import numpy as np
 from floq.optimization.fidelity import FidelityBase
+from floq.parallel.worker import chunks, partial_sums
+from floq.parallel.config import ParallelConfig
+
+
+# Fidelities installed in a pool worker by initialize_worker
+resident = {}
 
 
 def run_fid(pair):
@@ -18,30 +24,196 @@ def run_dfid(pair):
     return fid
 
 
+def run_value_and_grad(pair):
+    fid = pair[0]
+    ctrl = pair[1]
+    f, df = fid.value_and_grad(ctrl)
+    return [fid, f, df]
+
+
+def run_hessp(item):
+    fid, ctrl, v = item
+    return [fid, fid.hessp(ctrl, v)]
+
+
+def run_batch(item):
+    fid, controls, instruction = item
+    if instruction == 'f_batch':
+        values = [fid.f(c) for c in controls]
+    else:
+        values = [fid.df(c) for c in controls]
+    return [fid, np.array(values)]
+
+
+def run_value_and_grad_batch(item):
+    fid, controls = item
+    fs, dfs = zip(*[fid.value_and_grad(c) for c in controls])
+    return [fid, np.array(fs), np.array(dfs)]
+
+
+def initialize_worker(config, fidelities=None, weights=None):
+    # Pool workers are numbered from 1, respawned ones keep counting
+    config.apply((mp.current_process()._identity[0] - 1) % config.workers)
+    if fidelities is not None:
+        resident['fidelities'] = fidelities
+        resident['weights'] = weights
+
+
+def run_resident(task):
+    """
+    Compute the weighted partial sums of f and/or df over the resident
+    fidelities with the given indices, starting from the given truncations
+    (cache states without eigensystems). Returns the sums and the
+    truncations the members ended up with.
+    """
+    instruction, indices, states, ctrl = task
+    for k, state in zip(indices, states):
+        # Restoring drops the cached eigensystem, so only do it if needed
+        if resident['fidelities'][k].cache_state() != state:
+            resident['fidelities'][k].restore_cache(state)
+
+    members = [(resident['weights'][k], resident['fidelities'][k]) for k in indices]
+    f, df = partial_sums(instruction, members, ctrl)
+    return f, df, [resident['fidelities'][k].cache_state() for k in indices]
+
+
 class ParallelEnsembleFidelity(FidelityBase):
     """
     With a given Ensemble, and a FidelityComputer,
-    calculate the average fidelity over the whole ensemble.
+    calculate the average fidelity over the whole ensemble,
+    weighted with ensemble.weights.
+
+    With persistent=True, the fidelities are installed once in every pool
+    worker and stay resident there, so only the controls are sent and only
+    the partial sums of f and df come back. Otherwise, the fidelities are
+    sent to the pool (and back) on every call.
+
+    The number of processes (unless given), and the threads each of them uses
+    are given by config (a ParallelConfig, by default one process per core).
     """
 
-    def __init__(self, ensemble, fidelity, **params):
+    def __init__(self, ensemble, fidelity, persistent=False, processes=None, config=None,
+                 **params):
         super(ParallelEnsembleFidelity, self).__init__(ensemble)
+        self.config = config or ParallelConfig(workers=processes)
         self.fidelities = [fidelity(sys, **params) for sys in ensemble.systems]
-        self.pool = mp.Pool()
+        self.config.configure_systems(self.fidelities)
+        self.weights = np.asarray(ensemble.weights)
+        self.persistent = persistent
+        self.processes = processes or self.config.workers
+
+        if persistent:
+            self.states = [fid.cache_state() for fid in self.fidelities]
+            self.pool = mp.Pool(self.processes, initializer=initialize_worker,
+                                initargs=(self.config, self.fidelities, self.weights))
+        else:
+            self.pool = mp.Pool(self.processes, initializer=initialize_worker,
+                                initargs=(self.config,))
+
+
+    def _run_resident(self, instruction, controls_and_t):
+        # A chunk may end up on any worker, so the truncation (in particular nz)
+        # found for each member is kept here and passed along to start the next
+        # computation from
+        indices = [chunk for chunk in chunks(range(len(self.fidelities)), self.processes) if chunk]
+        tasks = [[instruction, chunk, [self.states[k] for k in chunk], controls_and_t]
+                 for chunk in indices]
+        fs, dfs, states = zip(*self.pool.map(run_resident, tasks))
+
+        for chunk, chunk_states in zip(indices, states):
+            for k, state in zip(chunk, chunk_states):
+                self.states[k] = state
+        return np.sum(fs, axis=0), np.sum(dfs, axis=0)
+
 
+    def _f(self, controls_and_t):
+        if self.persistent:
+            return self._run_resident('f', controls_and_t)[0]
 
-    def f(self, controls_and_t):
         self.dispatch_f_to_pool(controls_and_t)
-        f = np.mean([fid.f(controls_and_t) for fid in self.fidelities])
+        f = np.dot(self.weights, [fid.f(controls_and_t) for fid in self.fidelities])
         return f
 
 
-    def df(self, controls_and_t):
+    def _df(self, controls_and_t):
+        if self.persistent:
+            return self._run_resident('df', controls_and_t)[1]
+
         self.dispatch_df_to_pool(controls_and_t)
-        df = np.mean([fid.df(controls_and_t) for fid in self.fidelities], axis=0)
+        df = np.dot(self.weights, [fid.df(controls_and_t) for fid in self.fidelities])
         return df
 
 
+    def _value_and_grad(self, controls_and_t):
+        if self.persistent:
+            return self._run_resident('value_and_grad', controls_and_t)
+
+        items = [[fid, controls_and_t] for fid in self.fidelities]
+        self.fidelities, fs, dfs = zip(*self.pool.map(run_value_and_grad, items))
+        self.fidelities = list(self.fidelities)
+        return np.dot(self.weights, fs), np.dot(self.weights, dfs)
+
+
+    def _f_batch(self, controls):
+        if self.persistent:
+            return self._run_resident('f_batch', controls)[0]
+
+        return np.dot(self.weights, self._dispatch_batch_to_pool('f_batch', controls))
+
+
+    def _df_batch(self, controls):
+        if self.persistent:
+            return self._run_resident('df_batch', controls)[1]
+
+        return np.tensordot(self.weights, self._dispatch_batch_to_pool('df_batch', controls), axes=1)
+
+
+    def _value_and_grad_batch(self, controls):
+        if self.persistent:
+            return self._run_resident('value_and_grad_batch', controls)
+
+        items = [[fid, controls] for fid in self.fidelities]
+        self.fidelities, fs, dfs = zip(*self.pool.map(run_value_and_grad_batch, items))
+        self.fidelities = list(self.fidelities)
+        return np.dot(self.weights, fs), np.tensordot(self.weights, dfs, axes=1)
+
+
+    def _hessp(self, controls_and_t, v):
+        if self.persistent:
+            return self._run_resident('hessp', (controls_and_t, v))[1]
+
+        items = [[fid, controls_and_t, v] for fid in self.fidelities]
+        self.fidelities, hvs = zip(*self.pool.map(run_hessp, items))
+        self.fidelities = list(self.fidelities)
+        return np.dot(self.weights, hvs)
+
+
+    def cache_state(self, eigensystems=False):
+        # Resident members can end up in any worker, so only their truncation is kept
+        if self.persistent:
+            return [dict(state) for state in self.states]
+        return [fid.cache_state(eigensystems) for fid in self.fidelities]
+
+
+    def restore_cache(self, state):
+        if self.persistent:
+            # Eigensystems are dropped, see cache_state
+            self.states = [dict((key, value) for key, value in member_state.items()
+                                if key not in ('controls', 't', 'fixed_system'))
+                           for member_state in state]
+        else:
+            for fid, member_state in zip(self.fidelities, state):
+                fid.restore_cache(member_state)
+        self.forget()
+
+
+    def _dispatch_batch_to_pool(self, instruction, controls):
+        items = [[fid, controls, instruction] for fid in self.fidelities]
+        self.fidelities, values = zip(*self.pool.map(run_batch, items))
+        self.fidelities = list(self.fidelities)
+        return np.array(values)
+
+
     def dispatch_f_to_pool(self, controls_and_t):
         items = [[fid, controls_and_t] for fid in self.fidelities]
         self.fidelities = self.pool.map(run_fid, items)
@@ -49,4 +221,9 @@ class ParallelEnsembleFidelity(FidelityBase):
 
     def dispatch_df_to_pool(self, controls_and_t):
         items = [[fid, controls_and_t] for fid in self.fidelities]
-        self.fidelities = self.pool.map(run_dfid, items)
\ No newline at end of file
+        self.fidelities = self.pool.map(run_dfid, items)
+
+
+    def kill(self):
+        """ Terminate the pool """
+        self.pool.terminate()
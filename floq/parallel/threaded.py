@@ -0,0 +1,90 @@
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from floq.optimization.fidelity import FidelityBase
+from floq.parallel.worker import chunks, partial_sums
+from floq.parallel.config import ParallelConfig
+
+
+def run_chunk(task):
+    return partial_sums(*task)
+
+
+class ThreadedEnsembleFidelity(FidelityBase):
+    """
+    With a given Ensemble, and a FidelityComputer,
+    calculate the average fidelity over the whole ensemble,
+    weighted with ensemble.weights, using a pool of nthreads threads.
+
+    All fidelities live in one address space, so nothing is pickled or copied,
+    and cached state stays with its member. This relies on the numerical
+    kernels (numba with nogil, LAPACK) releasing the GIL.
+
+    The number of worker threads (unless given), and the threads each of them
+    uses for du and BLAS are given by config (a ParallelConfig, by default
+    one worker thread per core). To avoid oversubscription, BLAS is limited
+    to config.threads threads during evaluations (see ParallelConfig.limits,
+    which logs a warning if it cannot find a BLAS library to limit).
+    """
+
+    def __init__(self, ensemble, fidelity, nthreads=None, config=None, **params):
+        super(ThreadedEnsembleFidelity, self).__init__(ensemble)
+        self.config = config or ParallelConfig(workers=nthreads)
+        self.fidelities = [fidelity(sys, **params) for sys in ensemble.systems]
+        self.config.configure_systems(self.fidelities)
+        self.weights = np.asarray(ensemble.weights)
+        self.nthreads = nthreads or self.config.workers
+
+        members = zip(self.weights, self.fidelities)
+        self.members_chunked = [chunk for chunk in chunks(members, self.nthreads) if chunk]
+        self.pool = ThreadPool(self.nthreads)
+
+
+    def _run(self, instruction, controls_and_t):
+        tasks = [[instruction, chunk, controls_and_t] for chunk in self.members_chunked]
+        with self.config.limits():
+            fs, dfs = zip(*self.pool.map(run_chunk, tasks))
+        return np.sum(fs, axis=0), np.sum(dfs, axis=0)
+
+
+    def _f(self, controls_and_t):
+        return self._run('f', controls_and_t)[0]
+
+
+    def _df(self, controls_and_t):
+        return self._run('df', controls_and_t)[1]
+
+
+    def _value_and_grad(self, controls_and_t):
+        return self._run('value_and_grad', controls_and_t)
+
+
+    def _f_batch(self, controls):
+        return self._run('f_batch', controls)[0]
+
+
+    def _df_batch(self, controls):
+        return self._run('df_batch', controls)[1]
+
+
+    def _value_and_grad_batch(self, controls):
+        return self._run('value_and_grad_batch', controls)
+
+
+    def _hessp(self, controls_and_t, v):
+        return self._run('hessp', (controls_and_t, v))[1]
+
+
+    def cache_state(self, eigensystems=False):
+        return [fid.cache_state(eigensystems) for fid in self.fidelities]
+
+
+    def restore_cache(self, state):
+        for fid, member_state in zip(self.fidelities, state):
+            fid.restore_cache(member_state)
+        self.forget()
+
+
+    def kill(self):
+        """ Terminate the thread pool """
+        self.pool.terminate()
+
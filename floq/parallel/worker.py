@@ -1,7 +1,11 @@
 import logging
+import time
+import traceback
 import multiprocessing as mp
 import numpy as np
 from floq.optimization.fidelity import FidelityBase
+import floq.errors as er
+from floq.parallel.config import ParallelConfig
 
 
 
@@ -9,64 +13,302 @@ class FidelityMaster(FidelityBase):
     """
     With a given Ensemble, and a FidelityComputer,
     calculate the average fidelity over the whole ensemble
-    by distributing the work onto nworker sub-processes, which
+    (weighted with ensemble.weights) by distributing the work onto nworker sub-processes, which
     should run in parallel if there are enough cores available.
 
+    Controls are broadcast through a shared-memory buffer, and every worker
+    writes its partial f and df into its own row of a shared result array,
+    so only a short instruction and an acknowledgement travel through the pipes.
+    The buffers are sized on the first evaluation, to hold batches (see f_batch)
+    of up to `batch` rows; the workers are respawned whenever the number of controls
+    changes, or a batch has more rows than fit into the buffers. The cache states
+    of the members (including their eigensystems) are then collected from the
+    workers, and handed on to the new ones.
+
+    Members are scheduled dynamically: every worker holds the whole ensemble,
+    and before each evaluation the members are distributed according to the
+    cost measured in the previous one (see schedule), preferring the worker
+    that computed a member last, so that cached state like nz stays put.
+    A worker that runs out of members steals from the tail of the longest queue.
+
+    Workers are watched while they compute: a worker that dies, or that spends
+    more than timeout seconds on a single member, is (killed and) respawned,
+    and the request is retried up to retries times. Failures are recorded
+    in self.failures as WorkerErrors, and raised once the retries are exhausted.
+    Along with their acknowledgements, the workers report the truncation of the
+    members they computed (see FidelityBase.cache_state), which a respawned
+    worker starts from.
+    Exceptions raised by the fidelities are raised as RemoteError without retrying.
+
+    Hessian-vector products (see FidelityBase.hessp) are the sums of those of the
+    members, for which the controls and the vector take up two rows of the buffers.
+
+    How many threads each worker uses (for du and in BLAS), and whether it is
+    pinned, is given by config (a ParallelConfig, by default one thread per worker).
+
     Note: After use, the FidelityMaster should be forced to kill the child processes
     by calling the kill() method. It is recommended to use a new FidelityMaster thereafter.
     """
 
-    def __init__(self, nworker, ensemble, fidelity, **params):
+    def __init__(self, nworker, ensemble, fidelity, timeout=None, retries=2, config=None,
+                 batch=1, **params):
         super(FidelityMaster, self).__init__(ensemble)
+        self.config = config or ParallelConfig(workers=nworker)
         self.fidelities = [fidelity(sys, **params) for sys in ensemble.systems]
+        self.config.configure_systems(self.fidelities)
+        self.weights = np.asarray(ensemble.weights, dtype='float64')
         self.n = len(ensemble.systems)
         self.nworker = nworker
+        self.free_t = 't' in params and params['t'] is None  # df has an entry for t
 
-        self.fidelities_chunked = chunks(self.fidelities, nworker)
-        self._make_workers()
+        self.timeout = timeout
+        self.retries = retries
+        self.heartbeat = 0.1  # interval at which the workers are checked
+        self.failures = []
+
+        self.workers = []
+        self.ins = []
+        self.outs = []
+        self.npm = None
+        self.capacity = 0
+        self.batch = batch
+        self.states = {}  # the last reported truncation of each member
+        self._make_schedule_buffers()
+
+
+    def _make_schedule_buffers(self):
+        # Per-member costs and owners outlive the workers, queues are refilled every call
+        self.lock = mp.Lock()
+        self.costs_buffer = mp.RawArray('d', self.n)
+        self.owners_buffer = mp.RawArray('l', self.n)
+        self.queue_buffer = mp.RawArray('l', self.n)
+        self.heads_buffer = mp.RawArray('l', self.nworker)
+        self.tails_buffer = mp.RawArray('l', self.nworker)
+        self.beats_buffer = mp.RawArray('d', self.nworker)
+
+        self.costs = np.frombuffer(self.costs_buffer)
+        self.owners = np.frombuffer(self.owners_buffer, dtype='l')
+        self.queue = np.frombuffer(self.queue_buffer, dtype='l')
+        self.heads = np.frombuffer(self.heads_buffer, dtype='l')
+        self.tails = np.frombuffer(self.tails_buffer, dtype='l')
+        self.beats = np.frombuffer(self.beats_buffer)
+
+        for i, members in enumerate(chunks(range(self.n), self.nworker)):
+            self.owners[members] = i
+
+
+    def _make_buffers(self, npm, capacity):
+        # Shared memory has to exist before the workers are forked,
+        # it holds up to capacity rows of controls, and of f and df per worker
+        self.npm = npm
+        self.capacity = capacity
+        self.controls_buffer = mp.RawArray('d', capacity*npm)
+        self.results_buffer = mp.RawArray('d', self.nworker*capacity*(npm+1))
+        self.controls = np.frombuffer(self.controls_buffer).reshape(capacity, npm)
+        self.results = np.frombuffer(self.results_buffer).reshape(self.nworker, capacity, npm+1)
 
 
     def _make_workers(self):
         # Spawn the workers, set up pipes to talk to them
-        in_pipes = [mp.Pipe() for i in xrange(self.nworker)]
-        out_pipes = [mp.Pipe() for i in xrange(self.nworker)]
+        self.workers = [None]*self.nworker
+        self.ins = [None]*self.nworker
+        self.outs = [None]*self.nworker
 
-        self.workers = []
         logging.info('Attempting to spawn workers')
         for i in xrange(self.nworker):
-            worker = FidelityWorker(self.fidelities_chunked[i], in_pipes[i][1], out_pipes[i][1])
-            worker.start()
-            self.workers.append(worker)
+            self._spawn(i)
         logging.info('Successfully spawned workers')
 
-        self.ins = [in_pipes[i][0] for i in xrange(self.nworker)]
-        self.outs = [out_pipes[i][0] for i in xrange(self.nworker)]
+
+    def _spawn(self, i):
+        in_pipe = mp.Pipe()
+        out_pipe = mp.Pipe()
+
+        worker = FidelityWorker(self.fidelities, self.weights, in_pipe[1], out_pipe[1],
+                                self.controls_buffer, self.results_buffer, i, self.config,
+                                shape=(self.capacity, self.npm))
+        worker.share_schedule(self.lock, self.queue_buffer, self.heads_buffer,
+                              self.tails_buffer, self.costs_buffer, self.owners_buffer,
+                              self.beats_buffer)
+        worker.start()
+
+        self.workers[i] = worker
+        self.ins[i] = in_pipe[0]
+        self.outs[i] = out_pipe[0]
+
+
+    def _fill_queues(self):
+        """ Write the schedule for the next evaluation into the shared queues """
+        start = 0
+        for i, members in enumerate(schedule(self.costs, self.owners, self.nworker)):
+            self.queue[start:start+len(members)] = members
+            self.heads[i] = start
+            self.tails[i] = start + len(members)
+            start += len(members)
+
+
+    def _run(self, instruction, controls):
+        """
+        Write the controls (one vector per row) to shared memory, wake the workers
+        with the instruction and wait until each of them has written its partial result.
+        Returns the sum of f and df over the workers, one row per row of controls.
+        """
+        controls = np.atleast_2d(np.asarray(controls, dtype='float64'))
+        rows, npm = controls.shape
+        if self.npm != npm or self.capacity < rows:
+            # Grow geometrically, so that growing batches rarely force a respawn
+            capacity = max(self.capacity, self.batch)
+            if rows > capacity:
+                capacity = max(rows, 2*capacity)
+            self._respawn_all(npm, capacity)
+
+        self.controls[:rows] = controls
+        for attempt in xrange(self.retries+1):
+            self._fill_queues()
+            self.beats[:] = time.time()
+            for pipe in self.ins:
+                pipe.send([instruction, rows])
+
+            failures = self._wait()
+            if not failures:
+                return np.sum(self.results[:, :rows], axis=0)
+
+            self.failures.extend(failures)
+            self._restore_templates()
+            for failure in failures:
+                logging.warning(str(failure) + ', respawning')
+                self._spawn(failure.worker)
+
+        raise failures[0]
+
+
+    def _respawn_all(self, npm, capacity):
+        # New workers are forked from self.fidelities, so the caches of the
+        # current workers are moved there first
+        if self.workers:
+            state = self.cache_state(eigensystems=True)
+            self.kill()
+            for fid, member_state in zip(self.fidelities, state):
+                fid.restore_cache(member_state)
+            self.states = {}
+
+        self._make_buffers(npm, capacity)
+        self._make_workers()
+
+
+    def _restore_templates(self):
+        # Start respawned workers from the last truncation reported for each member
+        for k, state in self.states.items():
+            self.fidelities[k].restore_cache(state)
+
+
+    def _wait(self):
+        """
+        Wait for the acknowledgements of all workers, checking every
+        self.heartbeat seconds whether the pending ones are still alive
+        and busy with a member for less than self.timeout.
+
+        Returns the WorkerErrors for the workers that failed, and raises
+        a RemoteError if a fidelity raised an exception.
+        """
+        pending = range(self.nworker)
+        failures = []
+        remote = None
+
+        while pending:
+            i = pending[0]
+            if self.outs[i].poll(self.heartbeat):
+                reply = self.outs[i].recv()
+                if isinstance(reply, dict):
+                    self.states.update(reply)
+                else:
+                    remote = er.RemoteError(i, reply)
+                pending.remove(i)
+                continue
+
+            now = time.time()
+            for j in list(pending):
+                worker = self.workers[j]
+                if not worker.is_alive():
+                    failures.append(er.WorkerDiedError(j, worker.exitcode))
+                    pending.remove(j)
+                elif self.timeout is not None and now - self.beats[j] > self.timeout:
+                    worker.terminate()
+                    worker.join()
+                    failures.append(er.WorkerTimeoutError(j, self.timeout))
+                    pending.remove(j)
+
+        if remote is not None:
+            raise remote
+        return failures
 
 
     def _f(self, controls_and_t):
         """ Compute the average fidelity of the ensemble """
-        for pipe in self.ins:
-            pipe.send(['f', controls_and_t])
-
-        tmp = []
-        for pipe in self.outs:
-            tmp.append(pipe.recv())
-        mf = np.sum(tmp)/self.n
-        # logging.info('f=%f' % mf)
-        # logging.info('Controls: %s' % str(controls_and_t))
-        return mf
+        return self._run('f', controls_and_t)[0, 0]
 
 
     def _df(self, controls_and_t):
         """ Compute the average gradient of the fidelity of the ensemble """
-        for pipe in self.ins:
-            pipe.send(['df', controls_and_t])
+        return self._run('df', controls_and_t)[0, 1:self._gradient_end()]
+
+
+    def _value_and_grad(self, controls_and_t):
+        """ Compute the average fidelity and its gradient in one round-trip """
+        total = self._run('value_and_grad', controls_and_t)[0]
+        return total[0], total[1:self._gradient_end()]
 
-        tmp = []
+
+    def _f_batch(self, controls):
+        """ Compute the average fidelity for each row of controls in one round-trip """
+        return self._run('f', controls)[:, 0]
+
+
+    def _df_batch(self, controls):
+        """ Compute the average gradient for each row of controls in one round-trip """
+        return self._run('df', controls)[:, 1:self._gradient_end()]
+
+
+    def _value_and_grad_batch(self, controls):
+        """ Compute the average fidelity and gradient for each row of controls in one round-trip """
+        totals = self._run('value_and_grad', controls)
+        return totals[:, 0], totals[:, 1:self._gradient_end()]
+
+
+    def _hessp(self, controls_and_t, v):
+        """ Compute the average product of the Hessians with v in one round-trip """
+        return self._run('hessp', [controls_and_t, v])[0, 1:self._gradient_end()]
+
+
+    def _gradient_end(self):
+        # With a mask, the workers only fill in the first len(mask) components of df
+        # (and the one for t, if it is optimised)
+        if self.mask is None:
+            return 1 + self.npm
+        return 1 + len(self.mask) + self.free_t
+
+
+    def cache_state(self, eigensystems=False):
+        """ Collect the cache states of the members from the workers that own them """
+        states = [fid.cache_state(eigensystems) for fid in self.fidelities]
+        for pipe in self.ins:
+            pipe.send(['cache', eigensystems])
         for pipe in self.outs:
-            tmp.append(pipe.recv())
+            for k, state in pipe.recv().items():
+                states[k] = state
+        return states
+
 
-        return np.sum(tmp, axis=0)/self.n
+    def restore_cache(self, state):
+        """ Restore the cache states of the members, in every worker """
+        for fid, member_state in zip(self.fidelities, state):
+            fid.restore_cache(member_state)
+        self.states = {}
+        for pipe in self.ins:
+            pipe.send(['restore', state])
+        for pipe in self.outs:
+            pipe.recv()
+        self.forget()
 
 
     def kill(self):
@@ -75,46 +317,209 @@ class FidelityMaster(FidelityBase):
             pipe.send(None)  # tell workers to stop run()
         for worker in self.workers:
             worker.terminate()  # shut them down
+            worker.join()
+        self.workers = []
+        self.ins = []
+        self.outs = []
+        self.npm = None
+        self.capacity = 0
 
 
 
 class FidelityWorker(mp.Process):
     """
     Wraps a list of FidelityComputers, performing their computations in a separate
-    process. Communication with the 'master' process is done via Pipes. F and dF will
-    be added up locally, since only averages are used in the optimisation. This reduces
-    the amount of data to be communicated between processes.
+    process. The controls are read from a shared buffer, and F and dF are added up
+    locally (weighted with the ensemble weights of the members) and written
+    into row i of the shared result array, since only averages are used in
+    the optimisation. The pipes only carry instructions and acknowledgements.
+
+    Which members are computed is decided by the shared queues: the worker
+    first works through its own queue, then steals from the others.
+    A member is computed for all rows of the controls before the next one
+    is taken (for hessp, the two rows hold the controls and the vector,
+    and the product is written into the df of the first row).
+    The time spent on each member is recorded for the next schedule,
+    and the time a member is finished at as heartbeat. The acknowledgement
+    holds the cache states (without eigensystems) of the members computed.
+    If a fidelity raises an exception, its traceback is sent instead of the
+    acknowledgement.
 
     Note: the start() methods needs to be run before computations are performed.
     """
 
-    def __init__(self, fids, pipe_in, pipe_out):
+    def __init__(self, fids, weights, pipe_in, pipe_out, controls_buffer, results_buffer, i,
+                 config=None, shape=None):
         super(FidelityWorker, self).__init__()
+        self.config = config or ParallelConfig(workers=1)
+        self.shape = shape or (1, len(controls_buffer))
         self.pipe_in = pipe_in
         self.pipe_out = pipe_out
         self.fids = fids
+        self.weights = weights
+        self.controls_buffer = controls_buffer
+        self.results_buffer = results_buffer
+        self.i = i
         logging.info('Worker initialised with ' + str(len(self.fids)) + ' fidelities')
 
 
+    def share_schedule(self, lock, queue_buffer, heads_buffer, tails_buffer,
+                       costs_buffer, owners_buffer, beats_buffer):
+        self.lock = lock
+        self.queue_buffer = queue_buffer
+        self.heads_buffer = heads_buffer
+        self.tails_buffer = tails_buffer
+        self.costs_buffer = costs_buffer
+        self.owners_buffer = owners_buffer
+        self.beats_buffer = beats_buffer
+
+
+    def _next(self, queue, heads, tails):
+        """ Pop a member from the own queue, or steal one from the longest other queue """
+        with self.lock:
+            if heads[self.i] < tails[self.i]:
+                heads[self.i] += 1
+                return queue[heads[self.i]-1]
+
+            victim = np.argmax(tails - heads)
+            if tails[victim] > heads[victim]:
+                tails[victim] -= 1
+                return queue[tails[victim]]
+
+            return None
+
+
     def run(self):
         # When this is run, the Worker starts listening on its in_pipe,
         # it stops when None is sent through the pipe.
+        self.config.apply(self.i)
+        capacity, npm = self.shape
+        controls = np.frombuffer(self.controls_buffer).reshape(capacity, npm)
+        result = np.frombuffer(self.results_buffer).reshape(-1, capacity, npm+1)[self.i]
+
+        queue = np.frombuffer(self.queue_buffer, dtype='l')
+        heads = np.frombuffer(self.heads_buffer, dtype='l')
+        tails = np.frombuffer(self.tails_buffer, dtype='l')
+        costs = np.frombuffer(self.costs_buffer)
+        owners = np.frombuffer(self.owners_buffer, dtype='l')
+        beats = np.frombuffer(self.beats_buffer)
+
         while True:
             msg = self.pipe_in.recv()
-            if msg is not None:
-                instruction, ctrl = msg[0], msg[1]
-                if instruction == 'f':
-                    f = np.sum([fid.f(ctrl) for fid in self.fids])
-                    self.pipe_out.send(f)
+            if msg is not None and msg[0] == 'cache':
+                # Only the owner of a member holds its most recent state
+                self.pipe_out.send(dict((k, self.fids[k].cache_state(msg[1]))
+                                        for k in np.flatnonzero(owners == self.i)))
+
+            elif msg is not None and msg[0] == 'restore':
+                for fid, state in zip(self.fids, msg[1]):
+                    fid.restore_cache(state)
+                self.pipe_out.send(True)
+
+            elif msg is not None:
+                instruction, rows = msg
+                # Copy, so that memoising fidelities don't hold a view of the buffer
+                ctrl = np.copy(controls[:rows])
+                result[:rows] = 0.0
+
+                computed = {}
+                try:
+                    k = self._next(queue, heads, tails)
+                    while k is not None:
+                        start = time.time()
+                        fid, w = self.fids[k], self.weights[k]
+                        if instruction == 'hessp':
+                            hv = fid.hessp(ctrl[0], ctrl[1])
+                            result[0, 1:hv.size+1] += w*hv
+                        else:
+                            for r in xrange(rows):
+                                if instruction == 'f':
+                                    result[r, 0] += w*fid.f(ctrl[r])
+                                elif instruction == 'value_and_grad':
+                                    f, df = fid.value_and_grad(ctrl[r])
+                                    result[r, 0] += w*f
+                                    result[r, 1:df.size+1] += w*df
+                                else:
+                                    df = fid.df(ctrl[r])
+                                    result[r, 1:df.size+1] += w*df
+                        beats[self.i] = time.time()
+                        costs[k] = beats[self.i] - start
+                        owners[k] = self.i
+                        computed[k] = fid.cache_state()
+                        k = self._next(queue, heads, tails)
+                except Exception:
+                    self.pipe_out.send(traceback.format_exc())
                 else:
-                    df = np.sum([fid.df(ctrl) for fid in self.fids], axis=0)
-                    self.pipe_out.send(df)
+                    self.pipe_out.send(computed)
 
             else:
                 break
 
 
 
+def partial_sums(instruction, members, ctrl):
+    """
+    Compute the weighted sums of f and/or df over members, a list of
+    (weight, fidelity) pairs, at the controls ctrl -- or, for the instructions
+    f_batch, df_batch and value_and_grad_batch, at each row of ctrl,
+    returning arrays of sums. For hessp, ctrl is a pair (controls, v),
+    and the sum of the Hessian-vector products is returned in place of df.
+    """
+
+    f = 0.0
+    df = 0.0
+    for w, fid in members:
+        if instruction == 'f':
+            f += w*fid.f(ctrl)
+        elif instruction == 'df':
+            df += w*fid.df(ctrl)
+        elif instruction == 'f_batch':
+            f += w*np.array([fid.f(c) for c in ctrl])
+        elif instruction == 'df_batch':
+            df += w*np.array([fid.df(c) for c in ctrl])
+        elif instruction == 'hessp':
+            df += w*fid.hessp(*ctrl)
+        elif instruction == 'value_and_grad_batch':
+            fks, dfks = zip(*[fid.value_and_grad(c) for c in ctrl])
+            f += w*np.array(fks)
+            df += w*np.array(dfks)
+        else:
+            fk, dfk = fid.value_and_grad(ctrl)
+            f += w*fk
+            df += w*dfk
+    return f, df
+
+
+
+def schedule(costs, owners, nworker):
+    """
+    Distribute members with the given costs onto nworker workers,
+    greedily placing the most expensive members first (LPT).
+    A member stays with its previous owner unless that would push the owner
+    beyond an even share of the total cost.
+
+    Without measured costs, the members are split evenly by count.
+
+    Returns a list of member indices per worker, most expensive first.
+    """
+
+    if not np.any(costs):
+        return chunks(range(len(costs)), nworker)
+
+    share = np.sum(costs)/nworker
+    load = np.zeros(nworker)
+    assigned = [[] for i in xrange(nworker)]
+    for k in np.argsort(-np.asarray(costs), kind='mergesort'):
+        worker = owners[k]
+        if load[worker] + costs[k] > share:
+            worker = np.argmin(load)
+        load[worker] += costs[k]
+        assigned[worker].append(k)
+
+    return assigned
+
+
+
 def chunks(l, n):
     """
     Split list l into n chunks as uniformly as possible.
@@ -1,3 +1,7 @@
+import logging
+import numpy as np
+
+
 class EnsembleBase(object):
     """
     Specifies an ensemble of ParametricSystems.
@@ -8,8 +12,101 @@ class EnsembleBase(object):
     This is base class defining the API and cannot be used, it needs to be sub-classed,
     and a sub-class needs to provide a property called 'systems'.
 
+    Optionally, a sub-class can provide a property 'weights' if the systems
+    should not enter ensemble averages with equal weight.
+
+    If the systems support set_ncomp (see ParametricSystemBase),
+    set_ncomp(ncomp) changes the number of control components of all of them.
     """
 
     @property
     def systems(self):
         raise NotImplementedError
+
+    @property
+    def weights(self):
+        # Weights of the systems in ensemble averages, summing to one
+        n = len(self.systems)
+        return np.ones(n)/n
+
+
+    def set_ncomp(self, ncomp):
+        for system in self.systems:
+            system.set_ncomp(ncomp)
+
+
+
+class CompressedEnsemble(EnsembleBase):
+    """
+    An ensemble in which members of another ensemble whose parameters agree
+    to within a given resolution are merged into one weighted representative.
+
+    The members are binned on a grid in parameter space, with spacing resolution
+    (a number, or one number per parameter). From each occupied bin,
+    the member closest to the mean of the bin is kept as representative
+    and inherits the summed weight of the bin.
+
+    Attributes:
+        ensemble: the original ensemble
+        representatives: indices of the representatives in ensemble.systems
+        compression_ratio: number of original members per representative
+        deviations: (n, nparameters) array, the distance in parameter space between
+                    each original member and its representative
+    """
+
+    def __init__(self, ensemble, parameters, resolution):
+        """
+        Compress an ensemble, given
+        - ensemble: the EnsembleBase to be compressed
+        - parameters: (n, nparameters) array, the parameters of each member
+        - resolution: bin width (one for all parameters, or a vector of nparameters)
+        """
+        self.ensemble = ensemble
+
+        parameters = np.asarray(parameters, dtype=np.float64)
+        if parameters.ndim == 1:
+            parameters = parameters[:, np.newaxis]
+        scaled = parameters/resolution
+
+        member_weights = np.asarray(ensemble.weights, dtype=np.float64)
+        bins, membership = np.unique(np.round(scaled), axis=0, return_inverse=True)
+
+        nbins = bins.shape[0]
+        self.representatives = np.empty(nbins, dtype=int)
+        self._weights = np.empty(nbins)
+        for b in xrange(nbins):
+            members = np.flatnonzero(membership == b)
+            w = member_weights[members]
+            centre = np.average(scaled[members], axis=0, weights=w)
+            closest = np.argmin(np.sum((scaled[members]-centre)**2, axis=1))
+
+            self.representatives[b] = members[closest]
+            self._weights[b] = np.sum(w)
+
+        self._member_weights = member_weights
+        self.deviations = np.abs(parameters - parameters[self.representatives[membership]])
+        self.compression_ratio = float(parameters.shape[0])/nbins
+
+        all_systems = ensemble.systems
+        self._systems = [all_systems[i] for i in self.representatives]
+
+        logging.info('Compressed ensemble from %i to %i members (ratio %.2f)' %
+                     (parameters.shape[0], nbins, self.compression_ratio))
+
+
+    @property
+    def systems(self):
+        return self._systems
+
+    @property
+    def weights(self):
+        return self._weights
+
+
+    def error_bound(self, sensitivities):
+        """
+        Bound the error in the ensemble average introduced by the compression,
+        given the sensitivities of the fidelity to each parameter, i.e. the constants L_j with
+        |f(p) - f(p')| <= sum_j L_j |p_j - p'_j|.
+        """
+        return np.dot(self._member_weights, np.dot(self.deviations, sensitivities))
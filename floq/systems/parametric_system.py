@@ -16,11 +16,38 @@ class ParametricSystemBase(object):
         _dhf(controls): returning the derivative of the Hamiltonian
                         with the first index signifying the control parameter.
 
+    Optionally, a subclass can provide
+        _dhf_parameters(controls): returning the derivative of the Hamiltonian
+                                   with respect to uncertain parameters of the
+                                   system (which should enter it linearly), with
+                                   the first index signifying the parameter,
+        _d2hf_parameters_controls(controls): returning the mixed second derivatives
+                                             of the Hamiltonian with respect to the
+                                             parameters and the controls, if they don't vanish,
+        set_ncomp(ncomp): if the controls are the Fourier components of a pulse,
+                          changing their number (self.ncomp) on the existing system,
+                          such that the old controls are the first ones of the new.
+
 
     Methods:
         u(controls, t)
-        du(controls, t),
+        du(controls, t, mask),
     which implement basic caching and automatically keeps self.nz updated.
+    If a mask (indices, or booleans over the controls) is given, or self.mask
+    is set, du only computes and returns the derivatives with respect to those
+    controls.
+        du_parameters(controls, t): derivative of U with respect to the
+                                    uncertain parameters,
+        d2u_parameters(controls, t): their second derivatives,
+        d2u_parameters_controls(controls, t, mask): the mixed second derivatives
+                                                    with respect to parameters and controls,
+        du_directional(controls, t, v): the derivative of U in the direction v
+                                        of the controls, du.v,
+        d2u_trace_directional(controls, t, v, w): tr(w d/dc (du.v)) for all controls c,
+        cache_state(eigensystem), restore_cache(state): save and restore the truncation
+                                                        (nz, decimals, fixed_nz, and
+                                                        ncomp if it is set), the mask
+                                                        and the last eigensystem.
 
     Attributes:
         nz: (initial) number of Brillouin zones (should be overwritten by subclass)
@@ -28,6 +55,11 @@ class ParametricSystemBase(object):
         sparse: if True, sparse matrix algebra is used (can be overwritten by subclass)
         max_nz: max nz allowed (can be overwritten by subclass)
         decimals: decimals used to check for unitarity (can be overwritten by subclass)
+        threads: number of threads used to compute du (can be overwritten, the
+                 parallel ensemble backends set it to 1 for their members)
+        fixed_nz: if True, nz is not increased to make U unitary (default False)
+        mask: None, or a tuple of the indices of the controls that du is computed for
+              (see control_mask)
     """
 
     def __init__(self, **kwargs):
@@ -38,6 +70,9 @@ class ParametricSystemBase(object):
         self.max_nz = 999
         self.sparse = True
         self.decimals = 10
+        self.threads = 1
+        self.fixed_nz = False
+        self.mask = None
 
         # these should be overwritten by a subclass
         self.nz = 3
@@ -52,6 +87,18 @@ class ParametricSystemBase(object):
         raise NotImplementedError
 
 
+    def _dhf_parameters(self, controls):
+        raise NotImplementedError
+
+
+    def _d2hf_parameters_controls(self, controls):
+        return None
+
+
+    def set_ncomp(self, ncomp):
+        raise NotImplementedError
+
+
     def u(self, controls, t):
         if self._is_cached(controls, t):
             return self._fixed_system.u
@@ -73,7 +120,15 @@ class ParametricSystemBase(object):
             return udot
 
 
-    def du(self, controls, t):
+    def du(self, controls, t, mask=None):
+        mask = self.mask if mask is None else control_mask(mask)
+        if mask is not None:
+            # Only differentiate with respect to the masked controls
+            system = self._evolved(controls, t)
+            if system._du is not None:
+                return system._du[list(mask)]
+            return system.du_for(system.dhf[list(mask)])
+
         if self._is_cached(controls, t):
             return self._fixed_system.du
         else:
@@ -84,6 +139,116 @@ class ParametricSystemBase(object):
             return du
 
 
+    def du_directional(self, controls, t, v):
+        """
+        Compute du.v, the derivative of U in the direction v of the controls.
+        As dK is linear in dhf, it is obtained from the contracted dhf.v alone,
+        at the cost of one slice of du (unless the full du is cached).
+        """
+        system = self._evolved(controls, t)
+        if system._du is not None:
+            return np.tensordot(v, system._du, axes=1)
+        dhf_v = np.tensordot(v, system.dhf, axes=1)
+        return system.du_for(dhf_v[np.newaxis])[0]
+
+
+    def du_parameters(self, controls, t):
+        # Kept with the FixedSystem, so that the penalty of a robust fidelity
+        # and its gradient share it
+        system = self._evolved(controls, t)
+        if system._du_parameters is None:
+            system._du_parameters = system.du_for(self._dhf_parameters(controls))
+        return system._du_parameters
+
+
+    def d2u_parameters(self, controls, t):
+        system = self._evolved(controls, t)
+        dhf_parameters = self._dhf_parameters(controls)
+        return system.d2u_for(dhf_parameters, dhf_parameters)
+
+
+    def d2u_parameters_controls(self, controls, t, mask=None):
+        mask = self.mask if mask is None else control_mask(mask)
+        indices = slice(None) if mask is None else list(mask)
+
+        system = self._evolved(controls, t)
+        d2u = system.d2u_for(self._dhf_parameters(controls), system.dhf[indices])
+
+        d2hf = self._d2hf_parameters_controls(controls)
+        if d2hf is not None:
+            d2hf = d2hf[:, indices]
+            # parameters that multiply the controls contribute
+            # to first order in the mixed derivative of hf
+            n = d2hf.shape[0]*d2hf.shape[1]
+            first_order = system.du_for(d2hf.reshape((n,)+d2hf.shape[2:]))
+            d2u += first_order.reshape(d2u.shape)
+
+        return d2u
+
+
+    def d2u_trace_directional(self, controls, t, v, w):
+        """
+        Compute tr(w d/dc (du.v)) for all controls c, i.e. the second derivatives
+        of U with respect to the controls, contracted with the vector v and
+        traced with the matrix w, at a cost independent of the number of controls.
+        Like d2u_parameters, this assumes that hf is linear in the controls.
+        """
+        system = self._evolved(controls, t)
+        dhf_v = np.tensordot(v, system.dhf, axes=1)
+        return system.d2u_trace_for(system.dhf, dhf_v, w)
+
+
+    def _evolved(self, controls, t):
+        # Return the FixedSystem for the given controls and t,
+        # after U (and therefore the eigensystem) has been computed
+        if not self._is_cached(controls, t):
+            self._set_cached(controls, t)
+
+            self._fixed_system.u  # computes U, and adjusts nz if needed
+            self.nz = self._fixed_system.params.nz
+
+        return self._fixed_system
+
+
+    def cache_state(self, eigensystem=False):
+        """
+        Return the state of the caches as a dict, which can be restored
+        with restore_cache: the truncation (nz, decimals and fixed_nz), and
+        optionally the FixedSystem of the last controls and t, holding
+        the eigensystem of K.
+        """
+        state = {'nz': self.nz, 'decimals': self.decimals, 'fixed_nz': self.fixed_nz,
+                 'mask': self.mask}
+        if getattr(self, 'ncomp', None) is not None:
+            state['ncomp'] = self.ncomp
+        if eigensystem and self._last_controls is not None:
+            state['controls'] = self._last_controls
+            state['t'] = self._last_t
+            state['fixed_system'] = self._fixed_system
+        return state
+
+
+    def restore_cache(self, state):
+        if state.get('ncomp', None) is not None and state['ncomp'] != self.ncomp:
+            self.set_ncomp(state['ncomp'])
+
+        truncation = (self.nz, self.decimals, self.fixed_nz)
+        self.nz = state['nz']
+        self.decimals = state.get('decimals', self.decimals)
+        self.fixed_nz = state.get('fixed_nz', self.fixed_nz)
+        self.mask = state.get('mask', self.mask)
+
+        # Without an eigensystem, the last one is dropped if it was
+        # computed for another truncation
+        if 'fixed_system' in state:
+            self._last_controls = state['controls']
+            self._last_t = state['t']
+            self._fixed_system = state['fixed_system']
+        elif truncation != (self.nz, self.decimals, self.fixed_nz):
+            self._last_controls = None
+            self._last_t = None
+
+
     def _is_cached(self, controls, t):
         if not isinstance(controls, np.ndarray):
             return False
@@ -94,6 +259,12 @@ class ParametricSystemBase(object):
 
 
     def _set_cached(self, controls, t):
+        if self._last_controls is not None and np.array_equal(self._last_controls, controls):
+            # Only t has changed, which leaves the eigensystem of K as it is
+            self._last_t = copy.copy(t)
+            self._fixed_system = self._fixed_system.at_time(t)
+            return
+
         self._last_controls = np.copy(controls)
         self._last_t = copy.copy(t)
 
@@ -102,7 +273,9 @@ class ParametricSystemBase(object):
         self._fixed_system = fs.FixedSystem(hf, dhf, self.nz, self.omega, t,
                                             decimals=self.decimals,
                                             sparse=self.sparse,
-                                            max_nz=self.max_nz)
+                                            max_nz=self.max_nz,
+                                            threads=self.threads,
+                                            fixed_nz=self.fixed_nz)
 
     def heff(self, controls, t):
         u = self.u(controls, t)
@@ -125,6 +298,7 @@ class ParametricSystemWithFunctions(ParametricSystemBase):
         parameters: a data structure that holds parameters for hf and dhf
         (dictionary is probably the best idea)
         """
+        super(ParametricSystemWithFunctions, self).__init__()
         self.hf = hf
         self.dhf = dhf
         self.omega = omega
@@ -137,3 +311,94 @@ class ParametricSystemWithFunctions(ParametricSystemBase):
 
     def _dhf(self, controls):
         return self.dhf(controls, self.parameters, self.omega)
+
+
+
+class FourierControlSystem(ParametricSystemBase):
+    """
+    A system with the Hamiltonian
+    H(t) = h0 + sum_k sum_j (a_kj cos(k omega t) + b_kj sin(k omega t)) hcontrols[j],
+    with k going over ncomp harmonics of omega, i.e. the controls are the Fourier
+    components of the pulse applied to each of the control Hamiltonians hcontrols.
+
+    The controls are ordered by harmonic,
+    [a_11, ..., a_1m, b_11, ..., b_1m, a_21, ...],
+    so there are np = 2*m*ncomp of them, and hf has nc = 2*ncomp+1 components.
+    """
+
+    def __init__(self, h0, hcontrols, ncomp, omega, nz=3):
+        """
+        h0: the static Hamiltonian (dim x dim)
+        hcontrols: the control Hamiltonians (m x dim x dim)
+        ncomp: number of harmonics in the pulse
+        omega: base frequency of the pulse
+        nz: initial number of Brillouin zones
+        """
+        super(FourierControlSystem, self).__init__()
+
+        self.h0 = np.asarray(h0, dtype='complex128')
+        self.hcontrols = np.asarray(hcontrols, dtype='complex128')
+        self.omega = omega
+        self.nz = nz
+        self.set_ncomp(ncomp)
+
+
+    def set_ncomp(self, ncomp):
+        """
+        Change the number of harmonics of the pulse, keeping
+        the meaning of the controls of the first ones (see expand_controls).
+        """
+        self.ncomp = ncomp
+        m = self.hcontrols.shape[0]
+        self.dhf = np.array([self._hf_of(unit, False) for unit in np.eye(2*m*ncomp)])
+        self._last_controls = None
+        self._last_t = None
+
+
+    def _hf(self, controls):
+        return self._hf_of(controls, True)
+
+
+    def _dhf(self, controls):
+        # H is linear in the controls, so dhf is fixed
+        return self.dhf
+
+
+    def _hf_of(self, controls, static):
+        # hf[ncomp+n] is the component of exp(i n omega t)
+        m = self.hcontrols.shape[0]
+        hf = np.zeros((2*self.ncomp+1,) + self.h0.shape, dtype='complex128')
+        if static:
+            hf[self.ncomp] = self.h0
+
+        for k in xrange(1, self.ncomp+1):
+            block = controls[2*m*(k-1):2*m*k]
+            a = np.tensordot(block[:m], self.hcontrols, axes=1)
+            b = np.tensordot(block[m:], self.hcontrols, axes=1)
+            hf[self.ncomp+k] += 0.5*(a - 1j*b)
+            hf[self.ncomp-k] += 0.5*(a + 1j*b)
+
+        return hf
+
+
+
+def control_mask(mask):
+    """
+    Normalise a mask, given as indices or as booleans over the controls,
+    to a tuple of indices (or None, meaning all controls).
+    """
+    if mask is None:
+        return None
+    mask = np.asarray(mask)
+    if mask.dtype == bool:
+        mask = np.flatnonzero(mask)
+    return tuple(int(i) for i in mask)
+
+
+def expand_controls(controls, ncomp, new_ncomp):
+    """
+    Pad controls for ncomp Fourier components with zeros for the components up to
+    new_ncomp, for systems whose controls are ordered by component (see set_ncomp).
+    """
+    per_component = len(controls)//ncomp
+    return np.concatenate((controls, np.zeros(per_component*(new_ncomp-ncomp))))
@@ -0,0 +1,111 @@
+import numpy as np
+from floq.systems.ensemble import EnsembleBase
+from floq.systems.parametric_system import ParametricSystemBase
+
+
+
+class ReducedControlSystem(ParametricSystemBase):
+    """
+    Wraps a ParametricSystem, such that its controls are restricted to a subspace:
+    the controls of the wrapped system are offset + basis.coefficients,
+    and the coefficients are the controls of the ReducedControlSystem.
+
+    dhf is projected onto the basis before du is computed, so the cost
+    of the gradient scales with the number of basis vectors (the columns
+    of basis), instead of the number of controls of the wrapped system.
+
+    If no basis is given, a random orthonormal basis with rank vectors
+    is used (as in CRAB), see random_basis.
+
+    Attributes:
+        system: the wrapped system
+        basis: (np, rank) array, the basis vectors as columns
+        offset: the controls of the wrapped system for vanishing coefficients
+    """
+
+    def __init__(self, system, basis=None, rank=None, offset=None, np_full=None, seed=None):
+        """
+        Wrap system, given either a basis, or the rank of a random basis
+        and the number of controls np_full of the system.
+        """
+        super(ReducedControlSystem, self).__init__()
+
+        if basis is None:
+            basis = random_basis(np_full, rank, seed)
+        self.system = system
+        self.basis = np.asarray(basis, dtype=np.float64)
+        self.offset = np.zeros(self.basis.shape[0]) if offset is None else offset
+
+        self.nz = system.nz
+        self.omega = system.omega
+        self.decimals = system.decimals
+        self.sparse = system.sparse
+        self.max_nz = system.max_nz
+        self.threads = system.threads
+        self.fixed_nz = system.fixed_nz
+
+
+    def full_controls(self, coefficients):
+        """ The controls of the wrapped system, given the coefficients """
+        return self.offset + np.dot(self.basis, coefficients)
+
+
+    def _hf(self, controls):
+        return self.system._hf(self.full_controls(controls))
+
+
+    def _dhf(self, controls):
+        # Project onto the basis (chain rule), before du is computed
+        return np.tensordot(self.basis.T, self.system._dhf(self.full_controls(controls)), axes=1)
+
+
+    def _dhf_parameters(self, controls):
+        return self.system._dhf_parameters(self.full_controls(controls))
+
+
+    def _d2hf_parameters_controls(self, controls):
+        d2hf = self.system._d2hf_parameters_controls(self.full_controls(controls))
+        if d2hf is None:
+            return None
+        return np.tensordot(d2hf, self.basis, axes=([1], [0])).transpose(0, 4, 1, 2, 3)
+
+
+
+class ReducedEnsemble(EnsembleBase):
+    """
+    An ensemble of ReducedControlSystems, wrapping the members of another ensemble
+    with the same basis and offset (see ReducedControlSystem).
+    """
+
+    def __init__(self, ensemble, basis=None, rank=None, offset=None, np_full=None, seed=None):
+        if basis is None:
+            basis = random_basis(np_full, rank, seed)
+        self.ensemble = ensemble
+        self.basis = basis
+        self._systems = [ReducedControlSystem(system, basis, offset=offset)
+                         for system in ensemble.systems]
+
+
+    @property
+    def systems(self):
+        return self._systems
+
+    @property
+    def weights(self):
+        return self.ensemble.weights
+
+
+    def full_controls(self, coefficients):
+        """ The controls of the wrapped ensemble, given the coefficients """
+        return self._systems[0].full_controls(coefficients)
+
+
+
+def random_basis(np_full, rank, seed=None):
+    """
+    A random orthonormal basis of rank vectors in the space of np_full controls,
+    as an (np_full, rank) array.
+    """
+    state = np.random.RandomState(seed)
+    q, r = np.linalg.qr(state.normal(size=(np_full, rank)))
+    return q
@@ -1,5 +1,5 @@
 import numpy as np
-from floq.systems.ensemble import EnsembleBase
+from floq.systems.ensemble import EnsembleBase, CompressedEnsemble
 from floq.systems.parametric_system import ParametricSystemBase
 
 
@@ -44,6 +44,31 @@ class SpinEnsemble(EnsembleBase):
         return self._systems
 
 
+    def set_ncomp(self, ncomp):
+        """
+        Change the number of components of the control pulse of all spins,
+        see SpinSystem.set_ncomp.
+        """
+        super(SpinEnsemble, self).set_ncomp(ncomp)
+        self.ncomp = ncomp
+        self.np = 2*ncomp
+        self.nc = 2*ncomp+1
+
+    @property
+    def parameters(self):
+        # (n, 2) array with the detuning and amplitude of each spin
+        return np.column_stack((self.freqs, self.amps))
+
+
+    def compress(self, resolution):
+        """
+        Merge spins whose detuning and amplitude agree to within
+        resolution (a number, or [freq_resolution, amp_resolution])
+        into weighted representatives, see CompressedEnsemble.
+        """
+        return CompressedEnsemble(self, self.parameters, resolution)
+
+
 
 class RandomisedSpinEnsemble(SpinEnsemble):
     """
@@ -87,6 +112,9 @@ class SpinSystem(ParametricSystemBase):
 
     ncomp implies 2*ncomp = np control parameters,
     and np+1 non-zero Fourier components in Hf.
+
+    The detuning freq and the amplitude amp are its uncertain parameters,
+    in this order.
     """
 
     def __init__(self, ncomp, amp, freq, omega):
@@ -104,6 +132,18 @@ class SpinSystem(ParametricSystemBase):
         self.dhf = dhf(ncomp)  # independent of controls!
 
 
+    def set_ncomp(self, ncomp):
+        """
+        Change the number of components of the control pulse.
+        The controls of the first components keep their meaning,
+        so they can be padded with zeros for the new ones (see expand_controls).
+        """
+        self.ncomp = ncomp
+        self.dhf = dhf(ncomp)
+        self._last_controls = None
+        self._last_t = None
+
+
     def _hf(self, controls):
         # Compute hf, given 2*ncomp control parameters,
         # ordered as follows:
@@ -114,7 +154,20 @@ class SpinSystem(ParametricSystemBase):
 
     def _dhf(self, controls):
         # dHf is independent of the controls, return cached value
-        return self.dhf
+        # (the controls enter attenuated by amp)
+        return self.amp*self.dhf
+
+
+    def _dhf_parameters(self, controls):
+        # Hf is linear in freq and amp
+        dfreq = hf(self.ncomp, 1.0, np.zeros_like(controls))
+        damp = hf(self.ncomp, 0.0, controls)
+        return np.array([dfreq, damp])
+
+
+    def _d2hf_parameters_controls(self, controls):
+        # amp multiplies the controls, freq does not enter with them
+        return np.array([np.zeros_like(self.dhf), self.dhf])
 
 
 
@@ -171,4 +224,20 @@ def dhf(ncomp):
         dhf[i_b, -k-1, :, :] = np.array([[0.0, -0.25],
                                          [0.25, 0.0]])
 
-    return dhf
\ No newline at end of file
+    return dhf
+
+
+def sensitivities(controls, t):
+    """
+    Bound the change of U(t) of a SpinSystem with respect to
+    its detuning and amplitude, given the controls:
+    ||dU/dfreq|| <= t/2 and ||dU/damp|| <= t/2 sum_k sqrt(a_k^2+b_k^2),
+    in the operator norm.
+
+    Since the operator distance changes by at most ||dU||, and the
+    transfer distance by at most 2||dU||, these can be passed
+    (with the appropriate factor) to CompressedEnsemble.error_bound.
+    """
+    a = controls[0::2]
+    b = controls[1::2]
+    return 0.5*t*np.array([1.0, np.sum(np.sqrt(a**2+b**2))])
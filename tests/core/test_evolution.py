@@ -2,10 +2,12 @@ from tests.assertions import CustomAssertions
 import numpy as np
 import tests.rabi as rabi
 import floq.core.spin as spin
+import floq.systems.spins as spins
 import floq.core.evolution as ev
 import floq.helpers.index as h
 import floq.core.fixed_system as fs
 import floq.errors as er
+from mock import patch
 
 
 def generate_fake_spectrum(unique_vals, dim, omega, nz):
@@ -232,3 +234,111 @@ class TestCalculateUdot(CustomAssertions):
         u = ev.calculate_udot(phi, psi, psidot, energies, p).round(3)
 
         self.assertArrayEqual(u, target)
+
+
+class TestThreadedDerivative(CustomAssertions):
+    def setUp(self):
+        controls = np.array([1.2, 0.7, -0.4, 0.9, 0.3, -1.1])
+        self.hf = spins.hf(3, 0.7, controls)
+        self.dhf = spins.dhf(3)
+
+    def test_matches_serial(self):
+        serial = fs.FixedSystem(self.hf, self.dhf, 21, 1.5, 2.3)
+        threaded = fs.FixedSystem(self.hf, self.dhf, 21, 1.5, 2.3, threads=4)
+        self.assertArrayEqual(threaded.du, serial.du, 12)
+
+    def test_more_threads_than_parameters(self):
+        serial = fs.FixedSystem(self.hf, self.dhf, 21, 1.5, 2.3)
+        threaded = fs.FixedSystem(self.hf, self.dhf, 21, 1.5, 2.3, threads=9)
+        self.assertArrayEqual(threaded.du, serial.du, 12)
+
+
+class TestSecondDerivative(CustomAssertions):
+    def setUp(self):
+        self.ncomp = 2
+        self.controls = np.array([1.2, 0.7, -0.4, 0.9])
+        self.system = self.make_system(self.controls)
+        self.system.u
+
+    def make_system(self, controls):
+        hf = spins.hf(self.ncomp, 0.7, controls)
+        dhf = spins.dhf(self.ncomp)
+        return fs.FixedSystem(hf, dhf, 41, 1.5, 2.3)
+
+    def test_matches_finite_differences_of_du(self):
+        s = self.system
+        d2u = ev.get_d2u_from_eigensystem(s.dhf, s.dhf, s._psi, s._vals, s._vecs, s.params)
+
+        h = 1e-5
+        for c in xrange(4):
+            step = h*np.eye(4)[c]
+            fd = (self.make_system(self.controls+step).du
+                  - self.make_system(self.controls-step).du)/(2*h)
+            self.assertArrayEqual(d2u[c], fd, 7)
+
+    def test_is_symmetric(self):
+        s = self.system
+        d2u = ev.get_d2u_from_eigensystem(s.dhf, s.dhf, s._psi, s._vals, s._vecs, s.params)
+        self.assertArrayEqual(d2u, np.transpose(d2u, (1, 0, 2, 3)), 10)
+
+
+class TestSecondDerivativeTrace(CustomAssertions):
+    def setUp(self):
+        controls = np.array([1.2, 0.7, -0.4, 0.9])
+        self.system = fs.FixedSystem(spins.hf(2, 0.7, controls), spins.dhf(2), 41, 1.5, 2.3)
+        self.system.u
+        self.v = np.array([0.3, -1.0, 0.5, 0.2])
+        self.w = np.array([[0.2+0.1j, -0.7], [0.4j, 1.1-0.3j]])
+
+    def trace(self, dhf):
+        s = self.system
+        dhf_v = np.tensordot(self.v, s.dhf, axes=1)
+        return ev.get_d2u_trace_from_eigensystem(dhf, dhf_v, self.w, s._psi, s._vals, s._vecs,
+                                                 s.params)
+
+    def test_matches_contracted_second_derivatives(self):
+        s = self.system
+        d2u = ev.get_d2u_from_eigensystem(s.dhf, s.dhf, s._psi, s._vals, s._vecs, s.params)
+        expected = np.einsum('abxy,b,yx->a', d2u, self.v, self.w)
+        self.assertArrayEqual(self.trace(s.dhf), expected, 10)
+
+    def test_blocks_do_not_grow_with_parameters(self):
+        sizes = []
+        original = ev.second_integral_factors_from_first
+
+        def record(*args, **kwargs):
+            factors = original(*args, **kwargs)
+            sizes.append(factors.size)
+            return factors
+
+        dim, nd = self.system.params.dim, 4*self.system.params.nz_max+1
+        with patch('floq.core.evolution.second_integral_factors_from_first', side_effect=record):
+            with patch('floq.core.evolution.calculate_d2u') as full:
+                traces = self.trace(np.tile(self.system.dhf, (10, 1, 1, 1)))
+
+        self.assertFalse(full.called)
+        self.assertEqual(traces.shape, (40,))
+        self.assertEqual(sizes, [(dim*nd)**2]*dim)
+
+
+
+class TestSecondIntegralFactors(CustomAssertions):
+    def test_degenerate_limit(self):
+        t = 1.3
+        exact = -0.5*t**2*np.exp(-1j*t*0.4)
+        self.assertAlmostEqualWithDecimals(ev.second_integral_factors(0.4, 0.4, 0.4, t), exact, 10)
+
+    def test_continuous(self):
+        close = ev.second_integral_factors(0.4, 0.4+1e-5, 0.9, 1.3)
+        same = ev.second_integral_factors(0.4, 0.4, 0.9, 1.3)
+        self.assertAlmostEqualWithDecimals(close, same, 4)
+
+    def test_from_first_divided_differences(self):
+        t = 1.3
+        x = 0.4
+        y = np.array([0.4, 0.4+1e-9, 0.9, -0.2, 1.7])[:, np.newaxis]
+        z = np.array([0.4, 0.9, 0.9+1e-5, 2.5, -0.2])[np.newaxis, :]
+        factors = ev.second_integral_factors_from_first(x, y, z, ev.divided_differences(x, y, t),
+                                                        ev.divided_differences(x, z, t),
+                                                        ev.divided_differences(y, z, t), t)
+        self.assertArrayEqual(factors, ev.second_integral_factors(x, y, z, t), 7)
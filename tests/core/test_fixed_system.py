@@ -5,7 +5,7 @@ import floq.errors as er
 import floq.core.evolution
 import tests.rabi as rabi
 from tests.assertions import CustomAssertions
-from mock import MagicMock
+from mock import MagicMock, patch
 
 
 class TestFixedSystemInit(CustomAssertions):
@@ -62,6 +62,14 @@ class TestFixedSystemMaxNZ(TestCase):
             self.s.u()
 
 
+    def test_fixed_nz_is_not_increased(self):
+        self.s.fixed_nz = True
+        self.s._test_nz = MagicMock(return_value=[False, []])
+        self.s.u
+        self.assertEqual(self.s.params.nz, 3)
+        self.s._test_nz.assert_not_called()
+
+
 
 class TestEvolveFixedSystem(CustomAssertions):
     def setUp(self):
@@ -92,6 +100,26 @@ class TestEvolveFixedSystem(CustomAssertions):
 
 
 
+class TestFixedSystemAtTime(CustomAssertions):
+    def setUp(self):
+        hf = rabi.hf(5.0, 1.2, 2.8)
+        dhf = np.array([rabi.hf(1.0, 0, 0)])
+        self.s = fs.FixedSystem(hf, dhf, 3, 5.0, 20.5)
+        self.s.u
+        self.other = fs.FixedSystem(hf, dhf, 3, 5.0, 17.0)
+
+    def test_u_at_other_time(self):
+        u = self.other.u
+        with patch('floq.core.evolution.find_eigensystem') as find:
+            moved = self.s.at_time(17.0)
+            self.assertArrayEqual(moved.u, u, 8)
+            find.assert_not_called()
+
+    def test_du_at_other_time(self):
+        self.assertArrayEqual(self.s.at_time(17.0).du, self.other.du, 8)
+
+
+
 class TestEvolveFixedSystemWithDerivs(CustomAssertions):
     def setUp(self):
         g = 0.5
@@ -0,0 +1,42 @@
+from tests.assertions import CustomAssertions
+import floq.optimization.fidelity as fid
+from floq.systems.spins import SpinEnsemble
+import numpy as np
+
+
+FREQS = np.array([1.1, 1.0, 0.9, 1.05, 0.95])
+AMPS = np.array([1.0, 1.1, 0.9, 1.0, 1.05])
+TARGET = np.array([[0.105818 - 0.324164j, -0.601164 - 0.722718j],
+                   [0.601164 - 0.722718j, 0.105818 + 0.324164j]])
+CONTROLS = np.array([1.5, 1.2, 1.3, 1.4])
+
+
+def spin_ensemble(n, ncomp=2):
+    """ An ensemble of up to five spins, with the first n of FREQS and AMPS """
+    ensemble = SpinEnsemble(n, ncomp, 1.5, FREQS[:n], AMPS[:n])
+    for system in ensemble.systems:
+        system.nz = 31  # so that results don't depend on the history of nz
+    return ensemble
+
+
+
+class EnsembleTestCase(CustomAssertions):
+    """
+    Sets up an ensemble of n spins, the parameters of an OperatorDistance
+    reaching TARGET at t=1, and controls, as well as a reference EnsembleFidelity
+    to compare the parallel backends to.
+
+    The reference gets its own systems, so that it does not read their caches,
+    and it is evaluated once, so that workers forked afterwards find compiled kernels.
+    """
+
+    n = 5
+
+    def setUp(self):
+        self.ensemble = spin_ensemble(self.n)
+        self.params = dict(t=1.0, target=TARGET)
+        self.ctrl = np.copy(CONTROLS)
+
+        self.reference = fid.EnsembleFidelity(spin_ensemble(self.n), fid.OperatorDistance,
+                                              **self.params)
+        self.reference.value_and_grad(self.ctrl)
@@ -1,9 +1,13 @@
 from unittest import TestCase
+from StringIO import StringIO
+import json
 from tests.assertions import CustomAssertions
 import floq.optimization.fidelity as fid
-from floq.systems.spins import SpinEnsemble
+import floq.errors as er
+from floq.systems.spins import SpinEnsemble, SpinSystem
 import numpy as np
-from mock import MagicMock
+from mock import MagicMock, patch
+from floq.core.fixed_system import FixedSystem
 
 
 class TestFidelityBaseIterations(TestCase):
@@ -25,6 +29,55 @@ class TestFidelityBaseIterations(TestCase):
 
 
 
+class TestFidelityBaseMemo(CustomAssertions):
+    def setUp(self):
+        self.computer = fid.FidelityBase(None)
+        self.computer._f = MagicMock(return_value=2.0)
+        self.computer._df = MagicMock(return_value=np.array([3.0, 4.0]))
+        self.ctrl = np.array([1.0, 2.0])
+
+    def test_f_not_recomputed(self):
+        self.computer.f(self.ctrl)
+        self.computer.f(np.copy(self.ctrl))
+        self.computer._f.assert_called_once()
+
+    def test_recomputed_for_new_controls(self):
+        self.computer.f(self.ctrl)
+        self.computer.f(2*self.ctrl)
+        self.assertEqual(self.computer._f.call_count, 2)
+        self.assertEqual(self.computer.evaluations, 2)
+
+    def test_not_fooled_by_mutated_controls(self):
+        self.computer.f(self.ctrl)
+        self.ctrl[0] = 5.0
+        self.computer.f(self.ctrl)
+        self.assertEqual(self.computer._f.call_count, 2)
+
+    def test_forget(self):
+        self.computer.f(self.ctrl)
+        self.computer.forget()
+        self.computer.f(self.ctrl)
+        self.assertEqual(self.computer._f.call_count, 2)
+
+    def test_iterate_reuses_evaluation(self):
+        self.computer.progress = StringIO()
+        self.computer.value_and_grad(self.ctrl)
+        self.computer.iterate(self.ctrl)
+        self.computer._f.assert_called_once()
+
+    def test_progress_record(self):
+        self.computer.progress = StringIO()
+        self.computer.value_and_grad(self.ctrl)
+        self.computer.iterate(self.ctrl)
+
+        record = json.loads(self.computer.progress.getvalue().splitlines()[0])
+        self.assertEqual(record['iteration'], 1)
+        self.assertEqual(record['f'], 2.0)
+        self.assertEqual(record['df_norm'], 5.0)
+        self.assertEqual(record['evaluations'], 1)
+
+
+
 class TestEnsembleFidelity(CustomAssertions):
     def setUp(self):
         self.ensemble = SpinEnsemble(2, 2, 1.5, np.array([1.1, 1.1]), np.array([1, 1]))
@@ -37,3 +90,356 @@ class TestEnsembleFidelity(CustomAssertions):
         f = fid.EnsembleFidelity(self.ensemble, fid.OperatorDistance, t=1.0, target=target)
         print f.f(np.array([1.5, 1.5, 1.5, 1.5]))
         self.assertTrue(np.isclose(f.f(np.array([1.5, 1.5, 1.5, 1.5])), 0.0, atol=1e-5))
+
+
+    def test_cache_state_restores_nz(self):
+        f = fid.EnsembleFidelity(self.ensemble, fid.OperatorDistance, t=1.0, target=np.eye(2))
+        f.f(np.array([1.5, 1.5, 1.5, 1.5]))
+        state = f.cache_state()
+
+        g = fid.EnsembleFidelity(SpinEnsemble(2, 2, 1.5, np.array([1.1, 1.1]), np.array([1, 1])),
+                                 fid.OperatorDistance, t=1.0, target=np.eye(2))
+        g.restore_cache(state)
+        self.assertEqual([c.system.nz for c in g.fidelities],
+                         [c.system.nz for c in f.fidelities])
+
+
+
+class TestRefinementOrder(TestCase):
+    def test_is_permutation(self):
+        order = fid.refinement_order(11)
+        self.assertEqual(sorted(order), range(11))
+
+    def test_coarse_first(self):
+        self.assertEqual(fid.refinement_order(8)[:4], [0, 4, 2, 6])
+
+
+
+class TestAdaptiveEnsembleFidelity(CustomAssertions):
+    def setUp(self):
+        freqs = np.linspace(0.9, 1.1, 8)
+        amps = np.linspace(0.9, 1.1, 8)
+        self.ensemble = SpinEnsemble(8, 2, 1.5, freqs, amps)
+        self.target = np.array([[0.105818 - 0.324164j, -0.601164 - 0.722718j],
+                                [0.601164 - 0.722718j, 0.105818 + 0.324164j]])
+        self.ctrl = np.array([1.5, 1.5, 1.5, 1.5])
+
+        self.f = fid.AdaptiveEnsembleFidelity(self.ensemble, fid.OperatorDistance, initial=2,
+                                              patience=2, t=1.0, target=self.target)
+
+    def test_starts_with_subset(self):
+        self.assertEqual(len(self.f.active), 2)
+
+    def test_grows_when_stalled(self):
+        for i in xrange(3):
+            self.f.iterate(self.ctrl)
+        self.assertTrue(self.f.n_active > 2)
+
+    def test_keeps_members_when_growing(self):
+        member = self.f.active[1]
+        self.f.grow()
+        self.assertIs(self.f.active[1], member)
+
+    def test_complete_equals_ensemble_fidelity(self):
+        while not self.f.complete:
+            self.f.grow()
+        full = fid.EnsembleFidelity(self.ensemble, fid.OperatorDistance, t=1.0, target=self.target)
+        self.assertAlmostEqualWithDecimals(self.f.f(self.ctrl), full.f(self.ctrl), 8)
+
+
+class TestWeightedEnsembleFidelity(CustomAssertions):
+    def test_uses_ensemble_weights(self):
+        ensemble = SpinEnsemble(2, 2, 1.5, np.array([1.1, 0.9]), np.array([1, 1]))
+        ctrl = np.array([1.5, 1.5, 1.5, 1.5])
+        target = np.eye(2)
+
+        f = fid.EnsembleFidelity(ensemble, fid.OperatorDistance, t=1.0, target=target)
+        f.weights = np.array([0.25, 0.75])
+
+        single = [fid.OperatorDistance(s, t=1.0, target=target).f(ctrl) for s in ensemble.systems]
+        self.assertAlmostEqualWithDecimals(f.f(ctrl), 0.25*single[0]+0.75*single[1], 8)
+
+
+
+class TestMinimaxEnsembleFidelity(CustomAssertions):
+    def setUp(self):
+        freqs = np.array([0.1, 0.2, 0.8, 0.3])
+        amps = np.array([1.0, 1.0, 1.0, 1.0])
+        self.ensemble = SpinEnsemble(4, 2, 1.5, freqs, amps)
+        self.ctrl = np.array([1.5, 1.2, 0.5, 1.5])
+        self.singles = [fid.OperatorDistance(s, t=1.0, target=np.eye(2))
+                        for s in self.ensemble.systems]
+
+    def test_approaches_max(self):
+        f = fid.MinimaxEnsembleFidelity(self.ensemble, fid.OperatorDistance,
+                                        sharpness=1e4, t=1.0, target=np.eye(2))
+        worst = max([single.f(self.ctrl) for single in self.singles])
+        self.assertAlmostEqualWithDecimals(f.f(self.ctrl), worst, 3)
+
+    def test_gradient_matches_finite_differences(self):
+        f = fid.MinimaxEnsembleFidelity(self.ensemble, fid.OperatorDistance,
+                                        sharpness=20.0, cutoff=0.0, t=1.0, target=np.eye(2))
+        h = 1e-6
+        fd = np.array([(f.f(self.ctrl+h*e)-f.f(self.ctrl-h*e))/(2*h) for e in np.eye(4)])
+        self.assertArrayEqual(f.df(self.ctrl), fd, 4)
+
+    def test_skips_irrelevant_members(self):
+        f = fid.MinimaxEnsembleFidelity(self.ensemble, fid.OperatorDistance,
+                                        sharpness=1e4, t=1.0, target=np.eye(2))
+        worst = np.argmax([single.f(self.ctrl) for single in self.singles])
+        self.assertArrayEqual(f.df(self.ctrl), self.singles[worst].df(self.ctrl), 4)
+        self.assertEqual(f.skipped, 3)
+
+    def test_keeps_worst_member_below_cutoff(self):
+        f = fid.MinimaxEnsembleFidelity(self.ensemble, fid.OperatorDistance,
+                                        sharpness=1e-3, cutoff=0.5, t=1.0, target=np.eye(2))
+        worst = np.argmax([single.f(self.ctrl) for single in self.singles])
+        df = f.df(self.ctrl)
+        self.assertEqual(f.skipped, 3)
+        self.assertEqual(df.shape, (4,))
+        self.assertArrayEqual(df, self.singles[worst].df(self.ctrl), 8)
+
+
+
+class TestRobustFidelities(CustomAssertions):
+    def setUp(self):
+        self.ctrl = np.array([1.2, 0.7, -0.4, 0.9])
+        self.t = 2.0
+        self.sigmas = np.array([0.05, 0.03])
+        self.system = SpinSystem(2, 1.0, 0.3, 1.5)
+        self.system.nz = 31
+
+        target = self.system.u(self.ctrl, self.t)
+        initial = np.array([1.0+0j, 0.0])
+        self.fids = [(fid.RobustOperatorDistance, fid.OperatorDistance, dict(target=target)),
+                     (fid.RobustTransferDistance, fid.TransferDistance,
+                      dict(initial=initial, final=np.dot(target, initial)))]
+
+    def test_gradient_matches_finite_differences(self):
+        h = 1e-4
+        for robust, plain, params in self.fids:
+            f = robust(self.system, t=self.t, sigmas=self.sigmas, **params)
+            fd = np.array([(f.f(self.ctrl+h*e)-f.f(self.ctrl-h*e))/(2*h) for e in np.eye(4)])
+            self.assertArrayEqual(f.df(self.ctrl), fd, 6)
+
+    def test_value_and_grad_computes_sensitivities_once(self):
+        for robust, plain, params in self.fids:
+            f = robust(self.system, t=self.t, sigmas=self.sigmas, **params)
+            du_for = FixedSystem.du_for
+            with patch.object(FixedSystem, 'du_for', autospec=True, side_effect=du_for) as mock:
+                f.df(1.1*self.ctrl)
+                alone = mock.call_count
+                f.value_and_grad(1.2*self.ctrl)
+            # The penalty reuses the sensitivities computed for its gradient
+            self.assertEqual(mock.call_count, 2*alone)
+
+    def test_approximates_ensemble_average(self):
+        x, w = np.polynomial.hermite_e.hermegauss(5)
+        w = w/np.sum(w)
+
+        for robust, plain, params in self.fids:
+            average = 0.0
+            for xi, wi in zip(x, w):
+                for xj, wj in zip(x, w):
+                    member = SpinSystem(2, 1.0+self.sigmas[1]*xj, 0.3+self.sigmas[0]*xi, 1.5)
+                    average += wi*wj*plain(member, t=self.t, **params).f(self.ctrl)
+
+            f = robust(self.system, t=self.t, sigmas=self.sigmas, **params)
+            self.assertAlmostEqualWithDecimals(f.f(self.ctrl), average, 4)
+            self.assertAlmostEqualWithDecimals(f.taylor_average(self.ctrl), average, 4)
+
+
+
+class TestHessp(CustomAssertions):
+    def setUp(self):
+        self.ctrl = np.array([1.2, 0.7, -0.4, 0.9])
+        self.v = np.array([0.3, -1.0, 0.5, 0.2])
+        self.system = SpinSystem(2, 1.0, 0.3, 1.5)
+        self.system.nz = 31
+
+        initial = np.array([1.0+0j, 0.0])
+        self.fids = [fid.OperatorDistance(self.system, t=2.0, target=np.eye(2)),
+                     fid.TransferDistance(self.system, t=2.0, initial=initial,
+                                          final=np.array([0.0, 1.0+0j]))]
+
+    def finite_difference(self, f):
+        h = 1e-5
+        return (f.df(self.ctrl+h*self.v) - f.df(self.ctrl-h*self.v))/(2*h)
+
+    def test_matches_finite_differences(self):
+        for f in self.fids:
+            self.assertArrayEqual(f.hessp(self.ctrl, self.v), self.finite_difference(f), 6)
+
+    def test_is_symmetric(self):
+        for f in self.fids:
+            w = np.array([-0.7, 0.1, 0.4, 1.1])
+            self.assertAlmostEqualWithDecimals(np.dot(w, f.hessp(self.ctrl, self.v)),
+                                               np.dot(self.v, f.hessp(self.ctrl, w)), 8)
+
+    def test_includes_penalty(self):
+        target = self.system.u(self.ctrl, 2.0)
+        f = fid.RobustOperatorDistance(self.system, t=2.0, target=target, sigmas=[0.05, 0.03])
+        self.assertArrayEqual(f.hessp(self.ctrl, self.v), self.finite_difference(f), 5)
+
+    def test_ensemble_is_weighted_sum(self):
+        ensemble = SpinEnsemble(3, 2, 1.5, np.array([0.1, 0.2, 0.8]), np.ones(3))
+        for system in ensemble.systems:
+            system.nz = 31
+        f = fid.EnsembleFidelity(ensemble, fid.OperatorDistance, t=1.0, target=np.eye(2))
+        self.assertArrayEqual(f.hessp(self.ctrl, self.v), self.finite_difference(f), 6)
+
+    def test_base_uses_finite_differences(self):
+        computer = fid.FidelityBase(None)
+        computer._df = lambda x: np.array([x[0]**2, x[0]*x[1]])
+        hv = computer.hessp(np.array([1.0, 2.0]), np.array([1.0, 0.0]))
+        self.assertArrayEqual(hv, np.array([2.0, 2.0]), 6)
+
+
+
+class TestValueAndGrad(CustomAssertions):
+    def setUp(self):
+        self.ensemble = SpinEnsemble(3, 2, 1.5, np.array([0.1, 0.2, 0.8]), np.ones(3))
+        self.ctrl = np.array([1.5, 1.2, 0.5, 1.5])
+
+    def test_base_combines_f_and_df(self):
+        computer = fid.FidelityBase(None)
+        computer._f = MagicMock(return_value=1.0)
+        computer._df = MagicMock(return_value=np.ones(2))
+        computer.penalty = MagicMock(return_value=0.5)
+
+        f, df = computer.value_and_grad(self.ctrl)
+        self.assertEqual(f, 1.5)
+        self.assertArrayEqual(df, np.ones(2))
+
+    def test_fidelities_match_f_and_df(self):
+        fids = [fid.EnsembleFidelity(self.ensemble, fid.OperatorDistance, t=1.0, target=np.eye(2)),
+                fid.MinimaxEnsembleFidelity(self.ensemble, fid.TransferDistance, t=1.0,
+                                            initial=np.array([1.0, 0.0]), final=np.array([0.0, 1.0]))]
+        for computer in fids:
+            f, df = computer.value_and_grad(self.ctrl)
+            self.assertAlmostEqualWithDecimals(f, computer.f(self.ctrl), 10)
+            self.assertArrayEqual(df, computer.df(self.ctrl), 10)
+
+
+
+class TestBatch(CustomAssertions):
+    def setUp(self):
+        self.ensemble = SpinEnsemble(3, 2, 1.5, np.array([0.1, 0.2, 0.8]), np.ones(3))
+        self.controls = np.array([[1.5, 1.2, 0.5, 1.5],
+                                  [0.5, 0.2, 1.5, 1.1],
+                                  [1.0, 1.0, 1.0, 1.0]])
+
+    def test_base_loops_over_rows(self):
+        computer = fid.FidelityBase(None)
+        computer._f = MagicMock(side_effect=lambda c: c[0])
+        computer._df = MagicMock(side_effect=lambda c: 2*c)
+        computer.penalty = MagicMock(return_value=0.5)
+
+        self.assertArrayEqual(computer.f_batch(self.controls), self.controls[:, 0]+0.5)
+        self.assertArrayEqual(computer.df_batch(self.controls), 2*self.controls)
+        self.assertEqual(computer.evaluations, 6)
+
+        fs, dfs = computer.value_and_grad_batch(self.controls)
+        self.assertArrayEqual(fs, self.controls[:, 0]+0.5)
+        self.assertArrayEqual(dfs, 2*self.controls)
+        self.assertEqual(computer.evaluations, 9)
+
+    def test_fidelities_match_rows(self):
+        fids = [fid.EnsembleFidelity(self.ensemble, fid.OperatorDistance, t=1.0, target=np.eye(2)),
+                fid.AdaptiveEnsembleFidelity(self.ensemble, fid.OperatorDistance, initial=2,
+                                             t=1.0, target=np.eye(2)),
+                fid.MinimaxEnsembleFidelity(self.ensemble, fid.OperatorDistance, t=1.0,
+                                            target=np.eye(2))]
+        for computer in fids:
+            fs = computer.f_batch(self.controls)
+            dfs = computer.df_batch(self.controls)
+            for row, f, df in zip(self.controls, fs, dfs):
+                self.assertAlmostEqualWithDecimals(f, computer.f(row), 10)
+                self.assertArrayEqual(df, computer.df(row), 10)
+
+            fused_fs, fused_dfs = computer.value_and_grad_batch(self.controls)
+            self.assertArrayEqual(fused_fs, fs, 10)
+            self.assertArrayEqual(fused_dfs, dfs, 10)
+
+    def test_fused_batch_evaluates_members_once_per_row(self):
+        computer = fid.EnsembleFidelity(self.ensemble, fid.OperatorDistance, t=1.0,
+                                        target=np.eye(2))
+        computer.value_and_grad_batch(self.controls)
+        self.assertEqual([member.evaluations for member in computer.fidelities], [3, 3, 3])
+
+
+
+class TestMask(CustomAssertions):
+    def setUp(self):
+        self.ensemble = SpinEnsemble(3, 2, 1.5, np.array([0.1, 0.2, 0.8]), np.ones(3))
+        self.ctrl = np.array([1.5, 1.2, 0.5, 1.5])
+        self.mask = [True, False, False, True]
+
+    def test_ensemble_returns_masked_gradient(self):
+        full = fid.EnsembleFidelity(self.ensemble, fid.OperatorDistance, t=1.0, target=np.eye(2))
+        df = full.df(self.ctrl)
+
+        masked = fid.EnsembleFidelity(SpinEnsemble(3, 2, 1.5, np.array([0.1, 0.2, 0.8]),
+                                                   np.ones(3)),
+                                      fid.OperatorDistance, t=1.0, target=np.eye(2))
+        masked.set_mask(self.mask)
+        self.assertEqual(masked.mask, (0, 3))
+        self.assertArrayEqual(masked.df(self.ctrl), df[[0, 3]])
+        self.assertArrayEqual(masked.df_batch(np.array([self.ctrl]))[0], df[[0, 3]])
+
+        masked.set_mask(None)
+        self.assertArrayEqual(masked.df(self.ctrl), df)
+
+    def test_penalty_gradient_is_masked(self):
+        system = SpinSystem(2, 1.0, 0.3, 1.5)
+        params = dict(t=2.0, target=np.eye(2), sigmas=np.array([0.05, 0.03]))
+        df = fid.RobustOperatorDistance(SpinSystem(2, 1.0, 0.3, 1.5), **params).df(self.ctrl)
+
+        masked = fid.RobustOperatorDistance(system, **params)
+        masked.set_mask(self.mask)
+        self.assertArrayEqual(masked.df(self.ctrl), df[[0, 3]])
+
+
+
+class TestOptimisedDuration(CustomAssertions):
+    def setUp(self):
+        self.ctrl = np.array([1.2, 0.7, -0.4, 0.9])
+        self.t = 2.0
+        self.controls_and_t = np.append(self.ctrl, self.t)
+        self.system = SpinSystem(2, 1.0, 0.3, 1.5)
+        self.system.nz = 31
+        target = self.system.u(0.5*self.ctrl, 1.5)
+        initial = np.array([1.0+0j, 0.0])
+        self.fids = [(fid.OperatorDistance, dict(target=target)),
+                     (fid.TransferDistance, dict(initial=initial, final=np.dot(target, initial)))]
+
+    def test_matches_fixed_duration(self):
+        for fidelity, params in self.fids:
+            free = fidelity(self.system, t=None, **params)
+            system = SpinSystem(2, 1.0, 0.3, 1.5)
+            system.nz = 31
+            fixed = fidelity(system, t=self.t, **params)
+            f, df = free.value_and_grad(self.controls_and_t)
+            self.assertAlmostEqualWithDecimals(f, fixed.f(self.ctrl))
+            self.assertArrayEqual(df[:-1], fixed.df(self.ctrl))
+
+    def test_duration_gradient(self):
+        h = 1e-5
+        for fidelity, params in self.fids:
+            free = fidelity(self.system, t=None, **params)
+            step = np.append(np.zeros(4), h)
+            fd = (free.f(self.controls_and_t+step)-free.f(self.controls_and_t-step))/(2*h)
+            self.assertAlmostEqualWithDecimals(free.df(self.controls_and_t)[-1], fd, 6)
+
+    def test_fixed_duration(self):
+        fidelity, params = self.fids[0]
+        fixed = fid.FixedDuration(fidelity(self.system, t=None, **params), self.t)
+        free = fidelity(self.system, t=None, **params)
+        f, df = fixed.value_and_grad(self.ctrl)
+        self.assertAlmostEqualWithDecimals(f, free.f(self.controls_and_t))
+        self.assertArrayEqual(df, free.df(self.controls_and_t)[:-1])
+
+    def test_robust_fidelities_need_duration(self):
+        with self.assertRaises(er.UsageError):
+            fid.RobustOperatorDistance(self.system, None, np.eye(2), np.ones(2))
+
@@ -0,0 +1,267 @@
+from unittest import TestCase
+import os
+import json
+import shutil
+import tempfile
+import cPickle as pickle
+import numpy as np
+import floq.optimization.optimizer as optimizer
+import floq.optimization.fidelity as fid
+from floq.systems.spins import SpinEnsemble, SpinSystem
+from tests.ensembles import spin_ensemble, TARGET
+from mock import MagicMock, patch
+
+
+class TestSciPyOptimizer(TestCase):
+    def setUp(self):
+        self.fid = MagicMock()
+        self.init = np.ones(4)
+
+    def test_uses_value_and_grad(self):
+        with patch('scipy.optimize.minimize') as minimize:
+            optimizer.SciPyOptimizer(self.fid, self.init).optimize()
+            args, kwargs = minimize.call_args
+            self.assertIs(args[0], self.fid.value_and_grad)
+            self.assertIs(kwargs['jac'], True)
+
+    def test_gradient_free_only_uses_f(self):
+        with patch('scipy.optimize.minimize') as minimize:
+            optimizer.SciPyOptimizer(self.fid, self.init, method='Nelder-Mead').optimize()
+            args, kwargs = minimize.call_args
+            self.assertIs(args[0], self.fid.f)
+            self.assertIsNone(kwargs['jac'])
+
+    def test_hessian_methods_use_hessp(self):
+        with patch('scipy.optimize.minimize') as minimize:
+            optimizer.SciPyOptimizer(self.fid, self.init, method='trust-ncg').optimize()
+            args, kwargs = minimize.call_args
+            self.assertIs(kwargs['hessp'], self.fid.hessp)
+
+
+
+class TestNewtonCGOptimizer(TestCase):
+    def setUp(self):
+        self.system = SpinSystem(2, 1.0, 0.3, 1.5)
+        self.system.nz = 31
+        target = self.system.u(np.array([0.5, -0.3, 0.2, 0.4]), 2.0)
+        self.fid = fid.OperatorDistance(self.system, t=2.0, target=target)
+        self.init = np.array([0.1, 0.1, -0.1, 0.1])
+
+    def test_needs_fewer_iterations_than_bfgs(self):
+        res = optimizer.NewtonCGOptimizer(self.fid, self.init, tol=1e-8).optimize()
+        reference = optimizer.SciPyOptimizer(self.fid, self.init, tol=1e-8).optimize()
+        self.assertTrue(res.success)
+        self.assertAlmostEqual(res.fun, reference.fun, 6)
+        self.assertLess(res.nit, reference.nit)
+
+
+
+class Rugged(fid.FidelityBase):
+    def _f(self, controls):
+        return np.sum(controls**2) + 0.5*np.sum(1.0-np.cos(5.0*controls))
+
+    def _df(self, controls):
+        return 2.0*controls + 2.5*np.sin(5.0*controls)
+
+
+
+class TestBFGSOptimizer(TestCase):
+    def setUp(self):
+        self.init = np.array([0.3, -0.2])
+        self.path = os.path.join(tempfile.mkdtemp(), 'checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def test_matches_scipy(self):
+        res = optimizer.BFGSOptimizer(Rugged(None), self.init).optimize()
+        reference = optimizer.SciPyOptimizer(Rugged(None), self.init).optimize()
+        self.assertTrue(res.success)
+        self.assertTrue(np.allclose(res.x, reference.x, atol=1e-4))
+
+    def test_uses_value_and_grad(self):
+        fidelity = Rugged(None)
+        fidelity._value_and_grad = MagicMock(side_effect=lambda x: (Rugged._f(fidelity, x),
+                                                                    Rugged._df(fidelity, x)))
+        fidelity._f = MagicMock()
+        fidelity._df = MagicMock()
+        res = optimizer.BFGSOptimizer(fidelity, self.init).optimize()
+        self.assertTrue(res.success)
+        self.assertFalse(fidelity._f.called)
+        self.assertFalse(fidelity._df.called)
+
+    def test_writes_checkpoint(self):
+        fidelity = Rugged(None)
+        fidelity.cache_state = MagicMock(return_value='cache')
+        res = optimizer.BFGSOptimizer(fidelity, self.init, checkpoint=self.path).optimize()
+        with open(self.path, 'rb') as f:
+            state = pickle.load(f)
+        self.assertTrue(np.allclose(state['x'], res.x))
+        self.assertEqual(state['iterations'], res.nit)
+        self.assertEqual(state['cache'], 'cache')
+
+    def test_resume_continues(self):
+        full = optimizer.BFGSOptimizer(Rugged(None), self.init).optimize()
+
+        fidelity = Rugged(None)
+        fidelity.cache_state = MagicMock(return_value='cache')
+        first = optimizer.BFGSOptimizer(fidelity, self.init, maxiter=2, checkpoint=self.path)
+        first.optimize()
+
+        fidelity = Rugged(None)
+        fidelity.cache_state = MagicMock(return_value='cache')
+        fidelity.restore_cache = MagicMock()
+        resumed = optimizer.BFGSOptimizer.resume(fidelity, self.path, maxiter=full.nit)
+        self.assertEqual(resumed.iterations, 2)
+        self.assertTrue(np.allclose(resumed.hess_inv, first.hess_inv))
+        fidelity.restore_cache.assert_called_once()
+
+        res = resumed.optimize()
+        self.assertEqual(res.nit, full.nit)
+        self.assertTrue(np.allclose(res.x, full.x))
+
+
+
+class TestContinuationOptimizer(TestCase):
+    def setUp(self):
+        self.ensemble = SpinEnsemble(2, 2, 1.5, np.array([1.1, 1.0]), np.array([1.0, 1.1]))
+        self.target = np.array([[0.105818 - 0.324164j, -0.601164 - 0.722718j],
+                                [0.601164 - 0.722718j, 0.105818 + 0.324164j]])
+        self.fid = fid.EnsembleFidelity(self.ensemble, fid.OperatorDistance, t=1.0,
+                                        target=self.target)
+        self.init = np.array([1.0, 1.0, 1.0, 1.0])
+
+    def test_converges_with_full_truncation(self):
+        reference = fid.EnsembleFidelity(self.ensemble, fid.OperatorDistance, t=1.0,
+                                         target=self.target)
+        plain = optimizer.BFGSOptimizer(reference, self.init).optimize()
+
+        continuation = optimizer.ContinuationOptimizer(self.fid, self.init, [(3, 3, 0.1), (5, 5, 0.01)])
+        res = continuation.optimize()
+
+        self.assertEqual(len(continuation.stage_results), 3)
+        self.assertAlmostEqual(res.fun, plain.fun, 5)
+        for member in self.fid.fidelities:
+            self.assertFalse(member.system.fixed_nz)
+            self.assertEqual(member.system.decimals, 10)
+
+    def test_stages_use_fixed_nz(self):
+        seen = []
+        iterate = self.fid.iterate
+        def record(controls):
+            seen.append(self.fid.cache_state()[0])
+            iterate(controls)
+        self.fid.iterate = record
+
+        optimizer.ContinuationOptimizer(self.fid, self.init, [(3, 3, -np.inf)], maxiter=2).optimize()
+        self.assertEqual([seen[0][key] for key in ('nz', 'decimals', 'fixed_nz')], [3, 3, True])
+
+
+class TestComponentContinuationOptimizer(TestCase):
+    def setUp(self):
+        self.target = np.array([[0.105818 - 0.324164j, -0.601164 - 0.722718j],
+                                [0.601164 - 0.722718j, 0.105818 + 0.324164j]])
+
+    def fidelity(self):
+        ensemble = SpinEnsemble(2, 3, 1.5, np.array([1.1, 1.0]), np.array([1.0, 1.1]))
+        return fid.EnsembleFidelity(ensemble, fid.OperatorDistance, t=1.0, target=self.target)
+
+    def test_grows_components(self):
+        fidelity = self.fidelity()
+        continuation = optimizer.ComponentContinuationOptimizer(fidelity, np.ones(2), [1, 3])
+        res = continuation.optimize()
+
+        plain = optimizer.BFGSOptimizer(self.fidelity(), np.ones(6)).optimize()
+        self.assertEqual(res.x.shape, (6,))
+        self.assertEqual(len(continuation.stage_results), 2)
+        self.assertTrue(continuation.stage_results[0][1] >= res.fun)
+        self.assertTrue(res.fun < plain.fun + 1e-4)
+        for member in fidelity.fidelities:
+            self.assertEqual(member.system.ncomp, 3)
+
+
+
+class TestDurationSweep(TestCase):
+    def setUp(self):
+        self.ts = np.array([1.2, 0.8, 1.0])
+        self.path = os.path.join(tempfile.mkdtemp(), 'sweep')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def make_fidelity(self):
+        return fid.EnsembleFidelity(spin_ensemble(2), fid.OperatorDistance, t=None, target=TARGET)
+
+    def test_sweeps_sorted_durations(self):
+        sweep = optimizer.DurationSweep(self.make_fidelity, self.ts, np.ones(4), path=self.path)
+        ts, fs = sweep.optimize()
+
+        self.assertTrue(np.array_equal(ts, [0.8, 1.0, 1.2]))
+        for t, f, res in zip(ts, fs, sweep.results):
+            fixed = fid.FixedDuration(self.make_fidelity(), t)
+            self.assertAlmostEqual(fixed.f(res.x), f)
+
+        with open(self.path) as records:
+            lines = [json.loads(line) for line in records]
+        self.assertEqual([line['t'] for line in lines], [0.8, 1.0, 1.2])
+
+    def test_chains(self):
+        sweep = optimizer.DurationSweep(self.make_fidelity, self.ts, np.ones(4), chains=2)
+        ts, fs = sweep.optimize()
+        self.assertEqual(len(fs), 3)
+        self.assertTrue(all(res is not None for res in sweep.results))
+
+
+
+class TestSetTruncation(TestCase):
+    def test_sets_values_and_drops_eigensystems(self):
+        state = [{'nz': 3, 'decimals': 10, 'fixed_nz': False, 'controls': None},
+                 {'nz': 7, 'decimals': 10, 'fixed_nz': False}]
+        new = optimizer.set_truncation(state, nz=lambda nz: max(nz, 5), decimals=4)
+        self.assertEqual(new, [{'nz': 5, 'decimals': 4, 'fixed_nz': False},
+                               {'nz': 7, 'decimals': 4, 'fixed_nz': False}])
+
+
+
+class TestMultiStartOptimizer(TestCase):
+    def setUp(self):
+        self.inits = np.array([[2.0, -1.5], [0.1, 0.2], [-3.0, 1.0], [1.2, 1.3]])
+
+    def test_finds_best_of_separate_runs(self):
+        separate = [optimizer.SciPyOptimizer(Rugged(None), init).optimize() for init in self.inits]
+
+        multi = optimizer.MultiStartOptimizer(Rugged(None), self.inits, margin=np.inf)
+        res = multi.optimize()
+
+        self.assertAlmostEqual(res.fun, min([r.fun for r in separate]))
+        self.assertEqual(multi.culled, [])
+        for r, s in zip(multi.results, separate):
+            self.assertTrue(np.allclose(r.x, s.x))
+
+    def test_evaluates_in_batches(self):
+        fidelity = Rugged(None)
+        batch = fid.FidelityBase._value_and_grad_batch.__get__(fidelity)
+        fidelity._value_and_grad_batch = MagicMock(side_effect=batch)
+        optimizer.MultiStartOptimizer(fidelity, self.inits, margin=np.inf).optimize()
+        self.assertTrue(fidelity._value_and_grad_batch.call_count < fidelity.evaluations)
+
+    def test_computes_f_and_df_together(self):
+        fidelity = Rugged(None)
+        fidelity._f_batch = MagicMock()
+        fidelity._df_batch = MagicMock()
+        optimizer.MultiStartOptimizer(fidelity, self.inits, margin=np.inf).optimize()
+        self.assertFalse(fidelity._f_batch.called)
+        self.assertFalse(fidelity._df_batch.called)
+
+    def test_culls_trailing_starts(self):
+        multi = optimizer.MultiStartOptimizer(Rugged(None), self.inits, margin=1e-3, after=1)
+        res = multi.optimize()
+
+        self.assertTrue(len(multi.culled) > 0)
+        self.assertNotIn(1, multi.culled)
+        self.assertAlmostEqual(res.fun, 0.0)
+
+    def test_gradient_free(self):
+        multi = optimizer.MultiStartOptimizer(Rugged(None), self.inits, method='Nelder-Mead',
+                                              margin=np.inf)
+        self.assertAlmostEqual(multi.optimize().fun, 0.0, 5)
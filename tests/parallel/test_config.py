@@ -0,0 +1,70 @@
+from unittest import TestCase
+import os
+import time
+from floq.parallel.config import ParallelConfig, splits, tune, blas_libraries, blas_threads
+import numpy as np
+import numba
+from mock import MagicMock, patch
+
+
+class TestParallelConfig(TestCase):
+    def test_fills_cores_by_default(self):
+        config = ParallelConfig(threads=2, cores=8)
+        self.assertEqual(config.workers, 4)
+
+    def test_cpus(self):
+        config = ParallelConfig(workers=3, threads=2, cores=4)
+        self.assertEqual(config.cpus(0), [0, 1])
+        self.assertEqual(config.cpus(2), [0, 1])
+
+    def test_environment(self):
+        config = ParallelConfig(threads=3, cores=6)
+        self.assertEqual(config.environment()['OMP_NUM_THREADS'], '3')
+
+    def test_configure_systems(self):
+        fids = [MagicMock(), MagicMock()]
+        ParallelConfig(threads=2, cores=4).configure_systems(fids)
+        self.assertEqual([fid.system.threads for fid in fids], [2, 2])
+
+    def test_environment_leaves_numba_to_config(self):
+        config = ParallelConfig(threads=3, cores=6)
+        self.assertNotIn('NUMBA_NUM_THREADS', config.environment())
+
+    def test_limits_blas(self):
+        before = blas_threads()
+        self.assertTrue(before)  # numpy's BLAS is found
+        with ParallelConfig(threads=2, cores=2).limits():
+            self.assertEqual(blas_threads(), [2]*len(before))
+        self.assertEqual(blas_threads(), before)
+
+    @patch.dict(os.environ)
+    def test_apply_limits_numba_and_blas(self):
+        previous = numba.config.NUMBA_NUM_THREADS
+        libraries = blas_libraries()
+        counts = blas_threads()
+        try:
+            ParallelConfig(threads=3, cores=6).apply()
+            self.assertEqual(numba.config.NUMBA_NUM_THREADS, 3)
+            self.assertEqual(blas_threads(), [3]*len(counts))
+        finally:
+            numba.config.NUMBA_NUM_THREADS = previous
+            for (getter, setter), count in zip(libraries, counts):
+                setter(count)
+
+    def test_splits(self):
+        configs = splits(6)
+        self.assertEqual([(c.workers, c.threads) for c in configs],
+                         [(6, 1), (3, 2), (2, 3), (1, 6)])
+
+
+
+class TestTune(TestCase):
+    def test_picks_fastest(self):
+        def make_fidelity(config):
+            fid = MagicMock()
+            fid.value_and_grad.side_effect = lambda controls: time.sleep(0.01*abs(config.threads-2))
+            return fid
+
+        best, timings = tune(make_fidelity, np.ones(2), cores=4, repeat=1)
+        self.assertEqual(best.threads, 2)
+        self.assertEqual(len(timings), 3)
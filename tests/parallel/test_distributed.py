@@ -0,0 +1,98 @@
+from unittest import TestCase
+from tests.ensembles import EnsembleTestCase
+import floq.optimization.fidelity as fid
+import floq.errors as er
+from floq.parallel.distributed import DistributedFidelity, start_local_daemons, tree_setup
+import numpy as np
+from mock import MagicMock
+
+
+class FailingDistance(fid.OperatorDistance):
+    def _f(self, controls):
+        if controls[0] < 0:
+            raise ValueError('Member failed')
+        return super(FailingDistance, self)._f(controls)
+
+
+
+class TestDistributedFidelity(EnsembleTestCase):
+    def setUp(self):
+        super(TestDistributedFidelity, self).setUp()
+        self.f, self.df = self.reference.value_and_grad(self.ctrl)
+
+        self.processes, self.addresses = start_local_daemons(4, 'secret')
+        self.fid = DistributedFidelity(self.addresses, self.ensemble, fid.OperatorDistance,
+                                       'secret', **self.params)
+
+
+    def tearDown(self):
+        self.fid.kill()
+        for process in self.processes:
+            process.terminate()
+
+
+    def test_f(self):
+        self.assertAlmostEqualWithDecimals(self.fid.f(self.ctrl), self.f)
+
+
+    def test_df(self):
+        self.assertArrayEqual(self.fid.df(self.ctrl), self.df)
+
+
+    def test_value_and_grad(self):
+        f, df = self.fid.value_and_grad(self.ctrl)
+        self.assertAlmostEqualWithDecimals(f, self.f)
+        self.assertArrayEqual(df, self.df)
+
+    def test_hessp(self):
+        v = np.array([0.3, -0.1, 0.2, 0.5])
+        self.fid._df = MagicMock(side_effect=AssertionError)
+        self.assertArrayEqual(self.fid.hessp(self.ctrl, v), self.reference.hessp(self.ctrl, v))
+
+    def test_batch(self):
+        controls = np.array([self.ctrl, 0.5*self.ctrl, 2*self.ctrl])
+        self.assertArrayEqual(self.fid.f_batch(controls), self.reference.f_batch(controls))
+        self.assertArrayEqual(self.fid.df_batch(controls), self.reference.df_batch(controls))
+
+        fs, dfs = self.fid.value_and_grad_batch(controls)
+        self.assertArrayEqual(fs, self.reference.f_batch(controls))
+        self.assertArrayEqual(dfs, self.reference.df_batch(controls))
+
+
+    def test_cache_state_round_trip(self):
+        state = self.fid.cache_state()
+        self.assertEqual(len(state), 5)
+
+        for i, member in enumerate(state):
+            member['nz'] = 33 + 2*i
+        self.fid.restore_cache(state)
+        self.assertEqual([member['nz'] for member in self.fid.cache_state()],
+                         [33, 35, 37, 39, 41])
+
+
+    def test_daemons_can_be_reused(self):
+        self.fid.kill()
+        self.fid = DistributedFidelity(self.addresses, self.ensemble, fid.OperatorDistance,
+                                       'secret', fanout=3, **self.params)
+        self.assertAlmostEqualWithDecimals(self.fid.f(self.ctrl), self.f)
+
+
+    def test_raises_remote_errors_and_keeps_serving(self):
+        self.fid.kill()
+        self.fid = DistributedFidelity(self.addresses, self.ensemble, FailingDistance,
+                                       'secret', **self.params)
+        with self.assertRaises(er.RemoteError) as context:
+            self.fid.f(-self.ctrl)
+        self.assertIn('Member failed', context.exception.remote_traceback)
+        self.assertIn(context.exception.worker, self.addresses)
+
+        self.assertAlmostEqualWithDecimals(self.fid.f(self.ctrl), self.f)
+
+
+
+class TestTreeSetup(TestCase):
+    def test_binary_tree(self):
+        setups = [['setup', i] for i in xrange(4)]
+        tree = tree_setup(0, ['a', 'b', 'c', 'd'], setups, 2)
+        self.assertEqual(tree, ['setup', 0, [['b', ['setup', 1, [['d', ['setup', 3, []]]]]],
+                                             ['c', ['setup', 2, []]]]])
@@ -0,0 +1,80 @@
+from tests.ensembles import EnsembleTestCase
+import floq.optimization.fidelity as fid
+from floq.parallel.simple_ensemble import ParallelEnsembleFidelity
+import numpy as np
+from mock import MagicMock
+
+
+class TestPersistentParallelEnsembleFidelity(EnsembleTestCase):
+    n = 3
+
+    def setUp(self):
+        super(TestPersistentParallelEnsembleFidelity, self).setUp()
+        self.fid = ParallelEnsembleFidelity(self.ensemble, fid.OperatorDistance, persistent=True,
+                                            processes=4, **self.params)
+
+
+    def tearDown(self):
+        self.fid.kill()
+
+
+    def test_f(self):
+        self.assertAlmostEqualWithDecimals(self.fid.f(self.ctrl), self.reference.f(self.ctrl))
+
+
+    def test_df(self):
+        self.assertArrayEqual(self.fid.df(self.ctrl), self.reference.df(self.ctrl))
+
+
+    def test_value_and_grad(self):
+        f, df = self.fid.value_and_grad(self.ctrl)
+        self.assertAlmostEqualWithDecimals(f, self.reference.f(self.ctrl))
+        self.assertArrayEqual(df, self.reference.df(self.ctrl))
+
+    def test_batch(self):
+        controls = np.array([self.ctrl, 0.5*self.ctrl, 2*self.ctrl])
+        self.assertArrayEqual(self.fid.f_batch(controls), self.reference.f_batch(controls))
+        self.assertArrayEqual(self.fid.df_batch(controls), self.reference.df_batch(controls))
+
+        fs, dfs = self.fid.value_and_grad_batch(controls)
+        self.assertArrayEqual(fs, self.reference.f_batch(controls))
+        self.assertArrayEqual(dfs, self.reference.df_batch(controls))
+
+        transient = ParallelEnsembleFidelity(self.ensemble, fid.OperatorDistance, processes=2,
+                                             **self.params)
+        try:
+            fs, dfs = transient.value_and_grad_batch(controls)
+        finally:
+            transient.kill()
+        self.assertArrayEqual(fs, self.reference.f_batch(controls))
+        self.assertArrayEqual(dfs, self.reference.df_batch(controls))
+
+
+    def test_hessp(self):
+        v = np.array([0.3, -0.1, 0.2, 0.5])
+        hv = self.reference.hessp(self.ctrl, v)
+        self.fid._df = MagicMock(side_effect=AssertionError)
+        self.assertArrayEqual(self.fid.hessp(self.ctrl, v), hv)
+
+        transient = ParallelEnsembleFidelity(self.ensemble, fid.OperatorDistance, processes=2,
+                                             **self.params)
+        transient._df = MagicMock(side_effect=AssertionError)
+        try:
+            self.assertArrayEqual(transient.hessp(self.ctrl, v), hv)
+        finally:
+            transient.kill()
+
+
+    def test_truncation_reaches_workers(self):
+        self.fid.f(self.ctrl)
+        state = self.fid.cache_state()
+        for member in state:
+            member['decimals'] = 4
+        self.fid.restore_cache(state)
+        self.fid.f(self.ctrl)
+        self.assertEqual([member['decimals'] for member in self.fid.cache_state()], [4]*3)
+
+
+    def test_fidelities_stay_in_workers(self):
+        self.fid.f(self.ctrl)
+        self.assertIsNone(self.fid.fidelities[0]._last_controls)
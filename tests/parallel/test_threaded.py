@@ -0,0 +1,83 @@
+from tests.ensembles import EnsembleTestCase
+import floq.optimization.fidelity as fid
+from floq.parallel.threaded import ThreadedEnsembleFidelity
+from floq.parallel.config import ParallelConfig, blas_threads
+import numpy as np
+from mock import MagicMock
+
+
+class BlasRecordingDistance(fid.OperatorDistance):
+    """ Records the BLAS thread counts seen while computing f """
+
+    def _f(self, controls_and_t):
+        self.blas_threads = blas_threads()
+        return super(BlasRecordingDistance, self)._f(controls_and_t)
+
+
+
+class TestThreadedEnsembleFidelity(EnsembleTestCase):
+    n = 3
+
+    def setUp(self):
+        super(TestThreadedEnsembleFidelity, self).setUp()
+        for system in self.ensemble.systems:
+            system.threads = 4
+        self.fid = ThreadedEnsembleFidelity(self.ensemble, fid.OperatorDistance, nthreads=2,
+                                            **self.params)
+
+
+    def tearDown(self):
+        self.fid.kill()
+
+
+    def test_f(self):
+        self.assertAlmostEqualWithDecimals(self.fid.f(self.ctrl), self.reference.f(self.ctrl))
+
+
+    def test_df(self):
+        self.assertArrayEqual(self.fid.df(self.ctrl), self.reference.df(self.ctrl))
+
+
+    def test_value_and_grad(self):
+        f, df = self.fid.value_and_grad(self.ctrl)
+        self.assertAlmostEqualWithDecimals(f, self.reference.f(self.ctrl))
+        self.assertArrayEqual(df, self.reference.df(self.ctrl))
+
+    def test_batch(self):
+        controls = np.array([self.ctrl, 0.5*self.ctrl, 2*self.ctrl])
+        self.assertArrayEqual(self.fid.f_batch(controls), self.reference.f_batch(controls))
+        self.assertArrayEqual(self.fid.df_batch(controls), self.reference.df_batch(controls))
+
+        fs, dfs = self.fid.value_and_grad_batch(controls)
+        self.assertArrayEqual(fs, self.reference.f_batch(controls))
+        self.assertArrayEqual(dfs, self.reference.df_batch(controls))
+
+
+    def test_hessp(self):
+        v = np.array([0.3, -0.1, 0.2, 0.5])
+        self.fid._df = MagicMock(side_effect=AssertionError)
+        self.assertArrayEqual(self.fid.hessp(self.ctrl, v), self.reference.hessp(self.ctrl, v))
+
+
+    def test_members_keep_their_state(self):
+        self.fid.f(self.ctrl)
+        self.assertArrayEqual(self.fid.fidelities[0]._last_controls, self.ctrl)
+
+
+    def test_members_compute_du_serially(self):
+        self.assertEqual([sys.threads for sys in self.ensemble.systems], [1, 1, 1])
+
+
+    def test_members_run_with_limited_blas(self):
+        config = ParallelConfig(workers=2, threads=3, cores=6)
+        threaded = ThreadedEnsembleFidelity(self.ensemble, BlasRecordingDistance, config=config,
+                                            **self.params)
+        outside = blas_threads()
+        try:
+            threaded.f(self.ctrl)
+        finally:
+            threaded.kill()
+
+        for member in threaded.fidelities:
+            self.assertEqual(member.blas_threads, [3]*len(outside))
+        self.assertEqual(blas_threads(), outside)
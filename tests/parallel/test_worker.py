@@ -0,0 +1,242 @@
+from unittest import TestCase
+import os
+import signal
+import time
+from tests.ensembles import EnsembleTestCase, spin_ensemble
+import floq.optimization.fidelity as fid
+import floq.errors as er
+from floq.parallel.worker import FidelityMaster, schedule
+from floq.systems.spins import SpinEnsemble
+import numpy as np
+from mock import MagicMock
+
+
+class TestFidelityMaster(EnsembleTestCase):
+    def setUp(self):
+        super(TestFidelityMaster, self).setUp()
+        self.master = FidelityMaster(2, self.ensemble, fid.OperatorDistance, **self.params)
+
+
+    def tearDown(self):
+        self.master.kill()
+
+
+    def test_f(self):
+        self.assertAlmostEqualWithDecimals(self.master.f(self.ctrl), self.reference.f(self.ctrl))
+
+
+    def test_df(self):
+        self.assertArrayEqual(self.master.df(self.ctrl), self.reference.df(self.ctrl))
+
+
+    def test_value_and_grad(self):
+        f, df = self.master.value_and_grad(self.ctrl)
+        self.assertAlmostEqualWithDecimals(f, self.reference.f(self.ctrl))
+        self.assertArrayEqual(df, self.reference.df(self.ctrl))
+
+    def test_batch(self):
+        controls = np.array([self.ctrl, 0.5*self.ctrl, 2*self.ctrl])
+        self.assertArrayEqual(self.master.f_batch(controls), self.reference.f_batch(controls))
+        self.assertArrayEqual(self.master.df_batch(controls), self.reference.df_batch(controls))
+
+        fs, dfs = self.master.value_and_grad_batch(controls)
+        self.assertArrayEqual(fs, self.reference.f_batch(controls))
+        self.assertArrayEqual(dfs, self.reference.df_batch(controls))
+
+
+    def test_hessp(self):
+        # Summed from the members' products, not a finite difference of _df
+        v = np.array([0.3, -0.1, 0.2, 0.5])
+        self.master._df = MagicMock(side_effect=AssertionError)
+        self.assertArrayEqual(self.master.hessp(self.ctrl, v), self.reference.hessp(self.ctrl, v))
+        f, df = self.master.value_and_grad(self.ctrl)
+        self.assertAlmostEqualWithDecimals(f, self.reference.f(self.ctrl))
+
+
+    def test_cache_state_round_trip(self):
+        self.master.f(self.ctrl)
+        state = self.master.cache_state()
+        self.assertEqual(len(state), 5)
+
+        for member in state:
+            member['nz'] = 41
+        self.master.restore_cache(state)
+        self.assertEqual([member['nz'] for member in self.master.cache_state()], [41]*5)
+        self.assertAlmostEqualWithDecimals(self.master.f(0.5*self.ctrl),
+                                           self.reference.f(0.5*self.ctrl))
+
+
+    def test_ncomp_reaches_workers(self):
+        self.master.f(self.ctrl)
+        self.master.restore_cache([dict(state, ncomp=3) for state in self.master.cache_state()])
+
+        reference = fid.EnsembleFidelity(spin_ensemble(5, ncomp=3), fid.OperatorDistance,
+                                         **self.params)
+        ctrl = np.append(self.ctrl, [0.2, 0.1])
+        self.assertAlmostEqualWithDecimals(self.master.f(ctrl), reference.f(ctrl))
+
+
+    def test_mask(self):
+        self.master.df(self.ctrl)
+        self.master.set_mask([1, 2])
+        self.assertArrayEqual(self.master.df(self.ctrl), self.reference.df(self.ctrl)[[1, 2]])
+        f, df = self.master.value_and_grad(0.5*self.ctrl)
+        self.assertArrayEqual(df, self.reference.df(0.5*self.ctrl)[[1, 2]])
+
+
+    def test_new_controls_are_broadcast(self):
+        self.master.f(self.ctrl)
+        ctrl = 0.5*self.ctrl
+        self.assertAlmostEqualWithDecimals(self.master.f(ctrl), self.reference.f(ctrl))
+
+
+    def test_more_workers_than_members(self):
+        self.master.kill()
+        self.master = FidelityMaster(7, self.ensemble, fid.OperatorDistance, **self.params)
+        self.assertArrayEqual(self.master.df(self.ctrl), self.reference.df(self.ctrl))
+
+
+    def test_costs_are_recorded(self):
+        self.master.f(self.ctrl)
+        self.assertTrue(np.all(self.master.costs > 0.0))
+        self.assertTrue(set(self.master.owners) <= set([0, 1]))
+
+
+    def test_repeated_calls_with_schedule(self):
+        self.master.f(self.ctrl)
+        self.master.costs[0] = 10.0
+        self.assertArrayEqual(self.master.df(self.ctrl), self.reference.df(self.ctrl))
+
+
+
+class TestFidelityMasterWarmState(TestCase):
+    def setUp(self):
+        # Members start at the default nz, which the workers have to grow
+        self.ensemble = SpinEnsemble(4, 2, 1.5, np.array([1.1, 1.0, 0.9, 1.05]), np.ones(4))
+        self.ctrl = np.array([1.5, 1.2, 1.3, 1.4])
+        self.master = FidelityMaster(2, self.ensemble, fid.OperatorDistance, t=1.0,
+                                     target=np.eye(2))
+
+
+    def tearDown(self):
+        self.master.kill()
+
+
+    def template_nz(self):
+        return [fid.system.nz for fid in self.master.fidelities]
+
+
+    def test_respawn_for_batch_keeps_caches(self):
+        self.master.f(self.ctrl)
+        grown = [state['nz'] for state in self.master.cache_state()]
+        self.assertTrue(min(grown) > 3)
+
+        self.master.f_batch(np.array([self.ctrl, 0.5*self.ctrl, 2*self.ctrl]))
+        self.assertEqual(self.master.capacity, 3)
+        self.assertEqual(self.template_nz(), grown)
+        self.assertTrue(all(fid.system._fixed_system is not None
+                            for fid in self.master.fidelities))
+
+
+    def test_batch_sizes_buffers(self):
+        self.master.kill()
+        self.master = FidelityMaster(2, self.ensemble, fid.OperatorDistance, batch=4, t=1.0,
+                                     target=np.eye(2))
+        self.master.f(self.ctrl)
+        pids = [worker.pid for worker in self.master.workers]
+
+        self.master.f_batch(np.array([self.ctrl, 0.5*self.ctrl, 2*self.ctrl]))
+        self.assertEqual([worker.pid for worker in self.master.workers], pids)
+
+
+    def test_respawned_worker_starts_from_reported_truncation(self):
+        self.master.f(self.ctrl)
+        self.assertEqual(sorted(self.master.states), range(4))
+
+        os.kill(self.master.workers[0].pid, signal.SIGKILL)
+        self.master.workers[0].join()
+        self.master.f(0.5*self.ctrl)
+
+        # The templates the worker was forked from are no longer cold
+        self.assertEqual(len(self.master.failures), 1)
+        self.assertTrue(min(self.template_nz()) > 3)
+
+
+
+class SleepyFidelity(fid.FidelityBase):
+    def __init__(self, system, sleep=0.0, fail=False):
+        super(SleepyFidelity, self).__init__(system)
+        self.sleep = sleep
+        self.fail = fail
+
+    def _f(self, controls):
+        time.sleep(self.sleep)
+        if self.fail:
+            raise ValueError('Member failed')
+        return 1.0
+
+    def _df(self, controls):
+        return np.ones_like(controls)
+
+
+
+class TestFidelityMasterFaults(TestCase):
+    def setUp(self):
+        self.ensemble = SpinEnsemble(4, 2, 1.5, np.ones(4), np.ones(4))
+        self.ctrl = np.array([1.0, 2.0])
+        self.master = None
+
+
+    def tearDown(self):
+        self.master.kill()
+
+
+    def test_respawns_dead_worker(self):
+        self.master = FidelityMaster(2, self.ensemble, SleepyFidelity)
+        self.master.f(self.ctrl)
+
+        os.kill(self.master.workers[0].pid, signal.SIGKILL)
+        self.master.workers[0].join()
+
+        self.assertAlmostEqual(self.master.f(2*self.ctrl), 1.0)
+        self.assertIsInstance(self.master.failures[0], er.WorkerDiedError)
+        self.assertEqual(self.master.failures[0].worker, 0)
+        self.assertTrue(self.master.workers[0].is_alive())
+
+
+    def test_raises_after_timeouts(self):
+        self.master = FidelityMaster(2, self.ensemble, SleepyFidelity, timeout=0.2, retries=1,
+                                     sleep=5.0)
+        with self.assertRaises(er.WorkerTimeoutError):
+            self.master.f(self.ctrl)
+        self.assertEqual(len(self.master.failures), 4)
+
+
+    def test_raises_remote_errors(self):
+        self.master = FidelityMaster(2, self.ensemble, SleepyFidelity, fail=True)
+        with self.assertRaises(er.RemoteError) as context:
+            self.master.f(self.ctrl)
+        self.assertIn('Member failed', context.exception.remote_traceback)
+        self.assertEqual(self.master.failures, [])
+
+
+
+class TestSchedule(TestCase):
+    def test_even_split_without_costs(self):
+        assigned = schedule(np.zeros(5), np.zeros(5, dtype=int), 2)
+        self.assertEqual(assigned, [[0, 1, 2], [3, 4]])
+
+    def test_keeps_owners_when_balanced(self):
+        costs = np.array([1.0, 1.0, 1.0, 1.0])
+        owners = np.array([1, 0, 1, 0])
+        assigned = schedule(costs, owners, 2)
+        self.assertEqual(sorted(assigned[0]), [1, 3])
+        self.assertEqual(sorted(assigned[1]), [0, 2])
+
+    def test_rebalances_expensive_members(self):
+        costs = np.array([4.0, 1.0, 1.0, 1.0, 1.0])
+        owners = np.array([0, 0, 0, 1, 1])
+        assigned = schedule(costs, owners, 2)
+        self.assertEqual(assigned[0][0], 0)
+        self.assertEqual(sorted(assigned[0]), [0])
+        self.assertEqual(sorted(assigned[1]), [1, 2, 3, 4])
@@ -0,0 +1,51 @@
+from tests.assertions import CustomAssertions
+import numpy as np
+from floq.systems.ensemble import EnsembleBase, CompressedEnsemble
+
+
+class ListEnsemble(EnsembleBase):
+    def __init__(self, systems):
+        self._systems = systems
+
+    @property
+    def systems(self):
+        return self._systems
+
+
+
+class TestEnsembleBaseWeights(CustomAssertions):
+    def test_uniform(self):
+        ensemble = ListEnsemble(['a', 'b', 'c', 'd'])
+        self.assertArrayEqual(ensemble.weights, 0.25*np.ones(4))
+
+
+
+class TestCompressedEnsemble(CustomAssertions):
+    def setUp(self):
+        self.ensemble = ListEnsemble(['a', 'b', 'c', 'd', 'e'])
+        self.parameters = np.array([[0.0, 1.0],
+                                    [0.01, 1.0],
+                                    [1.0, 1.0],
+                                    [-0.01, 1.0],
+                                    [1.0, 2.0]])
+        self.compressed = CompressedEnsemble(self.ensemble, self.parameters, 0.1)
+
+    def test_merges_close_members(self):
+        self.assertEqual(len(self.compressed.systems), 3)
+
+    def test_representative_is_central(self):
+        self.assertIn('a', self.compressed.systems)
+
+    def test_weights(self):
+        self.assertArrayEqual(np.sort(self.compressed.weights), [0.2, 0.2, 0.6])
+
+    def test_compression_ratio(self):
+        self.assertAlmostEqualWithDecimals(self.compressed.compression_ratio, 5.0/3.0)
+
+    def test_error_bound(self):
+        bound = self.compressed.error_bound(np.array([2.0, 0.0]))
+        self.assertAlmostEqualWithDecimals(bound, 0.2*2*0.01*2)
+
+    def test_no_error_without_merging(self):
+        exact = CompressedEnsemble(self.ensemble, self.parameters, 1e-5)
+        self.assertAlmostEqualWithDecimals(exact.error_bound(np.ones(2)), 0.0)
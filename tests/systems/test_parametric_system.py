@@ -1,6 +1,7 @@
 from unittest import TestCase
 import numpy as np
 import floq.systems.parametric_system as ps
+import floq.systems.spins as spins
 import floq.core.fixed_system
 import floq.errors as er
 import tests.rabi as rabi
@@ -53,3 +54,76 @@ class TestParametricSystemBaseCaching(TestCase):
             self.real.u(self.ctrls1, 1.0)
             self.real.u(self.ctrls2, 1.0)
             self.assertEqual(mock.call_count, 2)
+
+    def test_restored_cache_skips_recomputation(self):
+        with patch('floq.core.fixed_system.FixedSystem') as mock:
+            self.real.u(self.ctrls1, 1.0)
+            state = self.real.cache_state(True)
+
+            fresh = ps.ParametricSystemBase()
+            fresh._hf = MagicMock()
+            fresh._dhf = MagicMock()
+            fresh.omega = self.real.omega
+            fresh.restore_cache(state)
+            fresh.u(self.ctrls1, 1.0)
+            mock.assert_called_once()
+            self.assertIs(fresh.nz, self.real.nz)
+
+    def test_restored_truncation_drops_cache(self):
+        with patch('floq.core.fixed_system.FixedSystem') as mock:
+            self.real.u(self.ctrls1, 1.0)
+            self.real.restore_cache({'nz': 5, 'decimals': 3, 'fixed_nz': True})
+            self.real.u(self.ctrls1, 1.0)
+            self.assertEqual(mock.call_count, 2)
+            args, kwargs = mock.call_args
+            self.assertEqual(args[2], 5)
+            self.assertEqual(kwargs['decimals'], 3)
+            self.assertTrue(kwargs['fixed_nz'])
+
+
+
+class TestParametricSystemDuration(CustomAssertions):
+    def test_eigensystem_reused_for_new_t(self):
+        system = spins.SpinSystem(2, 1.0, 0.3, 1.5)
+        controls = np.array([1.2, 0.7, -0.4, 0.9])
+        system.u(controls, 1.0)
+        with patch('floq.core.evolution.find_eigensystem') as find:
+            u = system.u(controls, 1.7)
+            find.assert_not_called()
+        self.assertArrayEqual(u, spins.SpinSystem(2, 1.0, 0.3, 1.5).u(controls, 1.7), 8)
+
+
+
+class TestFourierControlSystem(CustomAssertions):
+    def setUp(self):
+        sx = np.array([[0, 1], [1, 0]])
+        sy = np.array([[0, -1j], [1j, 0]])
+        sz = np.array([[1, 0], [0, -1]])
+        self.system = ps.FourierControlSystem(0.15*sz, [0.5*sx, 0.5*sy], 2, 1.5)
+
+    def test_matches_spin_with_sine_pulse(self):
+        spin = spins.SpinSystem(2, 1.0, 0.3, 1.5)
+        controls = np.array([0.3, 0.5, 0.7, 0.2])
+        # only sine components: [cos_x, cos_y, sin_x, sin_y] per harmonic
+        fourier_controls = np.array([0.0, 0.0, 0.3, 0.5, 0.0, 0.0, 0.7, 0.2])
+        self.assertArrayEqual(self.system.u(fourier_controls, 1.0), spin.u(controls, 1.0), 10)
+
+    def test_dhf_is_derivative(self):
+        controls = np.arange(8.0)
+        hf = self.system._hf(controls)
+        unit = np.zeros(8)
+        unit[5] = 1.0
+        self.assertArrayEqual(self.system._hf(controls+unit) - hf, self.system._dhf(controls)[5])
+
+    def test_set_ncomp_keeps_controls(self):
+        controls = np.linspace(0.1, 0.8, 8)
+        u = self.system.u(controls, 1.0)
+        self.system.set_ncomp(3)
+        self.assertEqual(self.system.dhf.shape[0], 12)
+        self.assertArrayEqual(self.system.u(ps.expand_controls(controls, 2, 3), 1.0), u, 10)
+
+
+class TestExpandControls(TestCase):
+    def test_pads_components(self):
+        expanded = ps.expand_controls(np.array([1.0, 2.0, 3.0, 4.0]), 2, 4)
+        self.assertTrue(np.array_equal(expanded, [1.0, 2.0, 3.0, 4.0, 0.0, 0.0, 0.0, 0.0]))
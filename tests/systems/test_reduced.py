@@ -0,0 +1,53 @@
+from tests.assertions import CustomAssertions
+import numpy as np
+import floq.systems.spins as spins
+import floq.optimization.fidelity as fid
+from floq.systems.reduced import ReducedControlSystem, ReducedEnsemble, random_basis
+
+
+class TestReducedControlSystem(CustomAssertions):
+    def setUp(self):
+        self.full = spins.SpinSystem(3, 1.1, 0.9, 1.5)
+        self.basis = random_basis(6, 2, seed=3)
+        self.offset = np.array([0.5, 0.1, 0.2, 0.3, 0.0, 0.4])
+        self.system = ReducedControlSystem(spins.SpinSystem(3, 1.1, 0.9, 1.5), self.basis,
+                                           offset=self.offset)
+        self.coefficients = np.array([0.7, -0.3])
+
+    def test_basis_is_orthonormal(self):
+        self.assertArrayEqual(np.dot(self.basis.T, self.basis), np.eye(2))
+
+    def test_u_of_full_controls(self):
+        full_controls = self.system.full_controls(self.coefficients)
+        self.assertArrayEqual(self.system.u(self.coefficients, 1.0),
+                              self.full.u(full_controls, 1.0))
+
+    def test_du_is_projected(self):
+        full_controls = self.system.full_controls(self.coefficients)
+        du = self.system.du(self.coefficients, 1.0)
+        self.assertEqual(du.shape, (2, 2, 2))
+        self.assertArrayEqual(du, np.tensordot(self.basis.T, self.full.du(full_controls, 1.0),
+                                               axes=1))
+
+    def test_mixed_derivatives_are_projected(self):
+        full_controls = self.system.full_controls(self.coefficients)
+        d2u = self.system.d2u_parameters_controls(self.coefficients, 1.0)
+        full = self.full.d2u_parameters_controls(full_controls, 1.0)
+        self.assertArrayEqual(d2u, np.tensordot(full, self.basis, axes=([1], [0])).transpose(0, 3, 1, 2))
+
+
+
+class TestReducedEnsemble(CustomAssertions):
+    def test_gradient_is_projected(self):
+        ensemble = spins.SpinEnsemble(2, 3, 1.5, np.array([1.1, 0.9]), np.array([1.0, 1.1]))
+        reduced = ReducedEnsemble(spins.SpinEnsemble(2, 3, 1.5, np.array([1.1, 0.9]),
+                                                     np.array([1.0, 1.1])),
+                                  rank=3, np_full=6, seed=1)
+        params = dict(t=1.0, target=np.eye(2))
+        full = fid.EnsembleFidelity(ensemble, fid.OperatorDistance, **params)
+        small = fid.EnsembleFidelity(reduced, fid.OperatorDistance, **params)
+
+        coefficients = np.array([0.5, 1.0, -0.5])
+        controls = reduced.full_controls(coefficients)
+        self.assertAlmostEqualWithDecimals(small.f(coefficients), full.f(controls))
+        self.assertArrayEqual(small.df(coefficients), np.dot(reduced.basis.T, full.df(controls)))
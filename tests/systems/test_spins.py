@@ -1,6 +1,7 @@
 from tests.assertions import CustomAssertions
 import numpy as np
 import floq.systems.spins as spins
+import floq.optimization.fidelity as fid
 
 
 
@@ -103,3 +104,141 @@ class TestSpinEnsemble(CustomAssertions):
         target = single.u(self.controls, self.t)
 
         self.assertArrayEqual(result, target, decimals=10)
+
+
+    def test_set_ncomp_keeps_controls(self):
+        system = self.ensemble.systems[0]
+        u = system.u(self.controls, self.t)
+
+        self.ensemble.set_ncomp(3)
+        self.assertEqual(self.ensemble.np, 6)
+        self.assertEqual(system.dhf.shape[0], 6)
+        padded = np.append(self.controls, [0.0, 0.0])
+        self.assertArrayEqual(system.u(padded, self.t), u, decimals=10)
+
+
+    def test_restore_cache_sets_ncomp(self):
+        system = self.ensemble.systems[0]
+        state = system.cache_state()
+        self.assertEqual(state['ncomp'], 2)
+
+        state['ncomp'] = 4
+        system.restore_cache(state)
+        self.assertEqual(system.ncomp, 4)
+        self.assertEqual(system.dhf.shape[0], 8)
+
+
+class TestSpinEnsembleCompression(CustomAssertions):
+
+    def setUp(self):
+        self.amps = np.array([1.0, 1.0001, 0.7, 1.0])
+        self.freqs = np.array([0.8, 0.8001, 0.9, 0.8])
+        self.ensemble = spins.SpinEnsemble(4, 2, 1.0, self.freqs, self.amps)
+
+        self.controls = np.array([1.5, 1.3, 1.4, 1.1])
+        self.target = np.array([[0.105818 - 0.324164j, -0.601164 - 0.722718j],
+                                [0.601164 - 0.722718j, 0.105818 + 0.324164j]])
+
+    def test_compresses(self):
+        compressed = self.ensemble.compress(0.01)
+        self.assertEqual(len(compressed.systems), 2)
+
+    def test_fidelity_within_bound(self):
+        compressed = self.ensemble.compress(0.01)
+
+        full = fid.EnsembleFidelity(self.ensemble, fid.OperatorDistance, t=3.0, target=self.target)
+        reduced = fid.EnsembleFidelity(compressed, fid.OperatorDistance, t=3.0, target=self.target)
+
+        difference = abs(full.f(self.controls)-reduced.f(self.controls))
+        bound = compressed.error_bound(spins.sensitivities(self.controls, 3.0))
+        self.assertTrue(difference <= bound)
+
+
+class TestSpinSystemParameterDerivatives(CustomAssertions):
+
+    def setUp(self):
+        self.controls = np.array([1.2, 0.7, -0.4, 0.9])
+        self.t = 2.0
+        self.system = self.make_system(0.5, 0.3)
+
+    def make_system(self, amp, freq):
+        system = spins.SpinSystem(2, amp, freq, 1.5)
+        system.nz = 31
+        return system
+
+    def finite_difference(self, amp, freq):
+        h = 1e-4
+        plus = self.make_system(0.5+amp*h, 0.3+freq*h).u(self.controls, self.t)
+        minus = self.make_system(0.5-amp*h, 0.3-freq*h).u(self.controls, self.t)
+        return (plus-minus)/(2*h)
+
+    def test_du_freq(self):
+        du = self.system.du_parameters(self.controls, self.t)
+        self.assertArrayEqual(du[0], self.finite_difference(0.0, 1.0), 6)
+
+    def test_du_amp(self):
+        du = self.system.du_parameters(self.controls, self.t)
+        self.assertArrayEqual(du[1], self.finite_difference(1.0, 0.0), 6)
+
+    def test_du_controls_attenuated(self):
+        h = 1e-4
+        step = h*np.array([1.0, 0.0, 0.0, 0.0])
+        plus = self.make_system(0.5, 0.3).u(self.controls+step, self.t)
+        minus = self.make_system(0.5, 0.3).u(self.controls-step, self.t)
+
+        du = self.system.du(self.controls, self.t)
+        self.assertArrayEqual(du[0], (plus-minus)/(2*h), 6)
+
+    def test_mixed_derivatives(self):
+        h = 1e-4
+        ddu = self.system.d2u_parameters_controls(self.controls, self.t)
+        plus = self.make_system(0.5+h, 0.3).du(self.controls, self.t)
+        minus = self.make_system(0.5-h, 0.3).du(self.controls, self.t)
+
+        self.assertArrayEqual(ddu[1], (plus-minus)/(2*h), 6)
+
+
+
+class TestSpinSystemMask(CustomAssertions):
+    def setUp(self):
+        self.controls = np.array([1.2, 0.7, -0.4, 0.9])
+        self.full = spins.SpinSystem(2, 0.5, 0.3, 1.5)
+        self.system = spins.SpinSystem(2, 0.5, 0.3, 1.5)
+
+    def test_only_masked_derivatives(self):
+        du = self.system.du(self.controls, 2.0, mask=[0, 3])
+        self.assertArrayEqual(du, self.full.du(self.controls, 2.0)[[0, 3]])
+        self.assertIsNone(self.system._fixed_system._du)
+
+    def test_boolean_mask_and_cached_du(self):
+        full = self.system.du(self.controls, 2.0)
+        du = self.system.du(self.controls, 2.0, mask=np.array([False, True, True, False]))
+        self.assertArrayEqual(du, full[[1, 2]])
+
+    def test_mask_attribute(self):
+        self.system.mask = (2,)
+        self.assertEqual(self.system.du(self.controls, 2.0).shape, (1, 2, 2))
+        d2u = self.system.d2u_parameters_controls(self.controls, 2.0)
+        full = self.full.d2u_parameters_controls(self.controls, 2.0)
+        self.assertArrayEqual(d2u, full[:, [2]])
+
+
+
+
+class TestSpinSystemDirectional(CustomAssertions):
+    def setUp(self):
+        self.controls = np.array([1.2, 0.7, -0.4, 0.9])
+        self.v = np.array([0.3, -1.0, 0.5, 0.2])
+        self.full = spins.SpinSystem(2, 0.5, 0.3, 1.5)
+        self.system = spins.SpinSystem(2, 0.5, 0.3, 1.5)
+
+    def test_contracts_full_du(self):
+        du_v = self.system.du_directional(self.controls, 2.0, self.v)
+        expected = np.tensordot(self.v, self.full.du(self.controls, 2.0), axes=1)
+        self.assertArrayEqual(du_v, expected)
+        self.assertIsNone(self.system._fixed_system._du)
+
+    def test_uses_cached_du(self):
+        full = self.system.du(self.controls, 2.0)
+        du_v = self.system.du_directional(self.controls, 2.0, self.v)
+        self.assertArrayEqual(du_v, np.tensordot(self.v, full, axes=1))